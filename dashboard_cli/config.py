@@ -6,11 +6,12 @@ from char_draw.graph import LineGraph,BarGraph,PieGraph,TableGraph
 from data_sources.syslog_data import SyslogDataTable
 from data_sources.proc_data import ProcDataTable
 from data_sources.elastic_data import ElasticsearchDataTable
-from data_sources.remote_data import RemoteDataTable,shutdown_connection_manager
+from data_sources.remote_data import RemoteDataTable,get_connection_manager,shutdown_connection_manager
 from data_sources.odbc_data import ODBCDataTable
 from data_sources.json_data import JSONDataTable
 from data_sources.csv_data import CSVDataTable
 from data_sources.logs_data import LogDataTable
+from data_sources.cgroup_data import CgroupDataTable
 from data_sources.data_table import to_json,from_json
 import importlib.util
 
@@ -23,22 +24,57 @@ graph_plugins = {}
 #       [
 #           {
 #           "name" : name to refer to this table below,
-#           "type" : one of "SyslogDataTable","ProcDataTable","ElasticsearchDataTable","RemoteDataTable","ODBCDataTable","CSVDataTable","JSONDataTable","LogDataTable" ( more to come),
+#           "type" : one of "SyslogDataTable","ProcDataTable","ElasticsearchDataTable","RemoteDataTable","ODBCDataTable","CSVDataTable","JSONDataTable","LogDataTable","CgroupDataTable" ( more to come),
 #           "refresh_minutes" : number of minutes to automatically refresh optional, 0 if only manual, default is 5 minutes
 #           "num_hours" : number of hours of history to look at
 #           "bucket_hours" : number of hours per bucket, table will have num_hours/bucket_hours entries
 #           "syslog_glob" : full unix glob pattern to match syslogs for the SyslogDataTable
+#           "sample_seconds" : for the ProcDataTable and CgroupDataTable, number of seconds between samples independent of refresh_minutes, 0 ( the default ) samples once per refresh
+#           "proc_stats" : for the ProcDataTable and CgroupDataTable, list of extra statistics for each metric's bucket one of "min","max","last", adds a column named for the metric and the statistic ex. "CPU Percent Max"
+#           "proc_backend" : for the ProcDataTable, one of "psutil" ( the default ) or "procfs" which reads /proc directly on Linux with less overhead per sample
+#           "proc_metrics" : for the ProcDataTable, list of metric sets to collect, default is [ "host" ]:
+#                    "host" : the host wide columns "CPU Percent", "Load Avg", "Filesystem Read Bytes/Sec" etc.
+#                    "per_cpu" : a "CPU <n> Percent" column for each core
+#                    "per_disk" : "Disk <device> Read Bytes/Sec", "... Write Bytes/Sec", "... Read Ops/Sec", "... Write Ops/Sec" columns for each disk device
+#                    "per_nic" : "Network <interface> Sent Bytes/Sec", "... Received Bytes/Sec", "... Sent Packets/Sec", "... Received Packets/Sec" columns for each network interface
+#                    "top_processes" : "Process PID", "Process Name", "Process CPU Percent", "Process RSS" columns for the top processes, updated on each refresh
+#           "proc_top_n" : for the ProcDataTable, the number of processes in the top_processes columns, default is 10
+#           "proc_top_sort" : for the ProcDataTable, sort the top_processes by one of "cpu" ( the default ) or "rss"
+#           "cgroup_globs" : for the CgroupDataTable, list of globs relative to cgroup_root matching the cgroup v2 directories to watch ex. [ "system.slice/*.service" ], each adds "<cgroup> CPU Percent", "<cgroup> CPU Throttled Percent", "<cgroup> Memory Current", "<cgroup> Memory Anon", "<cgroup> Memory File", "<cgroup> IO Read Bytes/Sec", "<cgroup> IO Write Bytes/Sec", "<cgroup> IO Read Ops/Sec", "<cgroup> IO Write Ops/Sec" columns
+#           "cgroup_root" : for the CgroupDataTable, the mount point of the cgroup v2 hierarchy, default is "/sys/fs/cgroup"
 #           "es_index_pattern" : only for ElasticsearchDataTable, Elasticsearch index pattern wildcard to query
 #           "es_query_body" : { body of the query to execute as well formed JSON Elasticsearch DSL },
 #           "es_field_map" : [ array of tuples [ json_path ex "aggregations.3.buckets.key" matching the value you want, column name to append it to in the table, value type one of int,float,str,or date where date is a timestamp numerical value ]...]
+#           "es_connection" : for the ElasticsearchDataTable, optional keyword arguments for the Elasticsearch client ex. { "hosts" : [ "http://localhost:9200" ] }, defaults to the client defaults, tables with the same es_connection share one client and connection pool
+#           "es_incremental" : for the ElasticsearchDataTable with a date_histogram query, optional, only query for new buckets on each refresh and merge them into the table:
+#                    { "timestamp_field" : the field the query's range is on ex. "@timestamp", the range is rewritten ( or added ) to start at the last bucket already in the table,
+#                      "key_column" : the name of the date column in the table holding the bucket keys,
+#                      "window_minutes" : optional, buckets older than this many minutes are dropped,
+#                      "overlap_buckets" : optional, the number of trailing buckets to fetch again, default is 1 which fetches the last possibly incomplete bucket }
+#           "es_max_rows" : for the ElasticsearchDataTable with a hits query, optional, page through up to this many hits using search_after in a point in time instead of a single search, hits are converted as each page arrives
+#           "es_page_size" : for the ElasticsearchDataTable with es_max_rows, optional, number of hits to fetch per page, default 1000
+#           "es_batch_seconds" : for the ElasticsearchDataTable, optional, wait this many seconds ex. 0.1 for other tables on the same es_connection to refresh and send all their searches as one _msearch, identical searches are only sent once
+#           "es_cache_seconds" : for the ElasticsearchDataTable with es_batch_seconds, optional, reuse the response to an identical search made less than this many seconds ago, default 0 is no caching
 #           "ssh_spec" : for the RemoteDataTable a string of the form ssh://username@hostname:port to connect to the remote system
 #           "table_def" : for the RemoteDataTable one of these table definitions, defines the remote table to populate, assumes local keyring has credentials for user at hostname
 #           "sql_spec" : for the ODBCDataTable, a string of the following form to specify a connection to an odbc database odbc://username@server/driver/database:port, assumes local keyring has credentials at this spec so something like 'keyring set odbc://james@localhost/myodbc8w/james:5432 james',
 #           "sql_query" : for the ODBCDataTable, a sql query to execute on that database,
 #           "sql_map" : for the ODBCDataTable, a list of tuples of the form [[sql_column_name,data_table_column_name],...] only these columns will be mapped into the table
+#           "sql_watermark" : for the ODBCDataTable, optional, for append only tables, { "column" : sql column ex. an id or timestamp that increases, "start" : value to start from, default 0 }, the sql_query has one ? parameter ex. "select * from events where id > ? order by id" that is bound to the largest value seen and the new rows are appended, without it each refresh replaces the table
+#           "sql_max_rows" : for the ODBCDataTable, optional, only keep the last sql_max_rows rows
+#           "sql_batch_size" : for the ODBCDataTable, optional, number of rows to fetch from the database at a time, default 1000
+#           "sql_aggregate" : for the ODBCDataTable, optional, instead of sql_query and sql_map have the database aggregate a table into time buckets with a GROUP BY so only one row per bucket is fetched:
+#                    { "table" : the table to query, "timestamp_column" : the timestamp column to bucket on,
+#                      "bucket_minutes" : size of a bucket in minutes, default 60, "num_buckets" : number of buckets back from now to keep, default 24,
+#                      "dialect" : sql dialect of the database, one of sqlite, postgresql or mysql, default sqlite,
+#                      "aggregates" : [ [ function one of count,sum,avg,min,max, sql column or * , data table column name ],...],
+#                      "where" : optional extra sql condition on the rows, "key_column" : name of the column of bucket times, default "Time Stamps" }
 #           "csv_spec" : for the CSVDataTable, path to CSV file to read,
 #           "csv_map" : for the CSVDataTable, column specification of the form [["csv_column_name","data_table_column_name","type one of _int,_float,_string,_date"],...] only imports matching columns,
-#           "json_spec" : for the JSONDataTable path to a JSON file to read, assumed to be in the format written by the data_sources.data_table.to_json function,
+#           "csv_tail" : for the CSVDataTable, optional, if true the CSV file is treated as append only and each refresh only parses the complete lines added since the last one, the file is reloaded if it is truncated or rewritten, default false
+#           "csv_max_rows" : for the CSVDataTable, optional, only keep the last csv_max_rows rows
+#           "json_spec" : for the JSONDataTable path to a JSON file to read, assumed to be in the format written by the data_sources.data_table.to_json function, either the standard or the compact columnar format,
+#           "file_hash" : for the CSVDataTable and JSONDataTable, optional, the file is only reloaded when its modification time, size or inode change, if true a hash of the contents is also compared so rewriting the same contents doesn't reload the table, default false
 #           "log_glob" : for the LogDataTable, glob of log files to read, can include compressed logs in .gz format,
 #           "log_map" : for the LogDataTable, list of line specifications of the form:
 #                    [ { "line_regex" : "escaped python regex with a group per field to extract",
@@ -49,6 +85,8 @@ graph_plugins = {}
 #                       },...repeated matches with different keys can collect other aggregations and also handle different types of lines
 #                    ],
 #           "log_lookback" : a tuple of the number of days, hours, minutes to look back at logs [ days, hours, minutes ] all must be specified
+#           "state_dir" : for the SyslogDataTable and LogDataTable, optional directory to checkpoint the aggregates and log file offsets in so a restart only parses new log data, ex "~/.dashboard/state",
+#           "checkpoint_minutes" : number of minutes between checkpoints when state_dir is set, a checkpoint is also written on shutdown, default is 5 minutes
 #           },
 #       ],
 #   "dashboard": definition of the dashboard to present
@@ -98,33 +136,58 @@ def load_table( t ):
     es_index_pattern = t.get("es_index_pattern",None)
     es_query_body = t.get("es_query_body",None)
     es_field_map = t.get("es_field_map",None)
+    es_connection = t.get("es_connection",None)
+    es_incremental = t.get("es_incremental",None)
+    es_max_rows = t.get("es_max_rows",None)
+    es_page_size = t.get("es_page_size",1000)
+    es_batch_seconds = t.get("es_batch_seconds",None)
+    es_cache_seconds = t.get("es_cache_seconds",0)
     ssh_spec = t.get("ssh_spec",None)
     table_def = t.get("table_def",None)
     sql_spec = t.get("sql_spec",None)
     sql_query = t.get("sql_query",None)
     sql_map = t.get("sql_map",None)
+    sql_watermark = t.get("sql_watermark",None)
+    sql_max_rows = t.get("sql_max_rows",None)
+    sql_batch_size = t.get("sql_batch_size",1000)
+    sql_aggregate = t.get("sql_aggregate",None)
     csv_spec = t.get("csv_spec",None)
     csv_map = t.get("csv_map",None)
+    csv_tail = t.get("csv_tail",False)
+    csv_max_rows = t.get("csv_max_rows",None)
     json_spec = t.get("json_spec",None)
+    file_hash = t.get("file_hash",False)
     log_glob = t.get("log_glob",None)
     log_map = t.get("log_map",None)
     log_lookback = t.get("log_lookback",None)
+    state_dir = t.get("state_dir",None)
+    checkpoint_minutes = t.get("checkpoint_minutes",5)
+    sample_seconds = t.get("sample_seconds",0)
+    proc_stats = t.get("proc_stats",None)
+    proc_backend = t.get("proc_backend","psutil")
+    proc_metrics = t.get("proc_metrics",None)
+    proc_top_n = t.get("proc_top_n",10)
+    proc_top_sort = t.get("proc_top_sort","cpu")
+    cgroup_globs = t.get("cgroup_globs",None)
+    cgroup_root = t.get("cgroup_root","/sys/fs/cgroup")
     if t["type"] == "SyslogDataTable":
-        dt = SyslogDataTable(syslog_glob,num_hours,bucket_hours,refresh_minutes)
+        dt = SyslogDataTable(syslog_glob,num_hours,bucket_hours,refresh_minutes,state_dir=state_dir,checkpoint_minutes=checkpoint_minutes)
     elif t["type"] == "ProcDataTable":
-        dt = ProcDataTable(num_hours,bucket_hours,refresh_minutes)
+        dt = ProcDataTable(num_hours,bucket_hours,refresh_minutes,sample_seconds,proc_stats,proc_backend,proc_metrics,proc_top_n,proc_top_sort)
     elif t["type"] == "ElasticsearchDataTable":
-        dt = ElasticsearchDataTable(refresh_minutes,es_index_pattern,es_query_body,es_field_map)
+        dt = ElasticsearchDataTable(refresh_minutes,es_index_pattern,es_query_body,es_field_map,es_connection,es_incremental,es_max_rows,es_page_size,es_batch_seconds,es_cache_seconds)
     elif t["type"] == "RemoteDataTable":
         dt = RemoteDataTable(ssh_spec,table_def,t["name"],refresh_minutes)
     elif t["type"] == "ODBCDataTable":
-        dt = ODBCDataTable(refresh_minutes,sql_spec,sql_query,sql_map)
+        dt = ODBCDataTable(refresh_minutes,sql_spec,sql_query,sql_map,sql_watermark,sql_max_rows,sql_batch_size,sql_aggregate)
     elif t["type"] == "CSVDataTable":
-        dt = CSVDataTable(refresh_minutes,csv_spec,csv_map,None)
+        dt = CSVDataTable(refresh_minutes,csv_spec,csv_map,None,file_hash,csv_tail,csv_max_rows)
     elif t["type"] == "JSONDataTable":
-        dt = JSONDataTable( json_spec )
+        dt = JSONDataTable( json_spec, file_hash )
     elif t["type"] == "LogDataTable":
-        dt = LogDataTable( log_glob, log_map, log_lookback, refresh_minutes)
+        dt = LogDataTable( log_glob, log_map, log_lookback, refresh_minutes, state_dir, checkpoint_minutes)
+    elif t["type"] == "CgroupDataTable":
+        dt = CgroupDataTable( cgroup_globs, num_hours, bucket_hours, refresh_minutes, sample_seconds, proc_stats, cgroup_root)
 
     dt.start_refresh()
     return dt
@@ -182,6 +245,11 @@ def load_config( stdscr, config_stream ):
             plugin_mod = load_plugin(p)
             context["plugins"].append( (p,plugin_mod) )
 
+    # log in to all the remote servers at once rather than one RemoteDataTable at a time
+    ssh_specs = [ t["ssh_spec"] for t in cf["tables"] if t["type"] == "RemoteDataTable" and "ssh_spec" in t ]
+    if ssh_specs:
+        get_connection_manager().connect_all(ssh_specs)
+
     context["tables"] = []
     for t in cf["tables"]:
         context["tables"].append((t["name"],load_table(t)))
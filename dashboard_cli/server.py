@@ -3,37 +3,274 @@ locale.setlocale(locale.LC_ALL,"")
 import sys
 import os
 import json
-import time
-from io import StringIO
-from data_sources.data_table import to_json,from_json
+import struct
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from data_sources.data_table import to_json,from_json,to_binary
+from data_sources.remote_data import protocol_versions,encode_delta,delta_json
 from dashboard_cli.config import load_table
+from data_sources.elastic_data import shutdown_es_clients
+from data_sources.odbc_data import shutdown_odbc_pools
+
+output_lock = threading.Lock()
+tables_lock = threading.Lock()
+# versions are unique across all the histories so a version from a table that was since reloaded is never mistaken for a current one
+table_versions = itertools.count(1)
+
+class TableHistory():
+    """ the most recent versions of a served table, used to answer get:<name>:<since_version> with only what changed since that version """
+    def __init__(self,depth=4):
+        """ keep snapshots of the last depth versions of the table """
+        self.version = 0
+        self.depth = depth
+        self.snapshots = []
+        self.history_lock = threading.Lock()
+
+    def delta(self,table,since):
+        """ snapshot the table, bumping the version if it changed, and return the delta from version since as a dict,
+        each column is either unchanged { "name" } or { "name", "evict" : k, "keep" : n, "append" : [ cells ] } meaning drop k rows from the front,
+        keep the next n and append the cells, if since is too old or unknown reset is set and every column is sent whole """
+        with table.refresh_lock:
+            columns = [ (c.get_name(),list(c.values)) for c in table.columns ]
+            name = table.name
+            refresh_minutes = table.refresh_minutes
+        snapshot = [ (cn,[ (c.type,c.value) for c in cells ]) for cn,cells in columns ]
+        with self.history_lock:
+            if not self.snapshots or self.snapshots[-1][1] != snapshot:
+                self.version = next(table_versions)
+                self.snapshots.append((self.version,snapshot))
+                del self.snapshots[:-self.depth]
+            version = self.version
+            old = dict(self.snapshots).get(since)
+
+        old_columns = dict(old) if old != None else {}
+        delta = { "version" : version, "name" : name, "refresh_minutes" : refresh_minutes, "reset" : old == None, "columns" : [] }
+        # rows are usually evicted from the front of every column at once, so the offset found for the first column is tried on all of them
+        table_evict = 0
+        if snapshot and snapshot[0][0] in old_columns:
+            table_evict = find_evict(old_columns[snapshot[0][0]],snapshot[0][1])
+        for (cn,cells),(_,new) in zip(columns,snapshot):
+            if cn not in old_columns:
+                delta["columns"].append({ "name" : cn, "evict" : 0, "keep" : 0, "append" : cells })
+                continue
+            old_values = old_columns[cn]
+            if old_values == new:
+                delta["columns"].append({ "name" : cn })
+                continue
+            evict = table_evict
+            keep = common_prefix(old_values,new,evict)
+            column_evict = find_evict(old_values,new)
+            if column_evict != evict and common_prefix(old_values,new,column_evict) > keep:
+                evict = column_evict
+                keep = common_prefix(old_values,new,evict)
+            delta["columns"].append({ "name" : cn, "evict" : evict, "keep" : keep, "append" : cells[keep:] })
+        return delta
+
+def find_evict( old, new ):
+    """ return the offset in old of the first row of new, the number of rows evicted from the front, 0 if it isn't there """
+    if new:
+        try:
+            return old.index(new[0])
+        except ValueError:
+            pass
+    return 0
+
+def common_prefix( old, new, evict ):
+    """ return the number of rows of old after the first evict that match the start of new """
+    keep = 0
+    limit = min(len(old)-evict,len(new))
+    while keep < limit and old[evict+keep] == new[keep]:
+        keep += 1
+    return keep
+
+histories = {}
+
+class Subscription():
+    """ a client's subscription to a table, each time the table changes the delta since the last version pushed is sent as a response to the subscribe request """
+    def __init__(self,request_id,table,history,since,protocol,compression,executor):
+        """ push deltas of table tracked in history starting from version since as responses to request_id, pushes run on executor so the table's refresh isn't held up """
+        self.request_id = request_id
+        self.table = table
+        self.history = history
+        self.version = since
+        self.protocol = protocol
+        self.compression = compression
+        self.executor = executor
+        self.pushed = False
+        self.push_lock = threading.Lock()
+
+    def changed(self,table):
+        """ listener registered on the table, called when a refresh completes """
+        self.executor.submit(self.push)
+
+    def push(self):
+        """ send the delta since the last version pushed, the first push is always sent so the client knows it is subscribed, later ones only if something changed """
+        with self.push_lock:
+            delta = self.history.delta(self.table,self.version)
+            if self.pushed and not delta["reset"] and all( "keep" not in c for c in delta["columns"] ):
+                return
+            self.version = delta["version"]
+            self.pushed = True
+            send_response(self.request_id,("delta",delta),self.protocol,self.compression)
+
+subscriptions = {}
+
+def table_history( tables, name ):
+    """ return the table called name and its history, creating the history the first time it is asked for """
+    with tables_lock:
+        return (tables[name],histories.setdefault(name,TableHistory()))
+
+def write_text( response, stream ):
+    """ write a response as text, tables are written as name:compact columnar json, several tables as many:{ name : compact columnar json, ... } and deltas as delta:json """
+    kind,value = response
+    if kind == "text":
+        stream.write(value)
+    elif kind == "delta":
+        stream.write("delta:%s"%delta_json(value))
+    elif kind == "table":
+        name,table = value
+        stream.write("%s:"%name)
+        to_json(table,stream,True)
+    else:
+        stream.write("many:{")
+        for idx in range(len(value)):
+            name,table = value[idx]
+            if idx:
+                stream.write(", ")
+            stream.write("%s: "%json.dumps(name))
+            to_json(table,stream,True)
+        stream.write("}")
+
+def send_response( request_id, response, protocol=1, compression="zlib" ):
+    """ write the response, a tuple (kind,value) where kind is text, table, tables or delta, to stdout,
+    protocol 1 writes a line, protocol 2 a line starting with the request id, protocol 3 a binary frame of request id, kind and length with tables and deltas in the binary columnar format """
+    with output_lock:
+        if protocol >= 3:
+            kind,value = response
+            if kind == "text":
+                payload = value.encode("utf-8")
+            elif kind == "delta":
+                payload = encode_delta(value,compression)
+            else:
+                payload = to_binary([value] if kind == "table" else value,compression)
+            sys.stdout.flush()
+            sys.stdout.buffer.write(struct.pack(">IBI",request_id,{ "text" : 0, "delta" : 2 }.get(kind,1),len(payload)))
+            sys.stdout.buffer.write(payload)
+            sys.stdout.buffer.flush()
+            return
+        if request_id != None:
+            sys.stdout.write("%d "%request_id)
+        write_text(response,sys.stdout)
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+
+def run_command( line, tables ):
+    """ run one command and return its response as a tuple (kind,value), kind is text with a string, table with a tuple (name,table), tables with a list of them or delta with a delta dict """
+    command,_,argument = line.strip().partition(":")
+    if command == "table":
+        td = json.loads(argument.strip())
+        table = load_table(td)
+        with tables_lock:
+            tables[td["name"]] = table
+            histories.pop(td["name"],None)
+        return ("text","loaded:%s"%(td["name"]))
+    elif command == "refresh":
+        with tables_lock:
+            table = tables[argument]
+        table.refresh()
+        return ("table",(argument,table))
+    elif command == "get":
+        if argument not in tables and argument.rsplit(":",1)[-1].isdigit():
+            name,since = argument.rsplit(":",1)
+            table,history = table_history(tables,name)
+            return ("delta",history.delta(table,int(since)))
+        with tables_lock:
+            table = tables[argument]
+        return ("table",(argument,table))
+    elif command == "unsubscribe":
+        with tables_lock:
+            subscription = subscriptions.pop(int(argument),None)
+        if subscription:
+            subscription.table.unlisten(subscription.changed)
+        return ("text","unsubscribed:%s"%argument)
+    elif command == "get_many":
+        names = json.loads(argument)
+        with tables_lock:
+            many = [(name,tables[name]) for name in names]
+        return ("tables",many)
+    raise Exception("Unknown command %s"%command)
+
+def subscribe( request_id, argument, tables, protocol, compression, executor ):
+    """ subscribe the request to pushes of the deltas of table since version for subscribe:<name>:<since_version>, the current delta is pushed right away """
+    name,since = argument.rsplit(":",1)
+    table,history = table_history(tables,name)
+    subscription = Subscription(request_id,table,history,int(since),protocol,compression,executor)
+    with tables_lock:
+        subscriptions[request_id] = subscription
+    table.listen(subscription.changed)
+    subscription.push()
+
+def run_framed( request_id, line, tables, protocol, compression, executor ):
+    """ run a command from the framed protocol and send its response, errors are sent back as error:message """
+    try:
+        if line.startswith("subscribe:"):
+            subscribe(request_id,line.strip().split(":",1)[1],tables,protocol,compression,executor)
+            return
+        response = run_command(line,tables)
+    except Exception as e:
+        response = ("text","error:%s"%(" ".join(str(e).split())))
+    send_response(request_id,response,protocol,compression)
 
 def server( options, args ):
     """ run as a data table server and respond to commands read from stdin """
     tables = {}
+    protocol = 1
+    compression = "zlib"
+    executor = None
     try:
         while True:
             line = sys.stdin.readline()
-            if line.startswith("table"):
-                command,json_blob = line.strip().split(":",1)
-                td = json.loads(json_blob.strip())
-                tables[td["name"]] = load_table(td)
-                print("loaded:%s"%(td["name"]))
-            elif line.startswith("refresh"):
-                command,name = line.strip().split(":",1)
-                tables[name].refresh()
-                table_json = StringIO()
-                to_json(tables[name],table_json)
-                print("%s:%s"%(name,table_json.getvalue()))
-            elif line.startswith("get"):
-                command,name = line.strip().split(":",1)
-                table_json = StringIO()
-                to_json(tables[name],table_json)
-                print("%s:%s"%(name,table_json.getvalue()))
-            elif line.startswith("exit"):
+            if not line:
+                break
+            request_id = None
+            if protocol >= 2:
+                request_id,_,command = line.partition(" ")
+                if not request_id.isdigit() or not command:
+                    # a line without a request id can't be answered, report it on id 0 which no request uses and carry on
+                    send_response(0,("text","error:bad framed request %s"%(" ".join(line.split())[:80])),protocol,compression)
+                    continue
+                request_id = int(request_id)
+                line = command
+            if line.startswith("exit"):
                 break
-            time.sleep(1)
+            elif line.startswith("protocol"):
+                fields = line.strip().split(":")
+                version = int(fields[1])
+                if len(fields) > 2 and fields[2] in ["none","zlib","lzma"]:
+                    compression = fields[2]
+                send_response(None,("text","protocol:%d"%(version if version in protocol_versions else 1)))
+                protocol = version if version in protocol_versions else 1
+                if protocol >= 2 and not executor:
+                    executor = ThreadPoolExecutor(max_workers=8)
+            elif executor:
+                executor.submit(run_framed,request_id,line,tables,protocol,compression,executor)
+            elif line.strip():
+                # blank lines are skipped as they always were, answering them would put the client a response ahead
+                try:
+                    response = run_command(line,tables)
+                except Exception as e:
+                    response = ("text","error:%s"%(" ".join(str(e).split())))
+                send_response(None,response)
     finally:
+        with tables_lock:
+            for subscription in subscriptions.values():
+                subscription.table.unlisten(subscription.changed)
+            subscriptions.clear()
+        if executor:
+            executor.shutdown(wait=True)
         for k in tables:
             tables[k].stop_refresh()
+        shutdown_es_clients()
+        shutdown_odbc_pools()
     return 0
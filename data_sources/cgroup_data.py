@@ -0,0 +1,150 @@
+# Copyright 2020 James P Goodwin data table package to manage sparse columnar data
+""" module that aggregates resource usage of cgroup v2 control groups ( containers, services ) and provides a set of data tables """
+import locale
+locale.setlocale(locale.LC_ALL,'')
+import os
+import glob
+import threading
+from data_sources.proc_data import SampledDataTable,ProcFile
+
+# the rate counters sampled for each cgroup, a cgroup's counters are named "<cgroup> <counter>"
+cgroup_counters = ["CPU Percent","CPU Throttled Percent","IO Read Bytes/Sec","IO Write Bytes/Sec","IO Read Ops/Sec","IO Write Ops/Sec"]
+
+class CgroupFiles():
+    """ the open cgroup v2 interface files for one cgroup, files for controllers that aren't enabled are skipped, the files are opened on the first read and again after close """
+    def __init__(self,path):
+        """ the cpu.stat, memory.current, memory.stat and io.stat files in the cgroup directory path """
+        self.path = path
+        self.files = {}
+        self.opened = False
+
+    def open(self):
+        """ open the files that exist in the cgroup directory """
+        for name in ["cpu.stat","memory.current","memory.stat","io.stat"]:
+            try:
+                self.files[name] = ProcFile(os.path.join(self.path,name))
+            except OSError:
+                pass
+        self.opened = True
+
+    def read(self,name):
+        """ return the contents of the file name or None if it isn't available """
+        if not self.opened:
+            self.open()
+        if name in self.files:
+            return self.files[name].read()
+        return None
+
+    def close(self):
+        """ close all the open files """
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.opened = False
+
+def parse_keyed( contents ):
+    """ parse the contents of a flat keyed file like cpu.stat or memory.stat into a dictionary of key to int value """
+    values = {}
+    for line in contents.split("\n"):
+        fields = line.split()
+        if len(fields) == 2:
+            values[fields[0]] = int(fields[1])
+    return values
+
+def parse_io_stat( contents ):
+    """ parse the contents of io.stat and return a tuple (rbytes,wbytes,rios,wios) summed over all the devices """
+    totals = {"rbytes":0,"wbytes":0,"rios":0,"wios":0}
+    for line in contents.split("\n"):
+        for field in line.split()[1:]:
+            key,_,value = field.partition("=")
+            if key in totals:
+                totals[key] += int(value)
+    return (totals["rbytes"],totals["wbytes"],totals["rios"],totals["wios"])
+
+class CgroupDataTable( SampledDataTable ):
+    """ class that collects a time based aggregation of the cpu, memory and io usage of a set of cgroup v2 control groups into a data_table """
+    def __init__(self,cgroup_globs=None,num_hours=24,bucket_hours=1,refresh_minutes=10,sample_seconds=0,cgroup_stats=None,cgroup_root="/sys/fs/cgroup"):
+        """ Initialize the CgroupDataTable with a list of globs relative to cgroup_root matching the cgroup directories to watch, a timespan to aggregate for,
+        aggregation bucket in hours, a refresh interval for updating in minutes, an interval in seconds to sample on independent of the refresh,
+        and a list of extra statistics from min,max,last to add columns for, the globs are re-expanded on each refresh to pick up new cgroups """
+        self.cgroup_globs = cgroup_globs if cgroup_globs else ["*"]
+        self.cgroup_root = cgroup_root
+        self.cgroups = {}
+        # held while the cgroup files are read or closed so a sample never reads a file that a refresh closed, or its descriptor reused by another open
+        self.files_lock = threading.Lock()
+        SampledDataTable.__init__(self,
+            "Cgroup Data: %s for the last %d hours in %d hour buckets, refreshed every %d minutes"%(
+            ",".join(self.cgroup_globs),
+            num_hours,
+            bucket_hours,
+            refresh_minutes),num_hours,bucket_hours,refresh_minutes,sample_seconds,cgroup_stats)
+        self.refresh()
+
+    def scan_cgroups( self ):
+        """ expand the cgroup globs and open the files for new cgroups, returns a dictionary of cgroup name to CgroupFiles, the files of cgroups that went away are closed by refresh """
+        cgroups = {}
+        for cg_glob in self.cgroup_globs:
+            for path in sorted(glob.glob(os.path.join(self.cgroup_root,cg_glob))):
+                if not os.path.isdir(path):
+                    continue
+                name = os.path.relpath(path,self.cgroup_root)
+                if name in cgroups:
+                    continue
+                if name in self.cgroups:
+                    cgroups[name] = self.cgroups[name]
+                else:
+                    cgroups[name] = CgroupFiles(path)
+        return cgroups
+
+    def sample_values( self ):
+        """ return a tuple (values,counters) of lists of tuples (column name, value) with the memory usage and the cpu and io counters of each cgroup """
+        values = []
+        counters = []
+        samples = []
+        with self.files_lock:
+            for name,cg_files in self.cgroups.items():
+                try:
+                    samples.append((name,cg_files.read("cpu.stat"),cg_files.read("memory.current"),cg_files.read("memory.stat"),cg_files.read("io.stat")))
+                except (OSError,TypeError,ValueError):
+                    # the cgroup was removed, it is dropped on the next scan
+                    continue
+
+        for name,cpu_stat,memory_current,memory_stat,io_stat in samples:
+            if cpu_stat != None:
+                cpu = parse_keyed(cpu_stat)
+                # counters in hundredths of a second so the rate is a percent of one cpu
+                counters.append(("%s CPU Percent"%name,cpu.get("usage_usec",0)/10000.0))
+                counters.append(("%s CPU Throttled Percent"%name,cpu.get("throttled_usec",0)/10000.0))
+            if memory_current != None:
+                values.append(("%s Memory Current"%name,int(memory_current.strip() or 0)))
+            if memory_stat != None:
+                memory = parse_keyed(memory_stat)
+                values.append(("%s Memory Anon"%name,memory.get("anon",0)))
+                values.append(("%s Memory File"%name,memory.get("file",0)))
+            if io_stat != None:
+                rbytes,wbytes,rios,wios = parse_io_stat(io_stat)
+                counters.append(("%s IO Read Bytes/Sec"%name,rbytes))
+                counters.append(("%s IO Write Bytes/Sec"%name,wbytes))
+                counters.append(("%s IO Read Ops/Sec"%name,rios))
+                counters.append(("%s IO Write Ops/Sec"%name,wios))
+        return (values,counters)
+
+    def refresh( self ):
+        """ refresh the table, rescans the cgroup globs, closes the files and drops the rate counters of cgroups that went away and takes a sample if there is no sample thread running """
+        cgroups = self.scan_cgroups()
+        with self.refresh_lock, self.files_lock:
+            removed = [ self.cgroups[name] for name in self.cgroups if name not in cgroups ]
+            self.cgroups = cgroups
+            for cg_files in removed:
+                cg_files.close()
+            counters = set( "%s %s"%(name,counter) for name in cgroups for counter in cgroup_counters )
+            for cn in [ cn for cn in self.rate_counters if cn not in counters ]:
+                del self.rate_counters[cn]
+        SampledDataTable.refresh(self)
+
+    def stop_refresh( self ):
+        """ Stop the refresh and sample threads and close the files of all the cgroups, they are opened again if sampling starts again """
+        SampledDataTable.stop_refresh(self)
+        with self.files_lock:
+            for cg_files in self.cgroups.values():
+                cg_files.close()
@@ -7,32 +7,127 @@ import os
 import glob
 import gzip
 import re
+import csv
 import keyring
+from io import StringIO
 from datetime import datetime,timedelta
-from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized,from_csv
+from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized,from_csv,FileWatch
 
 
+# number of bytes at the start and end of the data already read that are compared to detect a rewritten file in tail mode
+tail_mark_bytes = 256
+
+def complete_records( data ):
+    """ return the length of the prefix of data, a block of newline terminated lines, that holds only complete csv records,
+    a record with a quoted field that continues past the end of data is left for the next refresh """
+    state = { "consumed" : 0, "exhausted" : False }
+    def lines():
+        for line in data.split(b"\n")[:-1]:
+            state["consumed"] += len(line)+1
+            yield line.decode("utf-8")+"\n"
+        state["exhausted"] = True
+    complete = 0
+    for row in csv.reader(lines()):
+        # a complete record never needs to look past its last line, so one returned after the lines ran out was cut off
+        if state["exhausted"]:
+            break
+        complete = state["consumed"]
+    return complete
+
 class CSVDataTable( DataTable ):
     """ class that collects data from a CSV file on disk and extracts columns based on a column map of  the form [[CSV_column_name, DataTable_column_name,DataTable_type (one of _string,_int,_float,_date )],...] """
-    def __init__(self, refresh_minutes=1, csv_spec = None, csv_map= None, csv_name= None ):
-        """ Initialize the CSVDataTable object from the file named in csv_spec and extract the columns in the provided csv_map, name the table based on the name provided or extracted from the CSV """
+    def __init__(self, refresh_minutes=1, csv_spec = None, csv_map= None, csv_name= None, file_hash = False, csv_tail = False, csv_max_rows = None ):
+        """ Initialize the CSVDataTable object from the file named in csv_spec and extract the columns in the provided csv_map, name the table based on the name provided or extracted from the CSV,
+        the file is only reloaded when it changes, if file_hash is True a hash of the contents is also compared,
+        if csv_tail is True the file is treated as append only and only the complete records added since the last refresh are parsed and appended,
+        the whole file is reloaded if it is truncated or rewritten, optionally keep only the last csv_max_rows rows """
         self.csv_spec = csv_spec
         self.csv_map = csv_map
         self.csv_name = csv_name
+        self.csv_tail = csv_tail
+        self.csv_max_rows = csv_max_rows
+        self.tail_offset = 0
+        self.tail_header = None
+        self.tail_start = b""
+        self.tail_end = b""
+        self.file_watch = FileWatch(csv_spec,file_hash and not csv_tail)
         DataTable.__init__(self,None,(csv_name if csv_name else None),refresh_minutes)
         self.refresh()
 
     @synchronized
     def refresh( self ):
-        """ refresh the table by opening the csv file and loading it into a table """
-        dt = from_csv(open(self.csv_spec,"r"),self.name,self.csv_map)
-        if dt:
-            rows,cols = dt.get_bounds()
-            for idx in range(cols):
-                self.replace_column(idx,dt.get_column(idx))
+        """ refresh the table by opening the csv file and loading it into a table, does nothing if the file hasn't changed """
+        signature = self.file_watch.check()
+        if not signature:
+            return
+        reset = False
+        if self.csv_tail:
+            dt,reset = self.read_tail(signature)
+        else:
+            with open(self.csv_spec,"r") as csv_file:
+                dt = from_csv(csv_file,self.name,self.csv_map)
+        self.file_watch.update(signature)
+        if dt or reset:
+            if dt:
+                rows,cols = dt.get_bounds()
+                for idx in range(cols):
+                    self.replace_column(idx,dt.get_column(idx))
 
-            if dt.get_name():
-                self.name = dt.get_name()
+                if dt.get_name():
+                    self.name = dt.get_name()
 
             self.changed()
             DataTable.refresh(self)
+
+    def tail_rewritten( self, csv_file, signature, header ):
+        """ return True if the file was replaced, truncated or rewritten since the last refresh, besides the inode, size and header
+        the bytes at the start of the data and just before the tail offset that were already read are compared """
+        last_signature = self.file_watch.signature
+        if (not last_signature or last_signature[0][2] != signature[0][2] or
+            signature[0][1] < self.tail_offset or header != self.tail_header or not header.endswith(b"\n")):
+            return True
+        csv_file.seek(len(header))
+        if csv_file.read(len(self.tail_start)) != self.tail_start:
+            return True
+        csv_file.seek(self.tail_offset-len(self.tail_end))
+        return csv_file.read(len(self.tail_end)) != self.tail_end
+
+    def read_tail( self, signature ):
+        """ parse the records appended since the last refresh and return a tuple (table,reset) where table has the current columns with the new rows appended
+        or is None if there are no new complete records, reset is True if the table was emptied because the file was replaced, truncated or rewritten """
+        reset = False
+        with open(self.csv_spec,"rb") as csv_file:
+            header = csv_file.readline()
+            if not self.tail_offset or self.tail_rewritten(csv_file,signature,header):
+                reset = bool(self.tail_offset) or any(c.size() for c in self.columns)
+                self.tail_header = header
+                self.tail_offset = len(header)
+                self.tail_start = b""
+                self.tail_end = b""
+                for idx in range(len(self.columns)):
+                    self.replace_column(idx,Column(name=self.columns[idx].get_name()))
+            csv_file.seek(self.tail_offset)
+            data = csv_file.read()
+
+        end = data.rfind(b"\n")+1
+        if end and b'"' in data[:end]:
+            end = complete_records(data[:end])
+        if not end:
+            return (None,reset)
+        self.tail_offset += end
+        if len(self.tail_start) < tail_mark_bytes:
+            self.tail_start = (self.tail_start+data[:end])[:tail_mark_bytes]
+        self.tail_end = (self.tail_end+data[:end])[-tail_mark_bytes:]
+
+        new_rows = from_csv(StringIO((self.tail_header+data[:end]).decode("utf-8")),self.name,self.csv_map)
+        if not new_rows:
+            return (None,reset)
+        for c in new_rows.columns:
+            if self.has_column(c.get_name()):
+                values = self.get_column(c.get_name()).values + c.values
+            else:
+                values = c.values
+            if self.csv_max_rows and len(values) > self.csv_max_rows:
+                values = values[-self.csv_max_rows:]
+            c.values = values
+        return (new_rows,reset)
@@ -8,6 +8,13 @@ import threading
 import time
 import csv
 import json
+import hashlib
+import operator
+import array
+import struct
+import zlib
+import lzma
+import tempfile
 from functools import wraps
 
 string_type = '_string'
@@ -179,131 +186,336 @@ def synchronized(method):
 #           },
 #           ]
 #   }
+#   compact columnar format of data table as json written by to_json(dt,stream,True)
+#   {
+#       "name" : name of the table,
+#       "refresh_minutes" : refresh interval in minutes,
+#       "format" : "columnar",
+#       "columns" : [ array of column structures
+#           {
+#           "name": column name
+#           "type" : type of the values one of "_string","_float","_int","_date", or "types" : [ array of types one per value ] if the column has mixed types
+#           "values" : [ array of string, float, int, float for date, or null for blank ]
+#           },
+#           ]
+#   }
+
+def json_cell( ct, cv ):
+    """ return a Cell for the type ct and the json value cv """
+    if ct == string_type:
+        return Cell(string_type,cv,format_string)
+    elif ct == float_type:
+        return Cell(float_type,cv,format_float)
+    elif ct == int_type:
+        return Cell(int_type,cv,format_float)
+    elif ct == date_type:
+        return Cell(date_type,datetime.fromtimestamp(cv),format_date)
+    return blank_cell
+
 def from_json( stream ):
-    """ load a DataTable from a stream as JSON, return new DataTable """
-    jtable = json.load(stream)
+    """ load a DataTable from a stream as JSON in either the standard or compact columnar format, return new DataTable """
+    return from_dict(json.load(stream))
+
+def from_dict( jtable ):
+    """ create a DataTable from a table that was already loaded from JSON, return new DataTable """
     dt = DataTable(None,jtable.get("name","JSON DataTable"),jtable.get("refresh_minutes",1))
+    columnar = jtable.get("format") == "columnar"
     for c in jtable["columns"]:
-        nc = Column( name = c.get("name", None) )
-        for v in c["values"]:
-            ct = v["type"]
-            cv = v["value"]
-            if ct == string_type:
-                cc = Cell(string_type,cv,format_string)
-            elif ct == float_type:
-                cc = Cell(float_type,cv,format_float)
-            elif ct == int_type:
-                cc = Cell(int_type,cv,format_float)
-            elif ct == date_type:
-                cc = Cell(date_type,datetime.fromtimestamp(cv),format_date)
-            elif ct == blank_type:
-                cc = blank_cell
-            nc.put(nc.size(),cc)
-        dt.add_column( nc )
+        if columnar:
+            cells = from_columnar(c)
+        else:
+            cells = [ json_cell(v["type"],v["value"]) for v in c["values"] ]
+        dt.add_column( Column( values = cells, name = c.get("name", None) ) )
     return dt
 
-def to_json( dt, stream ):
-    """ write a DataTable to a stream as JSON """
-    out_dict = {}
-    if dt.name:
-        out_dict["name"] = dt.name
-
-    out_dict["refresh_minutes"] = dt.refresh_minutes
-
-    columns  = []
-    for idx in range(len(dt.columns)):
-        dtc = dt.columns[idx]
+def to_columnar( cells ):
+    """ return a dict with the compact columnar json encoding of a list of cells, { "type" : type, "values" : [ values ] } or { "types" : [ types ], "values" : [ values ] } if the types are mixed """
+    ct = blank_type
+    for v in cells:
+        if v.type != blank_type:
+            ct = v.type
+            break
+    column = {}
+    if all( v.type == ct or v.type == blank_type for v in cells ):
+        column["type"] = ct
+    else:
+        column["types"] = [ v.type for v in cells ]
+    column["values"] = [ ( None if v.type == blank_type else ( v.value if v.type != date_type else v.get_float_value() ) ) for v in cells ]
+    return column
+
+def from_columnar( column ):
+    """ return the list of cells encoded in a compact columnar json dict written by to_columnar """
+    values = column["values"]
+    types = column.get("types") or [ (column.get("type",blank_type) if v != None else blank_type) for v in values ]
+    return [ json_cell(ct,cv) for ct,cv in zip(types,values) ]
+
+def column_type( column ):
+    """ return the type of the first cell in the column that isn't blank or blank_type if they all are """
+    for cell in column.values:
+        if cell.type != blank_type:
+            return cell.type
+    return blank_type
+
+def to_json( dt, stream, columnar=False ):
+    """ write a DataTable to a stream as JSON one column at a time so only one column is ever converted in memory, if columnar is True write the compact columnar format,
+    the columns are copied under the table's lock and written outside it so a slow stream doesn't hold up the table's refresh """
+    name,refresh_minutes,columns = snapshot_columns(dt)
+    header = {}
+    if name:
+        header["name"] = name
+    header["refresh_minutes"] = refresh_minutes
+    if columnar:
+        header["format"] = "columnar"
+    stream.write(json.dumps(header)[:-1]+', "columns": [')
+
+    for idx in range(len(columns)):
+        cname,values = columns[idx]
         column = {}
-        if dtc.name:
-            column["name"] = dtc.name
-
-        values = []
-        for dtv in dtc.values:
-            values.append( { "type":dtv.type, "value": ( dtv.value if dtv.type != date_type else dtv.get_float_value() ) } )
-        column["values"] = values
-        columns.append(column)
-
-    out_dict["columns"] = columns
-    json.dump(out_dict,stream)
+        if cname:
+            column["name"] = cname
+        if columnar:
+            column.update(to_columnar(values))
+        else:
+            column["values"] = [ { "type":v.type, "value": ( v.value if v.type != date_type else v.get_float_value() ) } for v in values ]
+        if idx:
+            stream.write(", ")
+        json.dump(column,stream)
+    stream.write("]}")
+
+def snapshot_columns( dt ):
+    """ return a tuple (name,refresh_minutes,[(column name,list of cells),...]) with a copy of the table's column lists taken under its lock """
+    with dt.refresh_lock:
+        return (dt.name,dt.refresh_minutes,[ (c.name,list(c.values)) for c in dt.columns ])
+
+#   binary columnar format of a list of data tables written by to_binary(tables,compression)
+#   one byte compression codec 0 none, 1 zlib, 2 lzma followed by the compressed body
+#   body is a 4 byte big endian length and a json header of the form
+#   { "tables" : [ { "key" : name the table was requested by, "name" : table name, "refresh_minutes" : refresh interval in minutes,
+#                    "columns" : [ { "name" : column name, "encoding" : one of "int","float","date","json", "blanks" : [ indexes of blank cells ] } ] } ] }
+#   followed by one block per column in order, each a 4 byte big endian length and the data,
+#   int, float and date blocks are little endian arrays of 64 bit ints, doubles and timestamps, blanks hold 0,
+#   json blocks are compact columnar json { "types" : [ type per value ], "values" : [ value per value ] } for strings and mixed columns
+
+binary_codecs = { "none" : 0, "zlib" : 1, "lzma" : 2 }
+binary_typecodes = { "int" : "q", "float" : "d", "date" : "d" }
+
+def encode_column( column ):
+    """ return a tuple (header,block) with the binary encoding of a column, columns whose values don't fit the array type, like an int column holding floats, fall back to json """
+    ct = column_type(column)
+    blanks = [ idx for idx in range(len(column.values)) if column.values[idx].type == blank_type ]
+    encoding = { int_type : "int", float_type : "float", date_type : "date" }.get(ct,"json")
+    if encoding != "json" and len(blanks)+sum(1 for v in column.values if v.type == ct) != len(column.values):
+        encoding = "json"
+    if encoding != "json":
+        if encoding == "date":
+            values = [ ( v.get_float_value() if v.type != blank_type else 0 ) for v in column.values ]
+        else:
+            values = [ ( v.value if v.type != blank_type else 0 ) for v in column.values ]
+        try:
+            data = array.array(binary_typecodes[encoding],values)
+        except (OverflowError,TypeError,ValueError):
+            encoding = "json"
+    if encoding == "json":
+        values = [ ( None if v.type == blank_type else ( v.value if v.type != date_type else v.get_float_value() ) ) for v in column.values ]
+        return ({ "name" : column.name, "encoding" : "json", "blanks" : [] },json.dumps({ "types" : [ v.type for v in column.values ], "values" : values }).encode("utf-8"))
+    if sys.byteorder != "little":
+        data.byteswap()
+    return ({ "name" : column.name, "encoding" : encoding, "blanks" : blanks },data.tobytes())
+
+def decode_column( header, block ):
+    """ return a Column decoded from its header and binary block """
+    encoding = header["encoding"]
+    if encoding == "json":
+        jcolumn = json.loads(block.decode("utf-8"))
+        return Column( values = [ json_cell(ct,cv) for ct,cv in zip(jcolumn["types"],jcolumn["values"]) ], name = header["name"] )
+    data = array.array(binary_typecodes[encoding])
+    data.frombytes(block)
+    if sys.byteorder != "little":
+        data.byteswap()
+    values = data.tolist()
+    if encoding == "int":
+        cells = [ Cell(int_type,v,format_float) for v in values ]
+    elif encoding == "float":
+        cells = [ Cell(float_type,v,format_float) for v in values ]
+    else:
+        fromtimestamp = datetime.fromtimestamp
+        cells = [ Cell(date_type,fromtimestamp(v),format_date) for v in values ]
+    for idx in header["blanks"]:
+        cells[idx] = blank_cell
+    return Column( values = cells, name = header["name"] )
+
+def to_binary( tables, compression="zlib" ):
+    """ return bytes with the binary columnar encoding of tables, a list of tuples (key,DataTable), compressed with compression one of none, zlib or lzma """
+    headers = []
+    blocks = []
+    for key,dt in tables:
+        with dt.refresh_lock:
+            columns = []
+            for c in dt.columns:
+                header,block = encode_column(c)
+                columns.append(header)
+                blocks.append(struct.pack(">I",len(block)))
+                blocks.append(block)
+            headers.append({ "key" : key, "name" : dt.name, "refresh_minutes" : dt.refresh_minutes, "columns" : columns })
+    header = json.dumps({ "tables" : headers }).encode("utf-8")
+    body = b"".join([struct.pack(">I",len(header)),header]+blocks)
+    if compression == "zlib":
+        body = zlib.compress(body)
+    elif compression == "lzma":
+        body = lzma.compress(body)
+    return bytes([binary_codecs[compression]])+body
+
+def from_binary( payload ):
+    """ decode bytes written by to_binary and return a list of tuples (key,DataTable) """
+    codec = payload[0]
+    body = payload[1:]
+    if codec == binary_codecs["zlib"]:
+        body = zlib.decompress(body)
+    elif codec == binary_codecs["lzma"]:
+        body = lzma.decompress(body)
+    offset = 4+struct.unpack_from(">I",body,0)[0]
+    header = json.loads(body[4:offset].decode("utf-8"))
+    tables = []
+    for theader in header["tables"]:
+        dt = DataTable(None,theader["name"],theader["refresh_minutes"])
+        for cheader in theader["columns"]:
+            length = struct.unpack_from(">I",body,offset)[0]
+            offset += 4
+            dt.add_column(decode_column(cheader,body[offset:offset+length]))
+            offset += length
+        tables.append((theader["key"],dt))
+    return tables
 
 # csv representation of a DataTable
 # heading row at the top
 # each column of the form: table name_column name_type names cannot contain '_" and
 # types will be used to load cells can't have mixed cell types in a column
+def csv_strings( values ):
+    return [ Cell(string_type,v,format_string) if v else blank_cell for v in values ]
+
+def csv_floats( values ):
+    return [ Cell(float_type,float(v),format_float) if v else blank_cell for v in values ]
+
+def csv_ints( values ):
+    return [ Cell(int_type,int(v),format_float) if v else blank_cell for v in values ]
+
+def csv_date( value ):
+    if not value:
+        return blank_cell
+    try:
+        return Cell(date_type,datetime.fromtimestamp(float(value)),format_date)
+    except:
+        return Cell(date_type,parser.parse(value),format_date)
+
+def csv_dates( values ):
+    return [ csv_date(v) for v in values ]
+
+def csv_blanks( values ):
+    return [ blank_cell ]*len(values)
+
+# converters from a column of csv strings to a list of cells for each type
+csv_converters = { string_type : csv_strings, float_type : csv_floats, int_type : csv_ints, date_type : csv_dates, blank_type : csv_blanks }
+
 def from_csv( stream, name=None, field_map=None ):
     """ load a DataTable from a stream as CSV, return new DataTable, you can provide an override to the default parsing to provide a name and a field_map which is a list of tuples CSV_column_name,DataTable_column_name,DataTable_type it will only load columns in the column map """
-    dt = None
-    dr = csv.DictReader(stream)
-    for drr in dr:
-        for drc in drr:
+    reader = csv.reader(stream)
+    header = next(reader,None)
+    if not header:
+        return None
+
+    # map the header once to a list of (position,column name,converter), unmapped fields are never looked at
+    field_types = {}
+    if field_map:
+        for fm in reversed(field_map):
+            field_types[fm[0]] = (fm[1],fm[2])
+    mapping = []
+    column_names = set()
+    for pos,drc in enumerate(header):
+        if field_map:
+            dtc,dtt = field_types.get(drc,(None,None))
+        else:
             parts = drc.split("_",2)
-            if not dt:
-                if name:
-                    dt = DataTable(name=name)
-                elif not field_map and len(parts) == 3:
-                    dt = DataTable(name=parts[0])
-                else:
-                    dt = DataTable()
-
-            dtc = None
-            dtt = None
-            if field_map:
-                for fm in field_map:
-                    if drc == fm[0]:
-                        dtc = fm[1]
-                        dtt = fm[2]
-                        break
-            else:
-                if len(parts) == 3:
-                    dtc = parts[1]
-                    dtt = "_"+parts[2]
-
-            if dtc and dtt:
-                if not dt.has_column(dtc):
-                    dt.add_column(Column(name=dtc))
-                dtcc = dt.get_column(dtc)
-
-                drv = drr[drc]
-                if drv and dtt == string_type:
-                    cc = Cell(string_type,drv,format_string)
-                elif drv and dtt == float_type:
-                    cc = Cell(float_type,float(drv),format_float)
-                elif drv and dtt == int_type:
-                    cc = Cell(int_type,int(drv),format_float)
-                elif drv and dtt == date_type:
-                    try:
-                        cc = Cell(date_type,datetime.fromtimestamp(float(drv)),format_date)
-                    except:
-                        cc = Cell(date_type,parser.parse(drv),format_date)
-                elif not drv or dtt == blank_type:
-                    cc = blank_cell
-                dtcc.put(dtcc.size(),cc)
+            dtc,dtt = (parts[1],"_"+parts[2]) if len(parts) == 3 else (None,None)
+        if dtc and dtt and dtc not in column_names:
+            column_names.add(dtc)
+            mapping.append((pos,dtc,csv_converters.get(dtt,csv_blanks)))
+
+    positions = [pos for pos,dtc,convert in mapping]
+    width = max(positions)+1 if positions else 0
+    project = operator.itemgetter(*positions) if len(positions) > 1 else (lambda row: tuple(row[pos] for pos in positions))
+    rows = []
+    for row in reader:
+        if not row:
+            continue
+        if len(row) < width:
+            row = row + [""]*(width-len(row))
+        rows.append(project(row))
+    if not rows:
+        return None
+
+    if name:
+        dt = DataTable(name=name)
+    elif not field_map and len(header[0].split("_",2)) == 3:
+        dt = DataTable(name=header[0].split("_",2)[0])
+    else:
+        dt = DataTable()
+
+    columns = list(zip(*rows)) if positions else []
+    for idx,(pos,dtc,convert) in enumerate(mapping):
+        dt.add_column(Column(values=convert(columns[idx]),name=dtc))
     return dt
 
 def to_csv( dt, stream ):
-    """ write a DataTable to a stream as CSV, see standard format in comments above, type for column is based on the zeroth cell """
+    """ write a DataTable to a stream as CSV one row at a time, see standard format in comments above, type for column is based on the first non blank cell,
+    the columns are copied under the table's lock and written outside it """
+    name,refresh_minutes,columns = snapshot_columns(dt)
     field_names = []
-    idx = 0
     max_idx = 0
-    for c in dt.columns:
-        type = blank_type
-        for tidx in range(c.size()):
-            if c.get(tidx).type != blank_type:
-                type = c.get(tidx).type
-                break
-        field_names.append((dt.name if dt.name else "DataTable")+"_"+(c.name if c.name else "Column %d"%idx)+type)
-        idx += 1
-        if c.size() > max_idx:
-            max_idx = c.size()
-    wcsv = csv.DictWriter(stream,field_names)
+    for idx in range(len(columns)):
+        cname,values = columns[idx]
+        field_names.append((name if name else "DataTable")+"_"+(cname if cname else "Column %d"%idx)+column_type(Column(values=values)))
+        if len(values) > max_idx:
+            max_idx = len(values)
+    if not max_idx:
+        return
+    wcsv = csv.writer(stream)
+    wcsv.writerow(field_names)
     for wcridx in range(max_idx):
-        wcr = {}
-        for idx in range(len(dt.columns)):
-            cell = dt.columns[idx].get(wcridx)
-            wcr[field_names[idx]] = (cell.get_value() if cell.type != date_type else cell.get_float_value())
-        if wcridx == 0:
-            wcsv.writeheader()
-        wcsv.writerow(wcr)
+        row = []
+        for cname,values in columns:
+            cell = values[wcridx] if wcridx < len(values) else blank_cell
+            row.append(cell.value if cell.type != date_type else cell.get_float_value())
+        wcsv.writerow(row)
+
+class FileWatch(object):
+    """ detects changes to a file from its modification time, size and inode and optionally a hash of its contents """
+    def __init__(self,path,hash_contents=False):
+        """ watch the file at path, if hash_contents is True a file whose stat changed but whose contents are the same is treated as unchanged """
+        self.path = path
+        self.hash_contents = hash_contents
+        self.signature = None
+
+    def check(self):
+        """ return None if the file hasn't changed since the last update() otherwise return the new signature to pass to update() once the file has been loaded """
+        st = os.stat(self.path)
+        stat = (st.st_mtime_ns,st.st_size,st.st_ino)
+        if self.signature and self.signature[0] == stat:
+            return None
+        digest = None
+        if self.hash_contents:
+            sha1 = hashlib.sha1()
+            with open(self.path,"rb") as f:
+                for block in iter(lambda: f.read(65536),b""):
+                    sha1.update(block)
+            digest = sha1.hexdigest()
+            if self.signature and self.signature[1] == digest:
+                self.signature = (stat,digest)
+                return None
+        return (stat,digest)
+
+    def update(self,signature):
+        """ record the signature returned by check() after the file was loaded """
+        self.signature = signature
 
 class DataTable(object):
     def __init__(self,columns=None,name=None,refresh_minutes=10):
@@ -317,6 +529,8 @@ class DataTable(object):
         self.refresh_thread = None
         self.refresh_thread_stop = False
         self.refresh_timestamp = None
+        self.checkpoint_path = None
+        self.checkpoint_minutes = 5
         if columns:
             for c in columns:
                 self.add_column(c)
@@ -342,20 +556,74 @@ class DataTable(object):
     def perform_refresh( self ):
         """ Thread worker that sleeps and refreshes the data on a schedule """
         start_time = time.time()
+        checkpoint_time = time.time()
         while not self.refresh_thread_stop:
             if time.time() - start_time >= self.refresh_minutes*60.0:
                 self.refresh()
                 start_time = time.time()
+            if self.checkpoint_path and time.time() - checkpoint_time >= self.checkpoint_minutes*60.0:
+                self.save_checkpoint()
+                checkpoint_time = time.time()
             time.sleep(1)
 
     def stop_refresh( self ):
-        """ Stop the background refresh thread """
+        """ Stop the background refresh thread, saves a checkpoint if the thread was running """
         self.refresh_thread_stop = True
         if self.refresh_thread and self.refresh_thread.is_alive():
             self.refresh_thread.join()
+            self.save_checkpoint()
         self.refresh_thread = None
         self.refresh_thread_stop = False
 
+    def set_checkpoint( self, state_dir, key, checkpoint_minutes=5 ):
+        """ enable checkpointing of this table's state to a file in state_dir, key is a string identifying the table's configuration, the checkpoint is written every checkpoint_minutes and when the refresh thread is stopped """
+        state_dir = os.path.expanduser(state_dir)
+        os.makedirs(state_dir,exist_ok=True)
+        self.checkpoint_path = os.path.join(state_dir,"%s_%s.json"%(self.__class__.__name__,hashlib.sha1(key.encode("utf-8")).hexdigest()))
+        self.checkpoint_minutes = checkpoint_minutes
+
+    def get_checkpoint( self ):
+        """ return a json serializable snapshot of this table's state, base class has nothing to save """
+        return None
+
+    def put_checkpoint( self, checkpoint ):
+        """ restore this table's state from a snapshot returned by get_checkpoint """
+        pass
+
+    def save_checkpoint( self ):
+        """ atomically write the current checkpoint to the checkpoint file, if checkpointing is enabled """
+        if not self.checkpoint_path:
+            return
+        with self.refresh_lock:
+            checkpoint = self.get_checkpoint()
+        if checkpoint == None:
+            return
+        state_dir = os.path.dirname(self.checkpoint_path)
+        fd,temp_path = tempfile.mkstemp(dir=state_dir,prefix=".checkpoint_")
+        try:
+            with os.fdopen(fd,"w") as temp_file:
+                json.dump(checkpoint,temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path,self.checkpoint_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def load_checkpoint( self ):
+        """ load the checkpoint file if there is one and restore the table's state from it, returns True if state was restored """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return False
+        try:
+            with open(self.checkpoint_path,"r") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            with self.refresh_lock:
+                self.put_checkpoint(checkpoint)
+            return True
+        except (OSError,ValueError,KeyError,TypeError):
+            return False
+
     def listen(self,listen_func):
         """ register for notifications when a change event is raised on this table """
         self.listeners.append(listen_func)
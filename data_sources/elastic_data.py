@@ -7,16 +7,234 @@ import os
 import glob
 import gzip
 import re
+import json
+import threading
+import copy
+import time
 from elasticsearch import Elasticsearch
 from datetime import datetime,timedelta
-from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
+from data_sources.data_table import DataTable,Column,Cell,blank_cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
+
+_es_clients = {}
+_es_clients_lock = threading.RLock()
+def get_es_client( es_connection=None ):
+    """ return the process wide Elasticsearch client for the connection parameters in es_connection creating it if needed, clients and their connection pools are shared by all the tables with the same parameters """
+    key = json.dumps(es_connection,sort_keys=True) if es_connection else ""
+    with _es_clients_lock:
+        if key not in _es_clients:
+            _es_clients[key] = Elasticsearch(**(es_connection if es_connection else {}))
+        return _es_clients[key]
+
+class ESSearchBatch():
+    """ a set of searches collected during one batch window, identical searches share one entry """
+    def __init__(self):
+        self.searches = {}
+        self.results = {}
+        self.done = threading.Event()
+
+class ESMultiSearch():
+    """ batches the searches from all the tables using one Elasticsearch client into single _msearch requests and caches the responses for a short time """
+    def __init__(self, es_connection=None):
+        """ Initialize with the connection parameters for the client to send the batches with """
+        self.es_connection = es_connection
+        self.lock = threading.Lock()
+        self.batch = None
+        self.cache = {}
+        self.cache_seconds = 0
+
+    def search( self, index, body, batch_seconds, cache_seconds=0 ):
+        """ return the response to searching index with body, a response cached less than cache_seconds ago is reused,
+        otherwise the search joins the current batch, the first search in a batch waits batch_seconds for others to join and then sends the batch """
+        key = json.dumps([index,body],sort_keys=True,default=str)
+        leader = False
+        with self.lock:
+            now = time.time()
+            self.cache_seconds = max(self.cache_seconds,cache_seconds)
+            if cache_seconds and key in self.cache and now - self.cache[key][0] < cache_seconds:
+                return self.cache[key][1]
+            if not self.batch:
+                self.batch = ESSearchBatch()
+                leader = True
+            batch = self.batch
+            batch.searches[key] = (index,body)
+
+        if leader:
+            try:
+                time.sleep(batch_seconds)
+                with self.lock:
+                    self.batch = None
+                self.send_batch(batch)
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        result = batch.results.get(key)
+        if isinstance(result,Exception):
+            raise result
+        return result
+
+    def send_batch( self, batch ):
+        """ send the searches in the batch as one _msearch and store each response or error in the batch results """
+        keys = list(batch.searches.keys())
+        searches = []
+        for key in keys:
+            index,body = batch.searches[key]
+            searches.append({ "index" : index } if index else {})
+            searches.append(body if body else {})
+        try:
+            responses = response_body(get_es_client(self.es_connection).msearch(body=searches))["responses"]
+        except Exception as e:
+            for key in keys:
+                batch.results[key] = e
+            return
+
+        now = time.time()
+        with self.lock:
+            self.cache = { k : v for k,v in self.cache.items() if now - v[0] < self.cache_seconds }
+            for key,response in zip(keys,responses):
+                if "error" in response:
+                    batch.results[key] = Exception("Elasticsearch search failed",response["error"])
+                else:
+                    batch.results[key] = response
+                    if self.cache_seconds:
+                        self.cache[key] = (now,response)
+
+_es_batchers = {}
+def get_es_batcher( es_connection=None ):
+    """ return the process wide ESMultiSearch for the connection parameters in es_connection creating it if needed """
+    key = json.dumps(es_connection,sort_keys=True) if es_connection else ""
+    with _es_clients_lock:
+        if key not in _es_batchers:
+            _es_batchers[key] = ESMultiSearch(es_connection)
+        return _es_batchers[key]
+
+def shutdown_es_clients():
+    """ close all the Elasticsearch clients that were created and their connection pools """
+    global _es_clients, _es_batchers
+    with _es_clients_lock:
+        for key in _es_clients:
+            _es_clients[key].close()
+        _es_clients = {}
+        _es_batchers = {}
+
+def convert_date( value ):
+    return Cell(date_type,datetime.fromtimestamp(value/1000),format_date)
+
+def convert_int( value ):
+    return Cell(int_type,value,format_int)
+
+def convert_float( value ):
+    return Cell(float_type,value,format_float)
+
+def convert_str( value ):
+    return Cell(string_type,value,format_string)
+
+def convert_other( value ):
+    return Cell(string_type,str(value),format_string)
+
+field_converters = { "date" : convert_date, "int" : convert_int, "float" : convert_float, "str" : convert_str }
+
+def compile_field_map( es_field_map ):
+    """ compile an es_field_map list of [json path, column name, type] into a trie keyed by the parts of the json paths,
+    each node is a tuple (children,fields) where children is a dict of key to node and fields is a list of (column name, converter) for the paths that end at the node """
+    trie = ({},[])
+    for json_path,field_name,field_type in (es_field_map if es_field_map else []):
+        node = trie
+        for part in json_path.split("."):
+            if part not in node[0]:
+                node[0][part] = ({},[])
+            node = node[0][part]
+        node[1].append((field_name,field_converters.get(field_type,convert_other)))
+    return trie
+
+def response_body( response ):
+    """ return the json body of a search response, newer clients wrap it in an ApiResponse that isn't a dict """
+    return getattr(response,"body",response)
+
+def extract_fields( node, result, put_value ):
+    """ walk only the parts of the result that are referenced by the trie node, lists are walked element by element,
+    calls put_value(column name, converter, value) for each matching value in document order """
+    if isinstance(result,dict):
+        children = node[0]
+        for k in result:
+            if k in children:
+                child = children[k]
+            elif "." in k:
+                # keys can contain dots, ex. field names in _source, match them against the parts of the path
+                child = node
+                for part in k.split("."):
+                    child = child[0].get(part)
+                    if not child:
+                        break
+                if not child:
+                    continue
+            else:
+                continue
+            item = result[k]
+            for field_name,convert in child[1]:
+                put_value(field_name,convert,item)
+            if child[0] and (isinstance(item,dict) or isinstance(item,list)):
+                extract_fields(child,item,put_value)
+    elif isinstance(result,list):
+        for item in result:
+            extract_fields(node,item,put_value)
+
+def set_range_start( query, timestamp_field, start ):
+    """ find the range clauses on timestamp_field in the query and set them to start at start in epoch milliseconds, returns True if one was found,
+    a range that keeps an upper bound keeps its format with epoch_millis added as an alternative so the upper bound still parses """
+    found = False
+    if isinstance(query,dict):
+        for k in query:
+            item = query[k]
+            if k == "range" and isinstance(item,dict) and timestamp_field in item:
+                bounds = item[timestamp_field]
+                bounds.pop("gt",None)
+                bounds["gte"] = start
+                if "lt" not in bounds and "lte" not in bounds:
+                    bounds["format"] = "epoch_millis"
+                elif "format" in bounds and "epoch_millis" not in bounds["format"].split("||"):
+                    bounds["format"] += "||epoch_millis"
+                found = True
+            elif set_range_start(item,timestamp_field,start):
+                found = True
+    elif isinstance(query,list):
+        for item in query:
+            if set_range_start(item,timestamp_field,start):
+                found = True
+    return found
+
+def incremental_query( es_query_body, timestamp_field, start ):
+    """ return a copy of the query body that only matches documents with timestamp_field at or after the datetime start,
+    rewrites the range clauses on the timestamp_field or adds one as a filter if there isn't one """
+    body = copy.deepcopy(es_query_body if es_query_body else {})
+    start = int(start.timestamp()*1000)
+    if not set_range_start(body.get("query",{}),timestamp_field,start):
+        start_range = { "range" : { timestamp_field : { "gte" : start, "format" : "epoch_millis" } } }
+        if "query" in body:
+            body["query"] = { "bool" : { "filter" : [ body["query"], start_range ] } }
+        else:
+            body["query"] = { "bool" : { "filter" : [ start_range ] } }
+    return body
 
 class ElasticsearchDataTable( DataTable ):
     """ class that collects data from the response to a specific elasticsearch query and populates tables based on a field map """
-    def __init__(self,refresh_minutes=1,es_index_pattern=None,es_query_body=None,es_field_map=None):
-        """ Initialize the ElasticsearchQueryTable pass in a refresh interval in minutes, the es_query_body dict representing the query json and the field map list of tuples [( json path, field name, field type )...]"""
+    def __init__(self,refresh_minutes=1,es_index_pattern=None,es_query_body=None,es_field_map=None,es_connection=None,es_incremental=None,es_max_rows=None,es_page_size=1000,es_batch_seconds=None,es_cache_seconds=0):
+        """ Initialize the ElasticsearchQueryTable pass in a refresh interval in minutes, the es_query_body dict representing the query json and the field map list of tuples [( json path, field name, field type )...],
+        optionally a dict of keyword arguments for the Elasticsearch client ex. {"hosts":["http://localhost:9200"]}, the client is shared by all tables with the same es_connection,
+        and optionally a dict to refresh incrementally of the form { "timestamp_field" : field the query range is on, "key_column" : date column holding the bucket keys,
+        "window_minutes" : minutes of buckets to keep, "overlap_buckets" : number of trailing buckets to fetch again, default 1 },
+        and optionally es_max_rows to fetch the hits in pages of es_page_size with search_after in a point in time, up to es_max_rows hits,
+        and optionally es_batch_seconds to send the search in one _msearch with the other tables searching in the same window, reusing responses less than es_cache_seconds old """
+        self.es_connection = es_connection
+        self.es_incremental = es_incremental
+        self.es_max_rows = es_max_rows
+        self.es_page_size = es_page_size
+        self.es_batch_seconds = es_batch_seconds
+        self.es_cache_seconds = es_cache_seconds
         self.es_query_body = es_query_body
         self.es_field_map = es_field_map
+        self.es_field_trie = compile_field_map(es_field_map)
         self.es_index_pattern = es_index_pattern
         DataTable.__init__(self,None,
             "Elasticsearch query:%s,index:%s,fieldmap:%s,refreshed every %d minutes"%(
@@ -34,51 +252,114 @@ class ElasticsearchDataTable( DataTable ):
         """ set the elasticsearch parameters for this table """
         self.es_query_body = es_query_body
         self.es_field_map = es_field_map
+        self.es_field_trie = compile_field_map(es_field_map)
         self.es_index_pattern = es_index_pattern
         self.refresh()
 
+    def paged_search( self, es, query_body, put_value ):
+        """ fetch up to es_max_rows hits for the query in pages of es_page_size using search_after in a point in time, each page is converted into the columns as it arrives so only one page is in memory,
+        aggregations are only requested with the first page so they are computed once """
+        pit_id = response_body(es.open_point_in_time(index=self.es_index_pattern,keep_alive="1m"))["id"]
+        try:
+            rows = 0
+            search_after = None
+            while rows < self.es_max_rows:
+                body = dict(query_body if query_body else {})
+                size = min(self.es_page_size,self.es_max_rows-rows)
+                body["size"] = size
+                body["pit"] = { "id" : pit_id, "keep_alive" : "1m" }
+                if "sort" not in body:
+                    body["sort"] = [ { "_shard_doc" : "asc" } ]
+                if search_after:
+                    body["search_after"] = search_after
+                    body.pop("aggs",None)
+                    body.pop("aggregations",None)
+                page = response_body(es.search(body=body))
+                hits = page["hits"]["hits"]
+                if not hits:
+                    break
+                extract_fields( self.es_field_trie, page, put_value )
+                rows += len(hits)
+                pit_id = page.get("pit_id",pit_id)
+                search_after = hits[-1]["sort"]
+                if len(hits) < size:
+                    break
+        finally:
+            es.close_point_in_time(body={ "id" : pit_id })
+
+    def merge_buckets( self, new_columns, start ):
+        """ merge the buckets in new_columns fetched from start into the current columns, buckets before start are kept, buckets older than the window are dropped, returns the merged columns """
+        key_column = self.es_incremental["key_column"]
+        window_minutes = self.es_incremental.get("window_minutes",None)
+
+        keep = 0
+        if start and self.has_column(key_column):
+            kc = self.get_column(key_column)
+            while keep < kc.size() and kc.get(keep).get_value() < start:
+                keep += 1
+
+        new_rows = []
+        if key_column in new_columns:
+            nkc = new_columns[key_column]
+            new_rows = [idx for idx in range(nkc.size()) if not start or nkc.get(idx).get_value() >= start]
+
+        column_names = [c.get_name() for c in self.columns]+[cn for cn in new_columns if not self.has_column(cn)]
+        merged = {}
+        for cn in column_names:
+            values = self.get_column(cn).values[:keep] if self.has_column(cn) else []
+            values = values + [blank_cell]*(keep-len(values))
+            if cn in new_columns:
+                values = values + [new_columns[cn].get(idx) for idx in new_rows]
+            else:
+                values = values + [blank_cell]*len(new_rows)
+            merged[cn] = values
+
+        drop = 0
+        if window_minutes and key_column in merged:
+            cutoff = datetime.now() - timedelta(minutes=window_minutes)
+            keys = merged[key_column]
+            while drop < len(keys) and keys[drop].get_type() != blank_type and keys[drop].get_value() < cutoff:
+                drop += 1
+
+        return { cn : Column(values=merged[cn][drop:],name=cn) for cn in column_names }
+
     @synchronized
     def refresh( self ):
         """ refresh or rebuild tables """
 
-        es = Elasticsearch()
+        es = get_es_client(self.es_connection)
 
-        result = es.search(index=self.es_index_pattern,body=self.es_query_body)
+        start = None
+        if self.es_incremental:
+            key_column = self.es_incremental["key_column"]
+            overlap_buckets = self.es_incremental.get("overlap_buckets",1)
+            if self.has_column(key_column) and self.get_column(key_column).size() > overlap_buckets:
+                kc = self.get_column(key_column)
+                start = kc.get(kc.size()-overlap_buckets).get_value()
 
-        def match_fields( name, result ):
-            matches = []
-            if isinstance(result,dict):
-                for k in result:
-                    full_name = (name+"." if name else "")+k
-                    item = result[k]
-                    for json_path,field_name,field_type  in self.es_field_map:
-                        if full_name == json_path:
-                            matches.append((field_name,field_type,item))
-                    if isinstance(item,dict) or isinstance(item,list):
-                        matches += match_fields(full_name,item)
-            elif isinstance(result,list):
-                for k in result:
-                    matches += match_fields(name,k)
-            return matches
-
-        matches = match_fields( "",result)
+        if start:
+            query_body = incremental_query(self.es_query_body,self.es_incremental["timestamp_field"],start)
+        else:
+            query_body = self.es_query_body
 
         new_columns = {}
-        for column_name,column_type,value in matches:
+        def put_value( column_name, convert, value ):
             if not column_name in new_columns:
                 new_columns[column_name] = Column(name=column_name)
             c = new_columns[column_name]
-            if column_type == "date":
-                cc = Cell(date_type,datetime.fromtimestamp(value/1000),format_date)
-            elif column_type == "int":
-                cc = Cell(int_type,value,format_int)
-            elif column_type == "float":
-                cc = Cell(float_type,value,format_float)
-            elif column_type == "str":
-                cc = Cell(string_type,value,format_string)
-            else:
-                cc = Cell(string_type,str(value),format_string)
-            c.put(c.size(),cc)
+            c.put(c.size(),convert(value))
+
+        if self.es_max_rows:
+            self.paged_search( es, query_body, put_value )
+        elif self.es_batch_seconds != None:
+            result = get_es_batcher(self.es_connection).search(self.es_index_pattern,query_body,self.es_batch_seconds,self.es_cache_seconds)
+            extract_fields( self.es_field_trie, result, put_value )
+        else:
+            result = response_body(es.search(index=self.es_index_pattern,body=query_body))
+            extract_fields( self.es_field_trie, result, put_value )
+
+        if self.es_incremental:
+            new_columns = self.merge_buckets( new_columns, start )
 
         for column_name in new_columns:
             if self.has_column(column_name):
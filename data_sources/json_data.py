@@ -9,20 +9,27 @@ import gzip
 import re
 import keyring
 from datetime import datetime,timedelta
-from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized,from_json
+from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized,from_json,FileWatch
 
 class JSONDataTable( DataTable ):
     """ class that collects data from a JSON file on disk of the form written by data_sources.data_table.to_json() and updates this table with it """
-    def __init__(self, json_spec = None ):
-        """ Initialize the JSONDataTable object from the file named in json_spec, refresh minutes will come from the loaded json """
+    def __init__(self, json_spec = None, file_hash = False ):
+        """ Initialize the JSONDataTable object from the file named in json_spec, refresh minutes will come from the loaded json,
+        the file is only reloaded when it changes, if file_hash is True a hash of the contents is also compared """
         self.json_spec = json_spec
+        self.file_watch = FileWatch(json_spec,file_hash)
         DataTable.__init__(self,None,"JSONDataTable",120)
         self.refresh()
 
     @synchronized
     def refresh( self ):
-        """ refresh the table by opening the JSON file and loading it into a table """
-        dt = from_json(open(self.json_spec,"r"))
+        """ refresh the table by opening the JSON file and loading it into a table, does nothing if the file hasn't changed """
+        signature = self.file_watch.check()
+        if not signature:
+            return
+        with open(self.json_spec,"r") as json_file:
+            dt = from_json(json_file)
+        self.file_watch.update(signature)
         if dt:
             rows,cols = dt.get_bounds()
             for idx in range(cols):
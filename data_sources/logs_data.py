@@ -8,12 +8,54 @@ import glob
 import gzip
 import re
 import statistics
+import json
 from dateutil import parser
 from datetime import datetime,timedelta
-from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
+from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized,blank_cell
 
 format_map = { date_type : format_date, int_type : format_int, float_type : format_float, string_type : format_string }
 
+def encode_value( type, value ):
+    """ convert a cell value to a json serializable value for a checkpoint """
+    if type == date_type and isinstance(value,datetime):
+        if value == datetime.min:
+            return None
+        return value.timestamp()
+    return value
+
+def decode_value( type, value ):
+    """ convert a checkpoint value back to a cell value """
+    if type == date_type:
+        if value == None:
+            return datetime.min
+        return datetime.fromtimestamp(value)
+    return value
+
+def encode_cell( cell ):
+    """ convert a cell to a json serializable list for a checkpoint, values are only kept for actions that need them """
+    if cell.type == blank_type:
+        return None
+    if isinstance(cell,ActionCell):
+        if cell.action == "key" or cell.action.startswith("count("):
+            values = []
+        else:
+            values = [encode_value(cell.type,v) for v in cell.values]
+        return [cell.type,encode_value(cell.type,cell.value),cell.action,values]
+    return [cell.type,encode_value(cell.type,cell.value)]
+
+def decode_cell( encoded ):
+    """ convert a checkpoint list back to a cell """
+    if encoded == None:
+        return blank_cell
+    if len(encoded) == 4:
+        type,value,action,values = encoded
+        cell = ActionCell(type,None,format_map[type],action)
+        cell.values = [decode_value(type,v) for v in values]
+        cell.value = decode_value(type,value)
+        return cell
+    type,value = encoded
+    return Cell(type,decode_value(type,value),format_map[type])
+
 class ActionCell(Cell):
     def __init__(self,type,value,format,action):
         Cell.__init__(self,type,None,format)
@@ -94,7 +136,7 @@ class Value():
 
 class LogDataTable( DataTable ):
     """ class that collects a time based aggregation of data from the syslog into a data_table """
-    def __init__(self,log_glob=None,log_map=None,log_lookback=None,refresh_minutes=10):
+    def __init__(self,log_glob=None,log_map=None,log_lookback=None,refresh_minutes=10,state_dir=None,checkpoint_minutes=5):
         """ Initialize the LogDataTable with a file glob pattern to collect the
         matching logs on this machine, a timespan to aggregate for, aggregation
         bucket in hours, a refresh interval for updating in minutes and a
@@ -110,7 +152,9 @@ class LogDataTable( DataTable ):
                 "action one of key,avg,min,max,count(value),mode,median"],
                 ...]},...]
         the key action is special and indicates that this is the bucket key for this type of line
-        log_lookback is of the form [ days, hours, minutes ] all must be specified """
+        log_lookback is of the form [ days, hours, minutes ] all must be specified
+        if state_dir is provided the aggregates and file offsets are checkpointed there every checkpoint_minutes
+        and on shutdown and reloaded on startup so only new log data is parsed """
         self.log_glob = log_glob
         self.log_map = log_map
         self.log_lookback = log_lookback
@@ -121,8 +165,33 @@ class LogDataTable( DataTable ):
                 self.log_glob,
                 refresh_minutes),
                 refresh_minutes)
+        if state_dir:
+            self.set_checkpoint(state_dir,json.dumps([self.log_glob,self.log_map,self.log_lookback]),checkpoint_minutes)
+            self.load_checkpoint()
         self.refresh()
 
+    def get_checkpoint( self ):
+        """ return a copy of the file offsets and aggregated columns as a json serializable checkpoint """
+        columns = []
+        for c in self.columns:
+            columns.append({ "name" : c.get_name(), "cells" : [encode_cell(cell) for cell in c.values] })
+        return { "file_map" : dict(self.file_map), "columns" : columns }
+
+    def put_checkpoint( self, checkpoint ):
+        """ restore the file offsets and aggregated columns from a checkpoint """
+        file_map = {}
+        for lf,(lft,lfp) in checkpoint["file_map"].items():
+            file_map[lf] = (lft,lfp)
+        columns = []
+        for c in checkpoint["columns"]:
+            columns.append(Column(values=[decode_cell(cell) for cell in c["cells"]],name=c["name"]))
+        self.file_map = file_map
+        for c in columns:
+            if self.has_column(c.get_name()):
+                self.replace_column(self.map_column(c.get_name()),c)
+            else:
+                self.add_column(c)
+
     @synchronized
     def refresh( self ):
         """ refresh or rebuild tables """
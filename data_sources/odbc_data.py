@@ -7,58 +7,391 @@ import os
 import glob
 import gzip
 import re
+import time
+import threading
 import pyodbc
 import keyring
 from datetime import datetime,timedelta
-from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
+from data_sources.data_table import DataTable,Column,Cell,blank_cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
 
+def parse_sql_spec( sql_spec ):
+    """ parse a sql_spec of the form odbc://user@server/driver/database:port and return a tuple (username,server,driver,database,port) """
+    return re.match(r"odbc://([a-z_][a-z0-9_-]*\${0,1})@([^/]*)/([^/]*)/([^:]*):{0,1}(\d*){0,1}",sql_spec).groups()
+
+class PooledConnection():
+    """ an open connection in an ODBCConnectionPool with a cursor that is reused for each query """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.last_used = time.time()
+
+    def close( self ):
+        """ close the connection ignoring errors from connections that are already broken """
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+class ODBCConnectionPool():
+    """ pool of open connections for one sql_spec shared by all the tables querying that database """
+    def __init__(self, sql_spec, idle_seconds=300, check_seconds=30, max_idle=4, health_query="SELECT 1"):
+        """ Initialize the pool for sql_spec, idle connections are closed after idle_seconds by a sweep that runs while there are idle connections, connections idle longer than check_seconds
+        are checked with health_query before they are handed out, at most max_idle connections are kept open """
+        self.sql_spec = sql_spec
+        self.idle_seconds = idle_seconds
+        self.check_seconds = check_seconds
+        self.max_idle = max_idle
+        self.health_query = health_query
+        self.password = None
+        self.idle = []
+        self.sweep_thread = None
+        self.sweep_stop = threading.Event()
+        self.pool_lock = threading.RLock()
+
+    def connect( self ):
+        """ open a new connection, the keyring is only read the first time or after a connect fails, returns None if there are no credentials """
+        username,server,driver,database,port = parse_sql_spec(self.sql_spec)
+        with self.pool_lock:
+            if not self.password:
+                self.password = keyring.get_password(self.sql_spec, username)
+            password = self.password
+        if not password:
+            return None
+        try:
+            conn = pyodbc.connect("DRIVER={%s};DATABASE=%s;UID=%s;PWD=%s;SERVER=%s;PORT=%s;"%(driver,database,username,password,server,port))
+        except Exception:
+            with self.pool_lock:
+                self.password = None
+            raise
+        return PooledConnection(conn) if conn else None
+
+    def healthy( self, pc ):
+        """ return True if the connection answers the health query """
+        try:
+            pc.cursor.execute(self.health_query).fetchall()
+            return True
+        except Exception:
+            return False
+
+    def acquire( self ):
+        """ return an open connection from the pool, idle connections that expired or fail the health check are closed, a new connection is opened if none are left """
+        while True:
+            with self.pool_lock:
+                if not self.idle:
+                    break
+                pc = self.idle.pop()
+            idle = time.time() - pc.last_used
+            if idle < self.idle_seconds and (idle < self.check_seconds or self.healthy(pc)):
+                return pc
+            pc.close()
+        return self.connect()
+
+    def release( self, pc, broken=False ):
+        """ return a connection to the pool when the caller is done with it, broken connections and ones over max_idle are closed """
+        if broken:
+            pc.close()
+            return
+        pc.last_used = time.time()
+        with self.pool_lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(pc)
+                if not self.sweep_thread:
+                    self.sweep_thread = threading.Thread(target=self.perform_sweep,daemon=True)
+                    self.sweep_thread.start()
+                return
+        pc.close()
+
+    def sweep( self ):
+        """ close the idle connections that have been idle longer than idle_seconds """
+        now = time.time()
+        with self.pool_lock:
+            expired = [ pc for pc in self.idle if now - pc.last_used >= self.idle_seconds ]
+            self.idle = [ pc for pc in self.idle if now - pc.last_used < self.idle_seconds ]
+        for pc in expired:
+            pc.close()
+
+    def perform_sweep( self ):
+        """ Thread worker that sweeps the idle connections until there are none left or the pool is closed """
+        while not self.sweep_stop.wait(max(min(self.idle_seconds,self.check_seconds),0.1)):
+            self.sweep()
+            with self.pool_lock:
+                if not self.idle:
+                    self.sweep_thread = None
+                    return
+
+    def execute( self, sql_query, params, handle_batch, batch_size=1000 ):
+        """ execute sql_query with the list of bound parameters params on a pooled connection and call handle_batch(description,rows) with each batch of up to batch_size rows,
+        a connection that fails before any rows are handled is discarded and the query is tried once more on a new connection, returns False if there are no credentials """
+        for attempt in range(2):
+            pc = self.acquire()
+            if not pc:
+                return False
+            try:
+                cursor = pc.cursor.execute(sql_query,*params)
+            except pyodbc.Error:
+                self.release(pc,True)
+                if attempt:
+                    raise
+                continue
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    handle_batch(cursor.description,rows)
+            except:
+                self.release(pc,True)
+                raise
+            self.release(pc)
+            return True
+
+    def close( self ):
+        """ stop the sweep and close all the idle connections """
+        with self.pool_lock:
+            sweep_thread = self.sweep_thread
+            self.sweep_thread = None
+        if sweep_thread:
+            self.sweep_stop.set()
+            sweep_thread.join()
+            self.sweep_stop.clear()
+        with self.pool_lock:
+            for pc in self.idle:
+                pc.close()
+            self.idle = []
+
+_odbc_pools = {}
+_odbc_pools_lock = threading.RLock()
+def get_odbc_pool( sql_spec ):
+    """ return the process wide ODBCConnectionPool for sql_spec creating it if needed """
+    with _odbc_pools_lock:
+        if sql_spec not in _odbc_pools:
+            _odbc_pools[sql_spec] = ODBCConnectionPool(sql_spec)
+        return _odbc_pools[sql_spec]
+
+def shutdown_odbc_pools():
+    """ close all the pooled odbc connections """
+    global _odbc_pools
+    with _odbc_pools_lock:
+        for sql_spec in _odbc_pools:
+            _odbc_pools[sql_spec].close()
+        _odbc_pools = {}
+
+def convert_date( value ):
+    return Cell(date_type,value,format_date)
+
+def convert_int( value ):
+    return Cell(int_type,value,format_int)
+
+def convert_float( value ):
+    return Cell(float_type,value,format_float)
+
+def convert_str( value ):
+    return Cell(string_type,value,format_string)
+
+def convert_other( value ):
+    return Cell(string_type,str(value),format_string)
+
+def convert_value( value ):
+    """ convert a value from a result row into a Cell of the matching type """
+    if isinstance(value,datetime):
+        return convert_date(value)
+    elif isinstance(value,int):
+        return convert_int(value)
+    elif isinstance(value,float):
+        return convert_float(value)
+    elif isinstance(value,str):
+        return convert_str(value)
+    else:
+        return convert_other(value)
+
+value_converters = { datetime : convert_date, int : convert_int, float : convert_float, str : convert_str }
+
+def column_converter( values ):
+    """ return a function that converts the values of a result column into Cells, the type is chosen from the first value that isn't null,
+    values of any other type fall back to convert_value """
+    for value in values:
+        if value != None:
+            value_type = type(value)
+            convert = value_converters.get(value_type)
+            if not convert:
+                break
+            return lambda v: convert(v) if type(v) is value_type else convert_value(v)
+    return convert_value
+
+# per dialect templates for the aggregate query, bucket is an expression for the start of the bucket holding {ts} in epoch seconds,
+# start_format formats the start of the time range as a string to bind or is None to bind a datetime,
+# utc is True if the epoch is computed from the timestamp's wall clock time instead of the local timezone
+sql_dialects = {
+    "sqlite" : { "bucket" : "(CAST(strftime('%s',{ts}) AS INTEGER)/{seconds})*{seconds}", "start_format" : "%Y-%m-%d %H:%M:%S", "utc" : True },
+    "postgresql" : { "bucket" : "CAST(FLOOR(EXTRACT(EPOCH FROM {ts})/{seconds})*{seconds} AS BIGINT)", "start_format" : None, "utc" : True },
+    "mysql" : { "bucket" : "FLOOR(UNIX_TIMESTAMP({ts})/{seconds})*{seconds}", "start_format" : None, "utc" : False },
+}
+
+sql_aggregate_functions = [ "count", "sum", "avg", "min", "max" ]
+
+def aggregate_query( sql_aggregate ):
+    """ return the bucketed GROUP BY query for a sql_aggregate definition, the query has one ? parameter for the start of the time range """
+    dialect = sql_dialects[sql_aggregate.get("dialect","sqlite")]
+    seconds = int(sql_aggregate.get("bucket_minutes",60)*60)
+    ts = sql_aggregate["timestamp_column"]
+    select = [ dialect["bucket"].format(ts=ts,seconds=seconds)+" AS bucket" ]
+    for idx,(function,sql_column,data_column) in enumerate(sql_aggregate["aggregates"]):
+        if function.lower() not in sql_aggregate_functions:
+            raise ValueError("unsupported aggregate function %s"%function)
+        select.append("%s(%s) AS agg%d"%(function.upper(),sql_column,idx))
+    where = "%s >= ?"%ts
+    if sql_aggregate.get("where"):
+        where += " AND (%s)"%sql_aggregate["where"]
+    return "SELECT %s FROM %s WHERE %s GROUP BY 1 ORDER BY 1"%(",".join(select),sql_aggregate["table"],where)
+
+def to_epoch( dt, utc ):
+    """ convert a naive datetime to epoch seconds treating it as utc or local time """
+    return (dt - datetime(1970,1,1)).total_seconds() if utc else dt.timestamp()
+
+def from_epoch( epoch, utc ):
+    """ convert epoch seconds to a naive datetime in utc or local time """
+    return datetime(1970,1,1) + timedelta(seconds=epoch) if utc else datetime.fromtimestamp(epoch)
 
 class ODBCDataTable( DataTable ):
     """ class that collects data from the response to a specific sql query on an odbc connected database and populates tables based on a field map """
-    def __init__(self,refresh_minutes=1,sql_spec=None,sql_query=None,sql_map=None):
-        """ Initalize the ODBCDataTable object pass in a sql_spec to connect to the database of the form odbc://user@server/driver/database:port, a sql_query to be executed, and a field map of the form [[sql_column_name, data_table_column_name],..] indicating the columns to collect from the result """
+    def __init__(self,refresh_minutes=1,sql_spec=None,sql_query=None,sql_map=None,sql_watermark=None,sql_max_rows=None,sql_batch_size=1000,sql_aggregate=None):
+        """ Initalize the ODBCDataTable object pass in a sql_spec to connect to the database of the form odbc://user@server/driver/database:port, a sql_query to be executed, and a field map of the form [[sql_column_name, data_table_column_name],..] indicating the columns to collect from the result,
+        each refresh replaces the table with the result unless sql_watermark is a dict of the form { "column" : sql column name, "start" : initial value } in which case the query has one ? parameter
+        that is bound to the largest value of that column seen so far and the rows returned are appended, optionally keep only the last sql_max_rows rows,
+        rows are fetched sql_batch_size at a time,
+        or instead of a query and field map pass sql_aggregate, a dict of the form { "table" : table name, "timestamp_column" : column to bucket on, "bucket_minutes" : bucket size default 60,
+        "num_buckets" : buckets to keep default 24, "dialect" : one of sqlite, postgresql, mysql, "aggregates" : [[function one of count,sum,avg,min,max, sql column or *, data table column name],...],
+        "where" : optional extra sql condition, "key_column" : name of the bucket column default "Time Stamps" } to have the database compute the buckets with a GROUP BY """
         self.sql_spec = sql_spec
         self.sql_query = sql_query
         self.sql_map = sql_map
+        self.sql_watermark = sql_watermark
+        self.sql_max_rows = sql_max_rows
+        self.sql_batch_size = sql_batch_size
+        self.watermark = sql_watermark.get("start",0) if sql_watermark else None
+        # the configured start is an int or a string from the json config that may not compare with the column's values, ex. a datetime, so it is replaced by the first value fetched
+        self.watermark_fetched = False
+        self.sql_aggregate = sql_aggregate
+        self.query_lock = threading.Lock()
+        if sql_aggregate:
+            self.sql_query = aggregate_query(sql_aggregate)
+            self.sql_map = [["bucket",sql_aggregate.get("key_column","Time Stamps")]]+[["agg%d"%idx,aggregate[2]] for idx,aggregate in enumerate(sql_aggregate["aggregates"])]
         DataTable.__init__(self,None,
             "ODBCDataTable query:%s,database:%s,fieldmap:%s,refreshed every %d minutes"%(
-            sql_query,sql_spec,sql_map,refresh_minutes),
+            self.sql_query,sql_spec,self.sql_map,refresh_minutes),
             refresh_minutes)
 
         self.refresh()
 
-    @synchronized
     def refresh( self ):
-        """ refresh the table from the query """
-        username,server,driver,database,port = re.match(r"odbc://([a-z_][a-z0-9_-]*\${0,1})@([^/]*)/([^/]*)/([^:]*):{0,1}(\d*){0,1}",self.sql_spec).groups()
+        """ refresh the table from the query, refreshes run one at a time so overlapping refreshes can't fetch from the same watermark twice,
+        refresh_lock is only held while the results are applied so readers aren't blocked by the query """
+        with self.query_lock:
+            if self.sql_aggregate:
+                self.refresh_aggregate()
+            else:
+                self.refresh_query()
 
-        password = keyring.get_password(self.sql_spec, username)
-        if not password:
+    def refresh_query( self ):
+        """ refresh the table from the query, the query runs on a connection from the pool shared by the tables on the same database and is fetched in batches,
+        with a watermark only the rows after the last value seen are fetched and each batch is appended, otherwise the table is replaced when the fetch is done """
+        params = [self.watermark] if self.sql_watermark else []
+        new_values = { data_column : [] for sql_column,data_column in self.sql_map }
+        positions = []
+
+        def handle_batch( description, rows ):
+            if not positions:
+                names = [d[0] for d in description]
+                lower_names = [n.lower() for n in names]
+                def position( sql_column ):
+                    return names.index(sql_column) if sql_column in names else lower_names.index(sql_column.lower())
+                positions.extend([(position(sql_column),data_column) for sql_column,data_column in self.sql_map])
+                if self.sql_watermark:
+                    positions.append((position(self.sql_watermark["column"]),None))
+
+            batch_values = {}
+            for pos,data_column in positions:
+                values = [row[pos] for row in rows]
+                if data_column:
+                    batch_values[data_column] = list(map(column_converter(values),values))
+                else:
+                    values = [v for v in values if v != None]
+                    watermark = max(values) if values else None
+
+            if self.sql_watermark:
+                with self.refresh_lock:
+                    if watermark != None and (not self.watermark_fetched or watermark > self.watermark):
+                        self.watermark = watermark
+                        self.watermark_fetched = True
+                    self.append_values(batch_values)
+            else:
+                for data_column in batch_values:
+                    new_values[data_column].extend(batch_values[data_column])
+
+        if not get_odbc_pool(self.sql_spec).execute(self.sql_query,params,handle_batch,self.sql_batch_size):
             return
 
-        conn = pyodbc.connect("DRIVER={%s};DATABASE=%s;UID=%s;PWD=%s;SERVER=%s;PORT=%s;"%(driver,database,username,password,server,port))
-        if not conn:
+        with self.refresh_lock:
+            if not self.sql_watermark:
+                for data_column in new_values:
+                    if self.has_column(data_column):
+                        self.replace_column(self.map_column(data_column),Column(name=data_column))
+                self.append_values(new_values)
+            self.changed()
+            DataTable.refresh(self)
+
+    def refresh_aggregate( self ):
+        """ refresh the table from the aggregate query, only one row per bucket is fetched, buckets with no rows have a count of 0 and blank aggregates """
+        dialect = sql_dialects[self.sql_aggregate.get("dialect","sqlite")]
+        seconds = int(self.sql_aggregate.get("bucket_minutes",60)*60)
+        num_buckets = self.sql_aggregate.get("num_buckets",24)
+        aggregates = self.sql_aggregate["aggregates"]
+
+        now = to_epoch(datetime.now(),dialect["utc"])
+        first_bucket = (int(now)//seconds - (num_buckets-1))*seconds
+        start = from_epoch(first_bucket,dialect["utc"])
+        if dialect["start_format"]:
+            start = start.strftime(dialect["start_format"])
+
+        buckets = {}
+        def handle_batch( description, rows ):
+            for row in rows:
+                buckets[int(row[0])] = row[1:]
+
+        if not get_odbc_pool(self.sql_spec).execute(self.sql_query,[start],handle_batch,self.sql_batch_size):
             return
 
-        result = conn.execute(self.sql_query)
-
-        for row in result:
-            for sql_column,data_column in self.sql_map:
-                value = getattr(row,sql_column)
-                if not self.has_column(data_column):
-                    self.add_column(Column(name=data_column))
-                c = self.get_column(data_column)
-                if isinstance(value,datetime):
-                    cc = Cell(date_type,value,format_date)
-                elif isinstance(value,int):
-                    cc = Cell(int_type,value,format_int)
-                elif isinstance(value,float):
-                    cc = Cell(float_type,value,format_float)
-                elif isinstance(value,str):
-                    cc = Cell(string_type,value,format_string)
+        new_values = { data_column : [] for sql_column,data_column in self.sql_map }
+        key_column = self.sql_map[0][1]
+        for idx in range(num_buckets):
+            bucket = first_bucket + idx*seconds
+            new_values[key_column].append(convert_date(from_epoch(bucket,dialect["utc"])))
+            row = buckets.get(bucket)
+            for pos,(function,sql_column,data_column) in enumerate(aggregates):
+                value = row[pos] if row else None
+                if value != None:
+                    new_values[data_column].append(convert_value(value))
+                elif function.lower() == "count":
+                    new_values[data_column].append(convert_int(0))
                 else:
-                    cc = Cell(string_type,str(value),format_string)
-                c.put(c.size(),cc)
+                    new_values[data_column].append(blank_cell)
 
-        self.changed()
-        DataTable.refresh(self)
+        with self.refresh_lock:
+            for data_column in new_values:
+                if self.has_column(data_column):
+                    self.replace_column(self.map_column(data_column),Column(values=new_values[data_column],name=data_column))
+                else:
+                    self.add_column(Column(values=new_values[data_column],name=data_column))
+            self.changed()
+            DataTable.refresh(self)
+
+    @synchronized
+    def append_values( self, new_values ):
+        """ append the lists of cells in the dictionary new_values of column name to cells to the columns, only the last sql_max_rows rows are kept """
+        for sql_column,data_column in self.sql_map:
+            if not self.has_column(data_column):
+                self.add_column(Column(name=data_column))
+            c = self.get_column(data_column)
+            c.values.extend(new_values.get(data_column,[]))
+            if self.sql_max_rows and len(c.values) > self.sql_max_rows:
+                del c.values[:len(c.values)-self.sql_max_rows]
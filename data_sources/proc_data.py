@@ -7,94 +7,465 @@ import os
 import glob
 import gzip
 import re
+import threading
+import time
 import psutil
 from datetime import datetime,timedelta
 from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
 
 class AverageCell(Cell):
-    def __init__(self,type,value,format):
+    """ cell that keeps a streaming count, sum, minimum, maximum and last value of the values put into it in constant space, stat is one of avg,min,max,last and selects which of them is the value of the cell """
+    def __init__(self,type,value,format,stat="avg"):
         self.type = type
-        self.value = value
         self.format = format
-        self.values = [ value ]
+        self.stat = stat
+        self.count = 1
+        self.total = value
+        self.min = value
+        self.max = value
+        self.last = value
+        self.value = value
 
     def put_value(self,value):
-        self.values.append(value)
-        self.value = sum(self.values)/len(self.values)
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+        self.value = self.get_stat(self.stat)
 
-class ProcDataTable( DataTable ):
-    """ class that collects a time based aggregation of data from system process information into a data_table """
-    def __init__(self,num_hours=24,bucket_hours=1,refresh_minutes=10):
-        """ Initialize the ProcDataTable to collect system process information, a timespan to aggregate for, aggregation bucket in hours, a refresh interval for updating in minutes """
+    def get_stat(self,stat):
+        """ return the value of the statistic stat one of avg,min,max,last """
+        if stat == "min":
+            return self.min
+        elif stat == "max":
+            return self.max
+        elif stat == "last":
+            return self.last
+        else:
+            return self.total/self.count
+
+class RateCounter():
+    """ derives a per second rate from the deltas between consecutive samples of a counter that only increases, if the counter goes backwards it was reset and the new value is taken as the delta """
+    def __init__(self):
+        self.last_value = None
+        self.last_time = None
+
+    def rate(self,value,timestamp):
+        """ update the counter with the value sampled at timestamp in seconds, return the rate since the last sample or None for the first sample """
+        last_value = self.last_value
+        last_time = self.last_time
+        self.last_value = value
+        self.last_time = timestamp
+        if last_value == None or timestamp <= last_time:
+            return None
+        if value >= last_value:
+            delta = value - last_value
+        else:
+            delta = value
+        return delta/(timestamp-last_time)
+
+class SampledDataTable( DataTable ):
+    """ base class for tables that take samples of some metrics on their own interval and aggregate them into time buckets, subclasses implement sample_values, counters are turned into per second rate columns """
+    def __init__(self,name=None,num_hours=24,bucket_hours=1,refresh_minutes=10,sample_seconds=0,stats=None):
+        """ Initialize the SampledDataTable, a timespan to aggregate for, aggregation bucket in hours, a refresh interval for updating in minutes,
+        an interval in seconds to take samples on, if 0 a sample is only taken on each refresh, and a list of extra statistics one of min,max,last to
+        add columns for, the column for each metric is the average of the samples in the bucket """
         self.num_hours = num_hours
         self.bucket_hours = bucket_hours
-        DataTable.__init__(self,None,
-            "Proc Data: for the last %d hours in %d hour buckets, refreshed every %d minutes"%(
-            self.num_hours,
-            self.bucket_hours,
-            refresh_minutes),refresh_minutes)
-        self.refresh()
+        self.sample_seconds = sample_seconds
+        self.stats = stats if stats else []
+        self.bucket_columns = []
+        self.rate_counters = {}
+        self.sample_thread = None
+        self.sample_thread_stop = threading.Event()
+        DataTable.__init__(self,None,name,refresh_minutes)
+        self.add_column(Column(name="Time Stamps"))
+        self.bucket_columns.append("Time Stamps")
+
+    def sample_values( self ):
+        """ return a tuple (values,counters) for the current sample where values is a list of tuples (column name, value) and counters is a list of tuples (rate column name, counter value), implemented by subclasses """
+        return ([],[])
+
+    def start_refresh( self ):
+        """ Start the background refresh thread and the sample thread if there is a sample interval """
+        DataTable.start_refresh(self)
+        if self.sample_seconds:
+            self.sample_thread = threading.Thread(target=self.perform_sample)
+            self.sample_thread.start()
+
+    def perform_sample( self ):
+        """ Thread worker that takes a sample every sample_seconds """
+        next_time = time.time()
+        while not self.sample_thread_stop.is_set():
+            self.sample()
+            next_time += self.sample_seconds
+            delay = next_time - time.time()
+            if delay < 0:
+                next_time = time.time()
+                delay = 0
+            self.sample_thread_stop.wait(delay)
+
+    def stop_refresh( self ):
+        """ Stop the sample thread and the background refresh thread """
+        self.sample_thread_stop.set()
+        if self.sample_thread and self.sample_thread.is_alive():
+            self.sample_thread.join()
+        self.sample_thread = None
+        self.sample_thread_stop.clear()
+        DataTable.stop_refresh(self)
+
+    def sample( self ):
+        """ take one sample and aggregate it into the current time bucket """
+        current_time = datetime.now()
+        sample_time = time.monotonic()
+        values,counters = self.sample_values()
+
+        rates = []
+        for cn,value in counters:
+            if cn not in self.rate_counters:
+                self.rate_counters[cn] = RateCounter()
+            rates.append((cn,self.rate_counters[cn].rate(value,sample_time)))
+
+        with self.refresh_lock:
+            bidx = self.bucket_idx( current_time )
+
+            for cn,value in values+rates:
+                self.add_average(cn,"avg",bidx,value)
+                for stat in self.stats:
+                    self.add_average("%s %s"%(cn,stat.capitalize()),stat,bidx,value)
+
+    def bucket_idx( self, timestamp ):
+        """ return the index of the bucket for timestamp, appending a new bucket and evicting the oldest if needed """
+        column = self.get_column("Time Stamps")
+        size = column.size()
+        if size and column.get(size-1).get_value() >= timestamp:
+            idx = size-1
+            while idx > 0 and column.get(idx-1).get_value() >= timestamp:
+                idx -= 1
+            return idx
+
+        column.put(size,Cell(date_type,timestamp+timedelta( hours=self.bucket_hours),format_date))
+        if column.size() > self.num_hours/self.bucket_hours:
+            for cn in self.bucket_columns:
+                self.get_column(cn).delete(0)
+        return column.size()-1
+
+    def add_average( self, column_name, stat, idx, value ):
+        """ aggregate value into the bucket idx of the column named column_name, creating the column if needed, a value of None only creates the column """
+        if not self.has_column(column_name):
+            self.add_column(Column(name=column_name))
+            self.bucket_columns.append(column_name)
+        column = self.get_column(column_name)
+        if value == None:
+            return
+        if idx >= column.size() or column.get(idx).get_type() == blank_type:
+            column.put(idx, AverageCell(float_type,value,format_float,stat))
+        else:
+            column.get(idx).put_value(value)
 
     @synchronized
     def refresh( self ):
-        """ refresh or rebuild tables """
+        """ refresh the table, takes a sample if there is no sample thread running """
+        if not self.sample_thread:
+            self.sample()
+        self.changed()
 
-        current_time = datetime.now()
+        DataTable.refresh(self)
+
+def host_values( cpu_percent, load_avg, memory, disk_percent, disk_io, net_io, connections ):
+    """ return a tuple (values,counters) for the host wide metrics, disk_io is a tuple (read_bytes,write_bytes,read_count,write_count), net_io is a tuple (bytes_sent,bytes_recv,packets_sent,packets_recv) """
+    total,available = memory
+    read_bytes,write_bytes,read_count,write_count = disk_io
+    bytes_sent,bytes_recv,packets_sent,packets_recv = net_io
+    return ([
+        ("CPU Percent",cpu_percent),
+        ("Load Avg",load_avg),
+        ("Total Virtual Memory",total),
+        ("Available Virtual Memory",available),
+        ("Filesystem Percent Full",disk_percent),
+        ("Filesystem Read Bytes",read_bytes),
+        ("Filesystem Write Bytes",write_bytes),
+        ("Network Sent Bytes",bytes_sent),
+        ("Network Received Bytes",bytes_recv),
+        ("Network Connections",float(connections)) ],
+        [
+        ("Filesystem Read Bytes/Sec",read_bytes),
+        ("Filesystem Write Bytes/Sec",write_bytes),
+        ("Filesystem Read Ops/Sec",read_count),
+        ("Filesystem Write Ops/Sec",write_count),
+        ("Network Sent Bytes/Sec",bytes_sent),
+        ("Network Received Bytes/Sec",bytes_recv),
+        ("Network Sent Packets/Sec",packets_sent),
+        ("Network Received Packets/Sec",packets_recv) ])
 
-        column_names = [ "Time Stamps", "CPU Percent", "Load Avg",
-            "Total Virtual Memory", "Available Virtual Memory",
-            "Filesystem Percent Full", "Filesystem Read Bytes", "Filesystem Write Bytes",
-            "Network Sent Bytes","Network Received Bytes","Network Connections" ]
+def cpu_values( cpu_percents ):
+    """ return the list of values for the per cpu percents """
+    return [("CPU %d Percent"%idx,percent) for idx,percent in enumerate(cpu_percents)]
 
-        def bucket_idx( timestamp, column ):
-            for idx in range(column.size()):
-                if column.get(idx).get_value() >= timestamp:
-                    return idx
+def disk_counters( disk, disk_io ):
+    """ return the list of counters for one disk, disk_io is a tuple (read_bytes,write_bytes,read_count,write_count) """
+    read_bytes,write_bytes,read_count,write_count = disk_io
+    return [
+        ("Disk %s Read Bytes/Sec"%disk,read_bytes),
+        ("Disk %s Write Bytes/Sec"%disk,write_bytes),
+        ("Disk %s Read Ops/Sec"%disk,read_count),
+        ("Disk %s Write Ops/Sec"%disk,write_count) ]
+
+def nic_counters( nic, net_io ):
+    """ return the list of counters for one network interface, net_io is a tuple (bytes_sent,bytes_recv,packets_sent,packets_recv) """
+    bytes_sent,bytes_recv,packets_sent,packets_recv = net_io
+    return [
+        ("Network %s Sent Bytes/Sec"%nic,bytes_sent),
+        ("Network %s Received Bytes/Sec"%nic,bytes_recv),
+        ("Network %s Sent Packets/Sec"%nic,packets_sent),
+        ("Network %s Received Packets/Sec"%nic,packets_recv) ]
+
+class PsutilSampler():
+    """ takes samples of the system metrics using psutil, metrics is a list of the metric sets to sample from host,per_cpu,per_disk,per_nic """
+    def __init__(self,metrics=None):
+        self.metrics = metrics if metrics else ["host"]
+
+    def sample_values( self ):
+        """ return a tuple (values,counters) of lists of tuples (column name, value) for the current system metrics and cumulative counters """
+        values = []
+        counters = []
+        if "host" in self.metrics:
+            virtual_memory = psutil.virtual_memory()
+            disk_io = psutil.disk_io_counters()
+            net_io = psutil.net_io_counters()
+            host_v,host_c = host_values(
+                psutil.cpu_percent(),
+                psutil.getloadavg()[2],
+                (virtual_memory.total,virtual_memory.available),
+                psutil.disk_usage("/").percent,
+                (disk_io.read_bytes,disk_io.write_bytes,disk_io.read_count,disk_io.write_count),
+                (net_io.bytes_sent,net_io.bytes_recv,net_io.packets_sent,net_io.packets_recv),
+                len(psutil.net_connections()))
+            values += host_v
+            counters += host_c
+        if "per_cpu" in self.metrics:
+            values += cpu_values(psutil.cpu_percent(percpu=True))
+        if "per_disk" in self.metrics:
+            for disk,disk_io in psutil.disk_io_counters(perdisk=True).items():
+                counters += disk_counters(disk,(disk_io.read_bytes,disk_io.write_bytes,disk_io.read_count,disk_io.write_count))
+        if "per_nic" in self.metrics:
+            for nic,net_io in psutil.net_io_counters(pernic=True).items():
+                counters += nic_counters(nic,(net_io.bytes_sent,net_io.bytes_recv,net_io.packets_sent,net_io.packets_recv))
+        return (values,counters)
+
+class ProcFile():
+    """ a file under /proc or /sys that is opened once and re-read from the start for each sample """
+    def __init__(self,path):
+        """ open the file at path, the file descriptor stays open until close is called """
+        self.path = path
+        self.fd = None
+        self.fd = os.open(path,os.O_RDONLY)
+
+    def read(self):
+        """ seek back to the start of the file and return its whole contents as a string """
+        os.lseek(self.fd,0,os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd,65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8",errors="replace")
+
+    def close(self):
+        """ close the file descriptor """
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+class ProcfsSampler():
+    """ takes samples of the system metrics on Linux by reading /proc/stat, /proc/meminfo, /proc/diskstats, /proc/net/dev and /proc/net/sockstat directly, each file is read once per sample, metrics is a list of the metric sets to sample from host,per_cpu,per_disk,per_nic """
+    def __init__(self,metrics=None):
+        """ open the /proc files that are read for each sample """
+        self.metrics = metrics if metrics else ["host"]
+        self.stat_file = ProcFile("/proc/stat")
+        self.meminfo_file = ProcFile("/proc/meminfo")
+        self.diskstats_file = ProcFile("/proc/diskstats")
+        self.net_dev_file = ProcFile("/proc/net/dev")
+        self.sockstat_files = [ProcFile(f) for f in ["/proc/net/sockstat","/proc/net/sockstat6"] if os.path.exists(f)]
+        self.block_devices = set(os.listdir("/sys/block")) if os.path.isdir("/sys/block") else None
+        self.last_cpu_times = {}
+
+    def cpu_percents( self ):
+        """ return a tuple (cpu percent,[percent per cpu]) of the cpu percent busy since the last sample from /proc/stat, 0.0 for the first sample """
+        cpu_percent = 0.0
+        percents = []
+        for line in self.stat_file.read().split("\n"):
+            if not line.startswith("cpu"):
+                break
+            fields = line.split()
+            times = [int(f) for f in fields[1:9]]
+            idle = times[3]+times[4]
+            total = sum(times)
+            last_cpu_times = self.last_cpu_times.get(fields[0])
+            self.last_cpu_times[fields[0]] = (idle,total)
+            if not last_cpu_times or total <= last_cpu_times[1]:
+                percent = 0.0
             else:
-                return -1
-
-        def append_bucket( timestamp, column ):
-            column.put(column.size(),Cell(date_type,timestamp+timedelta( hours=self.bucket_hours),format_date))
-            if column.size() > self.num_hours/self.bucket_hours:
-                for cn in column_names:
-                    self.get_column(cn).delete(0)
-            return column.size()-1
-
-        def add_average( column_name, idx, value ):
-            column = self.get_column(column_name)
-            if not column.size() or idx >= column.size():
-                column.put(idx, AverageCell(float_type,value,format_float))
+                percent = 100.0*(1.0-(idle-last_cpu_times[0])/(total-last_cpu_times[1]))
+            if fields[0] == "cpu":
+                cpu_percent = percent
             else:
-                column.get(idx).put_value(value)
-
-        bidx = 0
-        for cn in column_names:
-            if not self.has_column(cn):
-                self.add_column(Column(name=cn))
-            if cn == "Time Stamps":
-                bidx = bucket_idx( current_time, self.get_column(cn))
-                if bidx < 0:
-                    bidx = append_bucket( current_time, self.get_column(cn))
-            elif cn == "CPU Percent":
-                add_average(cn,bidx,psutil.cpu_percent())
-            elif cn == "Load Avg":
-                add_average(cn,bidx,psutil.getloadavg()[2])
-            elif cn == "Total Virtual Memory":
-                add_average(cn,bidx,psutil.virtual_memory().total)
-            elif cn == "Available Virtual Memory":
-                add_average(cn,bidx,psutil.virtual_memory().available)
-            elif cn == "Filesystem Percent Full":
-                add_average(cn,bidx,psutil.disk_usage("/").percent)
-            elif cn == "Filesystem Read Bytes":
-                add_average(cn,bidx,psutil.disk_io_counters().read_bytes)
-            elif cn == "Filesystem Write Bytes":
-                add_average(cn,bidx,psutil.disk_io_counters().write_bytes)
-            elif cn == "Network Sent Bytes":
-                add_average(cn,bidx,psutil.net_io_counters().bytes_sent)
-            elif cn == "Network Received Bytes":
-                add_average(cn,bidx,psutil.net_io_counters().bytes_recv)
-            elif cn == "Network Connections":
-                add_average(cn,bidx,float(len(psutil.net_connections())))
-        self.changed()
+                percents.append(percent)
+        return (cpu_percent,percents)
 
-        DataTable.refresh(self)
+    def memory( self ):
+        """ return a tuple (total,available) in bytes from /proc/meminfo """
+        total = 0
+        available = 0
+        for line in self.meminfo_file.read().split("\n"):
+            if line.startswith("MemTotal:"):
+                total = int(line.split()[1])*1024
+            elif line.startswith("MemAvailable:"):
+                available = int(line.split()[1])*1024
+                break
+        return (total,available)
+
+    def disk_io( self ):
+        """ return a dictionary of device name to a tuple (read_bytes,write_bytes,read_count,write_count) for every device in /proc/diskstats """
+        disks = {}
+        for line in self.diskstats_file.read().split("\n"):
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            disks[fields[2]] = (int(fields[5])*512,int(fields[9])*512,int(fields[3]),int(fields[7]))
+        return disks
+
+    def net_io( self ):
+        """ return a dictionary of interface name to a tuple (bytes_sent,bytes_recv,packets_sent,packets_recv) for every interface in /proc/net/dev """
+        nics = {}
+        for line in self.net_dev_file.read().split("\n")[2:]:
+            if ":" not in line:
+                continue
+            nic,counts = line.split(":",1)
+            fields = counts.split()
+            nics[nic.strip()] = (int(fields[8]),int(fields[0]),int(fields[9]),int(fields[1]))
+        return nics
+
+    def connections( self ):
+        """ return the number of inet sockets in use, including TIME_WAIT, from /proc/net/sockstat and /proc/net/sockstat6 """
+        count = 0
+        for sockstat_file in self.sockstat_files:
+            for line in sockstat_file.read().split("\n"):
+                protocol,_,counts = line.partition(":")
+                if protocol in ["TCP","UDP","TCP6","UDP6"]:
+                    fields = counts.split()
+                    for idx in range(0,len(fields)-1,2):
+                        if fields[idx] in ["inuse","tw"]:
+                            count += int(fields[idx+1])
+        return count
+
+    def disk_percent( self ):
+        """ return the percent full of the root filesystem computed the same way as psutil.disk_usage """
+        st = os.statvfs("/")
+        used = (st.f_blocks - st.f_bfree)*st.f_frsize
+        total_user = used + st.f_bavail*st.f_frsize
+        if not total_user:
+            return 0.0
+        return round(100.0*used/total_user,1)
+
+    def sample_values( self ):
+        """ return a tuple (values,counters) of lists of tuples (column name, value) for the current system metrics and cumulative counters """
+        values = []
+        counters = []
+        cpu_percent,percents = self.cpu_percents()
+        disks = self.disk_io() if "host" in self.metrics or "per_disk" in self.metrics else {}
+        nics = self.net_io() if "host" in self.metrics or "per_nic" in self.metrics else {}
+        if "host" in self.metrics:
+            disk_io = [0,0,0,0]
+            for disk,counts in disks.items():
+                if self.block_devices == None or disk in self.block_devices:
+                    disk_io = [a+b for a,b in zip(disk_io,counts)]
+            net_io = [0,0,0,0]
+            for counts in nics.values():
+                net_io = [a+b for a,b in zip(net_io,counts)]
+            host_v,host_c = host_values(
+                cpu_percent,
+                os.getloadavg()[2],
+                self.memory(),
+                self.disk_percent(),
+                disk_io,
+                net_io,
+                self.connections())
+            values += host_v
+            counters += host_c
+        if "per_cpu" in self.metrics:
+            values += cpu_values(percents)
+        if "per_disk" in self.metrics:
+            for disk,counts in disks.items():
+                counters += disk_counters(disk,counts)
+        if "per_nic" in self.metrics:
+            for nic,counts in nics.items():
+                counters += nic_counters(nic,counts)
+        return (values,counters)
+
+class ProcDataTable( SampledDataTable ):
+    """ class that collects a time based aggregation of data from system process information into a data_table """
+    def __init__(self,num_hours=24,bucket_hours=1,refresh_minutes=10,sample_seconds=0,proc_stats=None,proc_backend="psutil",proc_metrics=None,proc_top_n=10,proc_top_sort="cpu"):
+        """ Initialize the ProcDataTable to collect system process information, a timespan to aggregate for, aggregation bucket in hours, a refresh interval for updating in minutes,
+        an interval in seconds to sample on independent of the refresh, a list of extra statistics from min,max,last to add columns for, the backend
+        to sample with one of psutil or procfs, procfs reads /proc directly on Linux and falls back to psutil if /proc isn't available, a list of metric
+        sets to collect from host,per_cpu,per_disk,per_nic,top_processes defaulting to host, and for top_processes the number of processes and what to sort them by one of cpu or rss """
+        self.proc_metrics = proc_metrics if proc_metrics else ["host"]
+        self.proc_top_n = proc_top_n
+        self.proc_top_sort = proc_top_sort
+        sampler_metrics = [m for m in self.proc_metrics if m != "top_processes"]
+        if proc_backend == "procfs" and os.path.exists("/proc/stat"):
+            self.sampler = ProcfsSampler(sampler_metrics)
+        else:
+            self.sampler = PsutilSampler(sampler_metrics)
+        SampledDataTable.__init__(self,
+            "Proc Data: for the last %d hours in %d hour buckets, refreshed every %d minutes"%(
+            num_hours,
+            bucket_hours,
+            refresh_minutes),num_hours,bucket_hours,refresh_minutes,sample_seconds,proc_stats)
+        self.refresh()
+
+    def sample_values( self ):
+        """ return the current sample from the sampler """
+        return self.sampler.sample_values()
+
+    def top_processes( self ):
+        """ return a list of the top proc_top_n processes as tuples (pid,name,cpu_percent,rss) sorted by cpu or rss,
+        psutil.process_iter caches the Process objects between calls so the cpu percent is the usage since the last refresh
+        and only the requested attributes are read from /proc/<pid> """
+        processes = []
+        for p in psutil.process_iter(["pid","name","cpu_percent","memory_info"]):
+            memory_info = p.info["memory_info"]
+            processes.append((p.info["pid"],p.info["name"] or "",p.info["cpu_percent"] or 0.0,memory_info.rss if memory_info else 0))
+        if self.proc_top_sort == "rss":
+            processes.sort(key=lambda p: p[3],reverse=True)
+        else:
+            processes.sort(key=lambda p: p[2],reverse=True)
+        return processes[:self.proc_top_n]
+
+    def refresh( self ):
+        """ refresh the table, takes a sample if there is no sample thread running and updates the top processes """
+        if "top_processes" in self.proc_metrics:
+            pid_column = Column(name="Process PID")
+            name_column = Column(name="Process Name")
+            cpu_column = Column(name="Process CPU Percent")
+            rss_column = Column(name="Process RSS")
+            for pid,name,cpu_percent,rss in self.top_processes():
+                pid_column.put(pid_column.size(),Cell(int_type,pid,format_int))
+                name_column.put(name_column.size(),Cell(string_type,name,format_string))
+                cpu_column.put(cpu_column.size(),Cell(float_type,cpu_percent,format_float))
+                rss_column.put(rss_column.size(),Cell(int_type,rss,format_int))
+            with self.refresh_lock:
+                for c in [pid_column,name_column,cpu_column,rss_column]:
+                    if self.has_column(c.get_name()):
+                        self.replace_column(self.map_column(c.get_name()),c)
+                    else:
+                        self.add_column(c)
+        SampledDataTable.refresh(self)
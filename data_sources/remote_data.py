@@ -5,14 +5,17 @@ import os
 import re
 from datetime import datetime
 import threading
-import time
+import queue
+import struct
 import csv
 import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from paramiko.client import SSHClient
 import keyring
 from functools import wraps
-from data_sources.data_table import DataTable,Cell,Column,from_json,to_json,synchronized
+from data_sources.data_table import DataTable,Cell,Column,from_json,from_dict,to_json,to_binary,from_binary,to_columnar,from_columnar,synchronized
 from dashboard.version import __version__
 
 def sync_connection(method):
@@ -29,52 +32,175 @@ def sync_manager(method):
             return method(self, *args, **kwargs)
     return wrapper
 
+# versions of the table server protocol this package speaks, 1 is one request at a time with unframed responses,
+# 2 frames each request and response line with a request id so requests can be pipelined and answered out of order,
+# 3 is 2 with responses sent as length prefixed binary frames and tables in the compressed binary columnar format,
+# 4 is 3 with get:<name>:<since_version> answered with only the columns and rows that changed since that version,
+# 5 is 4 with subscribe:<name>:<since_version> where the server pushes a delta each time the table refreshes
+protocol_versions = [1,2,3,4,5]
+
+# where the dashboard is installed on the remote servers
+remote_dashboard = "~/.local/bin/dashboard"
+
+#   a delta of a table since a version is a dict { "version" : new version, "name" : table name, "refresh_minutes" : refresh interval, "reset" : True if every column is sent whole,
+#   "columns" : [ { "name" : column name } for an unchanged column or { "name", "evict" : k, "keep" : n, "append" : [ cells ] } to drop k rows from the front, keep the next n and append the cells ] }
+#   in a binary frame it is a 4 byte big endian length, the json of the delta without the cells, and the appended cells as the columns of a table in the binary columnar format,
+#   as text it is delta: followed by the json with the appended cells in the compact columnar json format
+
+def encode_delta( delta, compression="zlib" ):
+    """ return bytes with the binary encoding of a delta """
+    header = dict(delta)
+    header["columns"] = [ { k : v for k,v in c.items() if k != "append" } for c in delta["columns"] ]
+    cells = DataTable(name="delta")
+    for c in delta["columns"]:
+        if "keep" in c:
+            cells.add_column(Column(values=list(c["append"]),name=c["name"]))
+    header = json.dumps(header).encode("utf-8")
+    return struct.pack(">I",len(header))+header+to_binary([("delta",cells)],compression)
+
+def decode_delta( payload ):
+    """ return the delta dict decoded from bytes written by encode_delta """
+    length = struct.unpack(">I",payload[:4])[0]
+    delta = json.loads(payload[4:4+length].decode("utf-8"))
+    cells = from_binary(payload[4+length:])[0][1]
+    for c in delta["columns"]:
+        if "keep" in c:
+            c["append"] = cells.get_column(c["name"]).values
+    return delta
+
+def delta_json( delta ):
+    """ return the text encoding of a delta """
+    columns = []
+    for c in delta["columns"]:
+        column = dict(c)
+        if "append" in c:
+            column["append"] = to_columnar(c["append"])
+        columns.append(column)
+    return json.dumps(dict(delta,columns=columns))
+
+def read_exact( stream, length ):
+    """ read exactly length bytes from the binary stream, returns None if the stream ends first """
+    data = b""
+    while len(data) < length:
+        block = stream.read(length-len(data))
+        if not block:
+            return None
+        data += block
+    return data
+
 class Connection():
-    def __init__(self, owner=None, ssh_client=None, session=None, stdin=None, stdout=None, stderr=None ):
-        """ provides protocol to the table server """
+    def __init__(self, owner=None, ssh_client=None, session=None, stdin=None, stdout=None, stderr=None, timeout=300, compression="zlib" ):
+        """ provides protocol to the table server, stdin, stdout and stderr are the server's streams with stdout opened in binary mode,
+        responses are waited for for up to timeout seconds, binary tables are compressed with compression one of none, zlib or lzma """
         self.ssh_client = ssh_client
         self.session = session
         self.clients = []
-        self.stdout_lines = []
-        self.stderr_lines = []
+        self.stdout_lines = queue.Queue()
+        self.stderr_lines = queue.Queue()
         self.owner = owner
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.timeout = timeout
+        self.compression = compression
+        self.protocol = 1
+        self.request_id = 0
+        self.pending = {}
+        self.subscriptions = {}
+        self.push_executor = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
         self.connection_lock = threading.RLock()
-        self.reader_lock = threading.RLock()
+        self.request_lock = threading.RLock()
         self.stdout_reader_thread = threading.Thread(target=self.reader,args=(self.stdout,self.stdout_lines))
         self.stdout_reader_thread.start()
         self.stderr_reader_thread = threading.Thread(target=self.reader,args=(self.stderr,self.stderr_lines))
         self.stderr_reader_thread.start()
 
     def reader( self, stream, lines ):
-        """ worker thread that reads from stdout and pushes data onto stdout_lines and stderr_lines """
-        while not self.session.exit_status_ready():
-            line = stream.readline()
-            with self.reader_lock:
-                lines.append(line)
-
-        with self.reader_lock:
-            lines += stream.readlines()
+        """ worker thread that reads lines from stream and puts them on the queue lines until the stream is closed, then puts None to wake any waiting reader,
+        once the framed protocol is in use responses on stdout are put on the queue of the request they answer """
+        try:
+            while True:
+                if self.protocol >= 3 and lines is self.stdout_lines:
+                    header = read_exact(stream,9)
+                    if not header:
+                        break
+                    request_id,kind,length = struct.unpack(">IBI",header)
+                    payload = read_exact(stream,length)
+                    if payload == None:
+                        break
+                    if kind == 0:
+                        payload = payload.decode("utf-8")
+                    elif kind == 2:
+                        payload = decode_delta(payload)
+                    self.route(request_id,payload)
+                    continue
+
+                line = stream.readline()
+                if not line:
+                    break
+                if isinstance(line,bytes):
+                    line = line.decode("utf-8")
+                if lines is self.stdout_lines and line.startswith("protocol:"):
+                    # switch here so the next read after the reply uses the new framing
+                    self.protocol = int(line.strip().split(":",1)[1])
+                request_id,_,response_line = line.partition(" ")
+                if self.protocol >= 2 and lines is self.stdout_lines and request_id.isdigit():
+                    self.route(int(request_id),response_line)
+                else:
+                    lines.put(line)
+        finally:
+            lines.put(None)
+            with self.request_lock:
+                for response in self.pending.values():
+                    response.put(None)
+                if lines is self.stdout_lines:
+                    # tell the subscribers there will be no more pushes so they go back to polling
+                    self.closed = True
+                    for callback in self.subscriptions.values():
+                        self.push_executor.submit(self.deliver,callback,"error:connection closed")
+                    self.subscriptions = {}
+            if lines is self.stdout_lines:
+                self.push_executor.shutdown(wait=False)
+
+    def route( self, request_id, response ):
+        """ put a response on the queue of the request waiting for it, responses to a subscription are passed to its callback on the push thread
+        so a slow subscriber doesn't hold up the responses to everyone else, pushes are delivered one at a time in the order they arrived """
+        with self.request_lock:
+            waiting = self.pending.get(request_id)
+            callback = self.subscriptions.get(request_id)
+        if waiting:
+            waiting.put(response)
+        elif callback:
+            self.push_executor.submit(self.deliver,callback,response)
+
+    def deliver( self, callback, response ):
+        """ call a subscription callback with a push, a bad push must not stop the pushes to the other subscribers """
+        try:
+            callback(response)
+        except Exception:
+            pass
+
+    def get_line( self, lines ):
+        """ wait for the next line on the queue lines, raises an exception if the server closed the stream or didn't respond in time """
+        try:
+            line = lines.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Exception("Timed out waiting for the remote dashboard")
+        if line == None:
+            # leave the marker for the next caller
+            lines.put(None)
+            raise Exception("Remote dashboard connection closed")
+        return line
 
     @sync_connection
     def get_stdout_line( self ):
         """ fetch a line from the queue of stdout_lines """
-        while True:
-            with self.reader_lock:
-                if len(self.stdout_lines):
-                    return self.stdout_lines.pop(0)
-            time.sleep(1)
+        return self.get_line(self.stdout_lines)
 
-    @sync_connection
     def get_stderr_line( self ):
         """ fetch a line from the queue of stderr_lines """
-        while True:
-            with self.reader_lock:
-                if len(self.stderr_lines):
-                    return self.stderr_lines.pop(0)
-            time.sleep(1)
+        return self.get_line(self.stderr_lines)
 
     @sync_connection
     def open( self, client ):
@@ -83,29 +209,121 @@ class Connection():
             self.clients.append(client)
 
     @sync_connection
+    def negotiate(self, protocol):
+        """ ask the server to switch to the protocol version, returns the version the server agreed to """
+        if protocol >= 3:
+            print("protocol:%d:%s"%(protocol,self.compression),file=self.stdin,flush=True)
+        else:
+            print("protocol:%d"%protocol,file=self.stdin,flush=True)
+        self.get_stdout_line()
+        return self.protocol
+
+    def request(self, command):
+        """ send a command to the server and wait for its response, with the framed protocol many requests can be outstanding at once """
+        if self.protocol < 2:
+            with self.connection_lock:
+                print(command,file=self.stdin,flush=True)
+                return self.get_stdout_line()
+
+        response = queue.Queue()
+        with self.request_lock:
+            self.request_id += 1
+            request_id = self.request_id
+            self.pending[request_id] = response
+            print("%d %s"%(request_id,command),file=self.stdin,flush=True)
+        try:
+            line = self.get_line(response)
+        finally:
+            with self.request_lock:
+                del self.pending[request_id]
+        if isinstance(line,str) and line.startswith("error:"):
+            raise Exception("Remote dashboard error",line.strip())
+        return line
+
     def table(self, table_def):
         """ send request to create a new remote table, returns loaded response """
-        print("table:%s"%table_def,file=self.stdin,flush=True)
-        return self.get_stdout_line()
+        return self.request("table:%s"%table_def)
 
-    @sync_connection
     def refresh(self, table_name):
-        """ send request to refresh a remote table named table_name and return response """
-        print("refresh:%s"%table_name,file=self.stdin,flush=True)
-        return self.get_stdout_line()
+        """ send request to refresh a remote table named table_name and return response, with protocol 3 the response is the binary encoded table """
+        return self.request("refresh:%s"%table_name)
 
-    @sync_connection
     def get(self, table_name):
-        """ send request to fetch table_name and return response """
-        print("get:%s"%table_name,file=self.stdin,flush=True)
-        return self.get_stdout_line()
+        """ send request to fetch table_name and return response, with protocol 3 the response is the binary encoded table """
+        return self.request("get:%s"%table_name)
+
+    def decode_table(self, response):
+        """ return the DataTable in a get or refresh response """
+        if isinstance(response,bytes):
+            return from_binary(response)[0][1]
+        name,json_blob = response.split(":",1)
+        return from_json(StringIO(json_blob))
+
+    def get_table(self, table_name):
+        """ fetch table_name and return it as a DataTable """
+        return self.decode_table(self.get(table_name))
+
+    def get_delta(self, table_name, since):
+        """ fetch the changes to table_name since the version since and return the delta dict, see the format above, 0 fetches everything """
+        return self.decode_delta(self.request("get:%s:%d"%(table_name,since)))
+
+    def decode_delta(self, response):
+        """ return the delta dict in a get or subscribe response, binary frames are already decoded by the reader """
+        if isinstance(response,dict):
+            return response
+        delta = json.loads(response.split(":",1)[1])
+        for c in delta["columns"]:
+            if "append" in c:
+                c["append"] = from_columnar(c["append"])
+        return delta
+
+    def subscribe(self, table_name, since, callback):
+        """ ask the server to push the changes to table_name since the version since, callback is called on the push thread with each delta,
+        or with an error: response if the subscription failed or the connection closed, returns the subscription id """
+        with self.request_lock:
+            self.request_id += 1
+            request_id = self.request_id
+            self.subscriptions[request_id] = callback
+            print("%d subscribe:%s:%d"%(request_id,table_name,since),file=self.stdin,flush=True)
+        return request_id
+
+    def unsubscribe(self, subscription):
+        """ stop the pushes for the subscription id returned by subscribe """
+        with self.request_lock:
+            self.subscriptions.pop(subscription,None)
+        return self.request("unsubscribe:%d"%subscription)
+
+    def refresh_table(self, table_name):
+        """ refresh table_name and return it as a DataTable """
+        return self.decode_table(self.refresh(table_name))
+
+    def get_many(self, table_names):
+        """ send request to fetch all of the tables in the list table_names in one response, returns a dictionary of table name to DataTable """
+        response = self.request("get_many:%s"%json.dumps(table_names))
+        if isinstance(response,bytes):
+            return dict(from_binary(response))
+        tables = json.loads(response.split(":",1)[1])
+        return { name : from_dict(tables[name]) for name in tables }
 
-    @sync_connection
     def exit(self):
         """ terminate the server and clean up this connection """
-        print("exit",file=self.stdin,flush=True)
+        with self.request_lock:
+            if self.protocol < 2:
+                print("exit",file=self.stdin,flush=True)
+            else:
+                self.request_id += 1
+                print("%d exit"%self.request_id,file=self.stdin,flush=True)
         return ""
 
+    def disconnect(self):
+        """ close the streams to a server that didn't start properly without asking it to exit, the reader threads end when its output closes """
+        for stream in [self.stdin,self.session]:
+            if stream:
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+
     @sync_connection
     def close(self,client):
         """ close this client's use of this connection """
@@ -113,9 +331,19 @@ class Connection():
             self.clients.remove(client)
 
 class ConnectionManager():
-    def __init__(self):
-        """ manages connections to servers and their initial setup """
+    def __init__(self,cache_path="~/.dashboard/remote_hosts.json"):
+        """ manages connections to servers and their initial setup, connections to different servers are set up in parallel,
+        hosts that passed the version check are remembered in the json file cache_path so the check isn't repeated on restart, None turns this off """
         self.connections = {}
+        self.connect_locks = {}
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else None
+        self.host_cache = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path,"r") as cache_file:
+                    self.host_cache = json.load(cache_file)
+            except (OSError,ValueError):
+                self.host_cache = {}
         self.manager_lock = threading.RLock()
 
     def __del__(self):
@@ -130,14 +358,45 @@ class ConnectionManager():
             self.connections[cn].ssh_client.close()
         self.connections = {}
 
-    @sync_manager
     def connect(self,ssh_spec,client):
-        """ create a connection to a server """
-        if ssh_spec in self.connections:
-            connection = self.connections[ssh_spec]
+        """ create a connection to a server or return the one already open, only connects to the same server wait for each other """
+        with self.manager_lock:
+            connection = self.connections.get(ssh_spec)
+            connect_lock = self.connect_locks.setdefault(ssh_spec,threading.Lock())
+        if not connection or connection.closed:
+            with connect_lock:
+                with self.manager_lock:
+                    connection = self.connections.get(ssh_spec)
+                if not connection or connection.closed:
+                    connection = self.open_connection(ssh_spec)
+                    if not connection:
+                        return None
+                    with self.manager_lock:
+                        self.connections[ssh_spec] = connection
+        if client != None:
             connection.open(client)
-            return connection
-
+        return connection
+
+    def connect_all(self,ssh_specs):
+        """ connect to all of the servers in the list ssh_specs in parallel, returns a dictionary of ssh_spec to connection for the ones that succeeded,
+        failures are left for the table that uses the server to report when it connects """
+        connections = {}
+        ssh_specs = list(dict.fromkeys(ssh_specs))
+        if not ssh_specs:
+            return connections
+        with ThreadPoolExecutor(max_workers=min(16,len(ssh_specs))) as executor:
+            futures = [ (ssh_spec,executor.submit(self.connect,ssh_spec,None)) for ssh_spec in ssh_specs ]
+        for ssh_spec,future in futures:
+            try:
+                connection = future.result()
+            except Exception:
+                continue
+            if connection:
+                connections[ssh_spec] = connection
+        return connections
+
+    def open_connection(self,ssh_spec):
+        """ log in to the server, set up the dashboard there unless the host is cached and start the table server, returns the connection or None if there is no password for the server """
         username,server,port = re.match(r"ssh://([a-z_][a-z0-9_-]*\${0,1})@([^:]*):{0,1}(\d*){0,1}",ssh_spec).groups()
 
         password = keyring.get_password(server,username)
@@ -154,27 +413,78 @@ class ConnectionManager():
                 pass
         ssh_client.connect( hostname=server, port=int(port if port else 22), username=username, password=password)
 
-        if self.setup( ssh_client ):
-            session,stdin,stdout,stderror = self.start_command(ssh_client,"~/.local/bin/dashboard --server")
-            connection = Connection(self,ssh_client,session,stdin,stdout,stderror)
-            connection.open(client)
-            self.connections[ssh_spec] = connection
+        try:
+            host = "%s@%s:%s"%(username,server,port if port else 22)
+            protocol = self.cached_protocol(host)
+            if protocol:
+                try:
+                    connection = self.start_server(ssh_client,protocol)
+                except Exception:
+                    connection = None
+                if not connection or connection.protocol != protocol:
+                    # the remote dashboard changed since it was checked, forget it so it is checked again
+                    self.cache_host(host,None)
+                if connection:
+                    return connection
+
+            protocol = self.setup( ssh_client )
+            if not protocol:
+                raise Exception("Setup of remote dashboard failed")
+            connection = self.start_server(ssh_client,protocol)
+            # a protocol 1 server can't be told apart from a missing one when it starts, so only framed servers are cached
+            if connection.protocol >= 2:
+                self.cache_host(host,connection.protocol)
             return connection
+        except:
+            ssh_client.close()
+            raise
+
+    def start_server(self, ssh_client, protocol):
+        """ start the remote table server and switch it to the protocol version, returns the connection to it, a server that fails to start is disconnected before the error is raised """
+        session,stdin,stdout,stderror = self.start_command(ssh_client,"%s --server"%remote_dashboard,True)
+        connection = Connection(self,ssh_client,session,stdin,stdout,stderror)
+        if protocol >= 2:
+            try:
+                connection.negotiate(protocol)
+            except Exception:
+                connection.disconnect()
+                raise
+        return connection
 
-        raise Exception("Setup of remote dashboard failed")
+    @sync_manager
+    def cached_protocol(self, host):
+        """ return the protocol version the host was set up with if it passed the version check for this version and path of the dashboard, otherwise None """
+        cached = self.host_cache.get(host)
+        if cached and cached.get("version") == __version__ and cached.get("path") == remote_dashboard:
+            return cached.get("protocol")
+        return None
 
     @sync_manager
-    def start_command(self, ssh_client, command ):
-        """ start a command and return a tuple with (channel,stdin,stdout,stderr) for running process """
+    def cache_host(self, host, protocol):
+        """ remember that host passed the version check and speaks protocol, None forgets the host, the cache file is replaced atomically """
+        if protocol:
+            self.host_cache[host] = { "version" : __version__, "path" : remote_dashboard, "protocol" : protocol }
+        else:
+            self.host_cache.pop(host,None)
+        if not self.cache_path:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        os.makedirs(cache_dir,exist_ok=True)
+        fd,temp_path = tempfile.mkstemp(dir=cache_dir,prefix=".remote_hosts_")
+        with os.fdopen(fd,"w") as cache_file:
+            json.dump(self.host_cache,cache_file)
+        os.replace(temp_path,self.cache_path)
+
+    def start_command(self, ssh_client, command, binary=False ):
+        """ start a command and return a tuple with (channel,stdin,stdout,stderr) for running process, if binary is True stdout is opened in binary mode """
         transport = ssh_client.get_transport()
         session = transport.open_session()
         session.exec_command(command)
-        stdout = session.makefile("r",1)
+        stdout = session.makefile("rb" if binary else "r",1)
         stderr = session.makefile_stderr("r",1)
         stdin = session.makefile_stdin("w",1)
         return (session,stdin,stdout,stderr)
 
-    @sync_manager
     def run_command(self, ssh_client, command ):
         """ run a command wait for it to exit and return the output (retcode,stdout_str,stderr_str) """
         session,stdin,stdout,stderr = self.start_command(ssh_client,command)
@@ -189,20 +499,26 @@ class ConnectionManager():
         exit_status = session.recv_exit_status()
         return (exit_status,stdout_output.getvalue(),stderr_output.getvalue())
 
-    @sync_manager
     def setup(self, ssh_client ):
-        """ check to see that dashboard is installed and install it if needed """
-        exit_status,stdout_str,stderr_str = self.run_command(ssh_client,"~/.local/bin/dashboard --version")
+        """ check to see that dashboard is installed and install it if needed, returns the newest protocol version both sides speak """
+        exit_status,stdout_str,stderr_str = self.run_command(ssh_client,"%s --version"%remote_dashboard)
         stdout_str = stdout_str.strip()
-        if stdout_str.startswith("dashboard version"):
-            if stdout_str.endswith(__version__):
-                return True
+        if not (stdout_str.startswith("dashboard version") and stdout_str.endswith(__version__)):
+            exit_status,stdout_str,stderr_str = self.run_command(ssh_client,'python3 -m pip install --upgrade "terminal-dashboard==%s"'%(__version__))
+            if exit_status:
+                raise Exception(exit_status,stdout_str,stderr_str)
 
-        exit_status,stdout_str,stderr_str = self.run_command(ssh_client,'python3 -m pip install --upgrade "terminal-dashboard==%s"'%(__version__))
-        if exit_status:
-            raise Exception(exit_status,stdout_str,stderr_str)
+        return self.negotiate_protocol( ssh_client )
 
-        return True
+    def negotiate_protocol(self, ssh_client ):
+        """ ask the remote dashboard which protocol versions it speaks and return the newest one we share, servers that don't know --protocol only speak version 1 """
+        exit_status,stdout_str,stderr_str = self.run_command(ssh_client,"%s --protocol"%remote_dashboard)
+        stdout_str = stdout_str.strip()
+        if exit_status or not stdout_str.startswith("dashboard protocol"):
+            return 1
+        remote_versions = [int(v) for v in stdout_str[len("dashboard protocol"):].strip().split(",") if v.strip().isdigit()]
+        shared = [v for v in protocol_versions if v in remote_versions]
+        return max(shared) if shared else 1
 
 
 _connection_manager = None
@@ -227,11 +543,13 @@ class RemoteDataTable( DataTable ):
         self.ssh_spec = ssh_spec
         self.table_def = table_def
         self.connection = None
+        self.remote_version = 0
+        self.subscription = None
         self.refresh()
 
     @synchronized
     def refresh(self):
-        """ create a connection to the remote dashboard table server and refresh our internal state """
+        """ create a connection to the remote dashboard table server and refresh our internal state, once subscribed to pushes from the server there is nothing to poll for """
 
         if not self.connection:
             cm = get_connection_manager()
@@ -243,13 +561,56 @@ class RemoteDataTable( DataTable ):
             if not response.startswith("loaded:%s"%self.table_def["name"]):
                 return
 
-        table_data = self.connection.get(self.table_def["name"])
-        name,json_blob = table_data.split(":",1)
-        dt = from_json(StringIO(json_blob))
+        if self.subscription != None:
+            return
+
+        if self.connection.protocol >= 4:
+            self.apply_delta(self.connection.get_delta(self.table_def["name"],self.remote_version))
+        else:
+            dt = self.connection.get_table(self.table_def["name"])
 
-        rows,cols = dt.get_bounds()
-        for idx in range(cols):
-            self.replace_column(idx,dt.get_column(idx))
+            rows,cols = dt.get_bounds()
+            for idx in range(cols):
+                self.replace_column(idx,dt.get_column(idx))
 
         self.changed()
         DataTable.refresh(self)
+
+        if self.connection.protocol >= 5:
+            self.subscription = self.connection.subscribe(self.table_def["name"],self.remote_version,self.push)
+
+    @synchronized
+    def push(self, response):
+        """ apply a delta pushed by the server, called on the connection's push thread, if the subscription failed go back to polling,
+        if the connection closed the next refresh connects again """
+        if not isinstance(response,dict) and not (isinstance(response,str) and response.startswith("delta:")):
+            self.subscription = None
+            if self.connection.closed:
+                self.connection = None
+            return
+        self.apply_delta(self.connection.decode_delta(response))
+        self.changed()
+        DataTable.refresh(self)
+
+    @synchronized
+    def apply_delta(self, delta):
+        """ apply a delta from the table server in place, unchanged columns are kept, rows are evicted from the front, kept and appended to in the existing columns,
+        if a column the delta expects isn't here the next refresh asks for everything again """
+        columns = []
+        missing = False
+        for dc in delta["columns"]:
+            column = None if delta["reset"] else self.cnames.get(dc["name"])
+            if column == None:
+                column = Column(name=dc["name"])
+                missing = missing or dc.get("keep",1) != 0
+            if "keep" in dc:
+                del column.values[dc["evict"]+dc["keep"]:]
+                del column.values[:dc["evict"]]
+                column.values.extend(dc["append"])
+            columns.append(column)
+        if columns != self.columns:
+            self.columns = []
+            self.cnames = {}
+            for idx in range(len(columns)):
+                self.replace_column(idx,columns[idx])
+        self.remote_version = 0 if missing else delta["version"]
@@ -7,28 +7,53 @@ import os
 import glob
 import gzip
 import re
+import json
+import bisect
+import hashlib
 from datetime import datetime,timedelta
 from data_sources.data_table import DataTable,Column,Cell,blank_type,string_type,float_type,int_type,date_type,format_string,format_float,format_date,format_int,synchronized
 
 class SyslogDataTable( DataTable ):
     """ class that collects a time based aggregation of data from the syslog into a data_table """
-    def __init__(self,syslog_glob="/var/log/syslog*",num_hours=24,bucket_hours=1,refresh_minutes=10,start_time=None):
-        """ Initialize the SyslogDataTable with a file glob pattern to collect the syslogs on this machine, a timespan to aggregate for, aggregation bucket in hours, a refresh interval for updating in minutes """
+    def __init__(self,syslog_glob="/var/log/syslog*",num_hours=24,bucket_hours=1,refresh_minutes=10,start_time=None,state_dir=None,checkpoint_minutes=5):
+        """ Initialize the SyslogDataTable with a file glob pattern to collect the syslogs on this machine, a timespan to aggregate for, aggregation bucket in hours, a refresh interval for updating in minutes, if state_dir is provided the counts and file offsets are checkpointed there every checkpoint_minutes and on shutdown and reloaded on startup """
         self.syslog_glob = syslog_glob
         self.num_hours = num_hours
         self.bucket_hours = bucket_hours
         self.start_time = start_time
+        # map of a fingerprint of the first line of each log file to the byte offset parsed up to, follows files across rotation and compression
+        self.file_map = {}
+        # map of (log timestamp, service) to [messages, errors, warnings] counts within the time window
+        self.counts = {}
         DataTable.__init__(self,None,
             "Syslog Data: %s for the last %d hours in %d hour buckets, refreshed every %d minutes"%(
             self.syslog_glob,
             self.num_hours,
             self.bucket_hours,
             refresh_minutes),refresh_minutes)
+        if state_dir:
+            self.set_checkpoint(state_dir,json.dumps([self.syslog_glob,self.num_hours,self.bucket_hours]),checkpoint_minutes)
+            self.load_checkpoint()
         self.refresh()
 
+    def get_checkpoint( self ):
+        """ return a copy of the file offsets and counts as a json serializable checkpoint """
+        counts = []
+        for (log_datetime,log_process),(messages,errors,warnings) in self.counts.items():
+            counts.append([log_datetime.timestamp(),log_process,messages,errors,warnings])
+        return { "file_map" : dict(self.file_map), "counts" : counts }
+
+    def put_checkpoint( self, checkpoint ):
+        """ restore the file offsets and counts from a checkpoint """
+        counts = {}
+        for timestamp,log_process,messages,errors,warnings in checkpoint["counts"]:
+            counts[(datetime.fromtimestamp(timestamp),log_process)] = [messages,errors,warnings]
+        self.file_map = dict(checkpoint["file_map"])
+        self.counts = counts
+
     @synchronized
     def refresh( self ):
-        """ refresh or rebuild tables """
+        """ refresh or rebuild tables, only the lines added to the logs since the last refresh are parsed """
         if self.start_time:
             year,month,day,hour,minute,second = self.start_time
             current_time = datetime(year,month,day,hour,minute,second)
@@ -37,6 +62,59 @@ class SyslogDataTable( DataTable ):
         start_time = current_time - timedelta( hours = self.num_hours )
         syslog_files = glob.glob(self.syslog_glob)
 
+        line_re = re.compile(r"(\w\w\w\s+\d+\s\d\d:\d\d:\d\d)\s[a-z0-9\-]*\s([a-zA-Z0-9\-\_\.]*)[\[\]0-9]*:\s*(.*)")
+        error_re = re.compile(r"[Ee]rror|ERROR")
+        warning_re = re.compile(r"[Ww]arning|WARNING")
+
+        file_map = {}
+        for slf in syslog_files:
+            if os.stat(slf).st_mtime < start_time.timestamp():
+                continue
+
+            if slf.endswith(".gz"):
+                slf_f = gzip.open(slf,"rb")
+            else:
+                slf_f = open(slf,"rb")
+
+            with slf_f:
+                first_line = slf_f.readline()
+                if not first_line.endswith(b"\n"):
+                    continue
+                fingerprint = hashlib.sha1(first_line).hexdigest()
+                offset = self.file_map.get(fingerprint,0)
+                slf_f.seek(offset,0)
+
+                while True:
+                    raw_line = slf_f.readline()
+                    if not raw_line.endswith(b"\n"):
+                        break
+                    offset += len(raw_line)
+                    line = raw_line.decode("utf-8",errors="replace").strip()
+                    m = line_re.match(line)
+                    if m:
+                        log_date = re.sub(r"\s+"," ","%d "%current_time.year + m.group(1))
+                        log_process = m.group(2)
+                        log_message = m.group(3)
+                        log_datetime = datetime.strptime(log_date,"%Y %b %d %H:%M:%S")
+                        if log_datetime < start_time:
+                            continue
+                        is_error = error_re.search(log_message)
+                        is_warning = warning_re.search(log_message)
+                        key = (log_datetime,log_process)
+                        if key not in self.counts:
+                            self.counts[key] = [0,0,0]
+                        counts = self.counts[key]
+                        counts[0] += 1
+                        if is_error and not is_warning:
+                            counts[1] += 1
+                        elif is_warning:
+                            counts[2] += 1
+                file_map[fingerprint] = offset
+        self.file_map = file_map
+
+        for key in [k for k in self.counts if k[0] < start_time]:
+            del self.counts[key]
+
         time_column = Column(name="Time Stamps")
         bucket_time = start_time
         idx = 0
@@ -45,16 +123,12 @@ class SyslogDataTable( DataTable ):
             bucket_time = bucket_time + timedelta( hours = self.bucket_hours )
             idx += 1
         time_column.put(idx,Cell(date_type,current_time,format_date))
+        bucket_times = [c.get_value() for c in time_column.values]
 
         def bucket_idx( timestamp ):
             if timestamp < start_time or timestamp > current_time:
                 return -1
-
-            for idx in range(time_column.size()):
-                if time_column.get(idx).get_value() >= timestamp:
-                    return idx
-            else:
-                return -1
+            return bisect.bisect_left(bucket_times,timestamp)
 
         errors_column = Column(name="Errors by Time")
         warnings_column = Column(name="Warnings by Time")
@@ -65,12 +139,9 @@ class SyslogDataTable( DataTable ):
         warnings_service_column = Column(name="Warnings by Service")
         messages_service_column = Column(name="Messages by Service")
 
+        service_map = {}
         def service_idx( service ):
-            for idx in range(services_column.size()):
-                if services_column.get(idx).get_value() == service:
-                    return idx
-            else:
-                return -1
+            return service_map.get(service,-1)
 
         def put_or_sum( column, idx, value ):
             current_value = 0
@@ -80,41 +151,20 @@ class SyslogDataTable( DataTable ):
                     current_value = int(c.get_value())
             column.put(idx,Cell(int_type,current_value+value,format_int))
 
-
-        for slf in syslog_files:
-            if slf.endswith(".gz"):
-                slf_f = gzip.open(slf,"rt",encoding="utf-8")
-            else:
-                slf_f = open(slf,"r",encoding="utf-8")
-
-            for line in slf_f:
-                line = line.strip()
-                m = re.match(r"(\w\w\w\s+\d+\s\d\d:\d\d:\d\d)\s[a-z0-9\-]*\s([a-zA-Z0-9\-\_\.]*)[\[\]0-9]*:\s*(.*)",line)
-                if m:
-                    log_date = re.sub(r"\s+"," ","%d "%current_time.year + m.group(1))
-                    log_process = m.group(2)
-                    log_message = m.group(3)
-                    log_datetime = datetime.strptime(log_date,"%Y %b %d %H:%M:%S")
-                    b_idx = bucket_idx( log_datetime )
-                    if b_idx >= 0:
-                        s_idx = service_idx( log_process )
-                        if s_idx < 0:
-                            s_idx = services_column.size()
-                            services_column.put(s_idx,Cell(string_type,log_process,format_string))
-                        put_or_sum(messages_column,b_idx,1)
-                        put_or_sum(messages_service_column,s_idx,1)
-                        is_error = re.search(r"[Ee]rror|ERROR",log_message)
-                        is_warning = re.search(r"[Ww]arning|WARNING",log_message)
-                        error_count = 0
-                        warning_count = 0
-                        if is_error and not is_warning:
-                            error_count = 1
-                        elif is_warning:
-                            warning_count = 1
-                        put_or_sum(errors_column,b_idx,error_count)
-                        put_or_sum(errors_service_column,s_idx,error_count)
-                        put_or_sum(warnings_column,b_idx,warning_count)
-                        put_or_sum(warnings_service_column,s_idx,warning_count)
+        for (log_datetime,log_process),(message_count,error_count,warning_count) in self.counts.items():
+            b_idx = bucket_idx( log_datetime )
+            if b_idx >= 0:
+                s_idx = service_idx( log_process )
+                if s_idx < 0:
+                    s_idx = services_column.size()
+                    services_column.put(s_idx,Cell(string_type,log_process,format_string))
+                    service_map[log_process] = s_idx
+                put_or_sum(messages_column,b_idx,message_count)
+                put_or_sum(messages_service_column,s_idx,message_count)
+                put_or_sum(errors_column,b_idx,error_count)
+                put_or_sum(errors_service_column,s_idx,error_count)
+                put_or_sum(warnings_column,b_idx,warning_count)
+                put_or_sum(warnings_service_column,s_idx,warning_count)
 
         columns = [time_column,errors_column,warnings_column,messages_column,services_column,
                     errors_service_column,warnings_service_column,messages_service_column]
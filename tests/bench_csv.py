@@ -0,0 +1,73 @@
+# Copyright 2020 James P Goodwin data table package to manage sparse columnar data
+""" benchmark of from_csv loading 4 mapped columns out of a 40 column csv file compared to the previous row at a time DictReader parser, run with PYTHONPATH=. python3 tests/bench_csv.py [rows] """
+import sys
+import os
+import csv
+import time
+import tempfile
+from data_sources.data_table import DataTable,Column,Cell,blank_cell,string_type,float_type,int_type,format_string,format_float,from_csv
+
+def dictreader_from_csv( stream, name=None, field_map=None ):
+    """ the previous from_csv parser reduced to the string, int and float types, kept here as the baseline """
+    dt = None
+    dr = csv.DictReader(stream)
+    for drr in dr:
+        for drc in drr:
+            if not dt:
+                dt = DataTable(name=name)
+            dtc = None
+            dtt = None
+            for fm in field_map:
+                if drc == fm[0]:
+                    dtc = fm[1]
+                    dtt = fm[2]
+                    break
+            if dtc and dtt:
+                if not dt.has_column(dtc):
+                    dt.add_column(Column(name=dtc))
+                dtcc = dt.get_column(dtc)
+                drv = drr[drc]
+                if drv and dtt == string_type:
+                    cc = Cell(string_type,drv,format_string)
+                elif drv and dtt == float_type:
+                    cc = Cell(float_type,float(drv),format_float)
+                elif drv and dtt == int_type:
+                    cc = Cell(int_type,int(drv),format_float)
+                else:
+                    cc = blank_cell
+                dtcc.put(dtcc.size(),cc)
+    return dt
+
+def write_csv( path, rows, columns ):
+    """ write a csv file with rows rows of columns int, float and string columns """
+    with open(path,"w",newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["field_%d"%idx for idx in range(columns)])
+        for ridx in range(rows):
+            writer.writerow([ (ridx+idx if idx%3 == 0 else (ridx*0.5 if idx%3 == 1 else "value_%d"%idx)) for idx in range(columns)])
+
+def bench_parser( parser, path, field_map ):
+    """ parse the file with parser and return (seconds,rows) """
+    start_time = time.perf_counter()
+    with open(path,"r") as f:
+        dt = parser(f,"Benchmark",field_map)
+    return (time.perf_counter()-start_time,dt.get_bounds()[0])
+
+def main( rows ):
+    field_map = [["field_0","Int","_int"],["field_1","Float","_float"],["field_2","String","_string"],["field_39","Last","_int"]]
+    fd,path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        write_csv(path,rows,40)
+        old_time,old_rows = bench_parser(dictreader_from_csv,path,field_map)
+        new_time,new_rows = bench_parser(from_csv,path,field_map)
+    finally:
+        os.remove(path)
+    assert old_rows == new_rows == rows
+    print("DictReader from_csv: %10.2f sec for %d rows"%(old_time,rows))
+    print("column wise from_csv:%10.2f sec for %d rows"%(new_time,rows))
+    print("speedup:             %10.1fx"%(old_time/new_time))
+    return 0
+
+if __name__ == '__main__':
+    exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000))
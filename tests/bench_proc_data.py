@@ -0,0 +1,24 @@
+# Copyright 2020 James P Goodwin data table package to manage sparse columnar data
+""" benchmark comparing the per sample cost of the psutil and procfs samplers for ProcDataTable, run with PYTHONPATH=. python3 tests/bench_proc_data.py [samples] """
+import sys
+import time
+from data_sources.proc_data import PsutilSampler,ProcfsSampler
+
+def bench_sampler( sampler, samples ):
+    """ take samples with sampler and return the average seconds per sample """
+    sampler.sample_values()
+    start_time = time.perf_counter()
+    for idx in range(samples):
+        sampler.sample_values()
+    return (time.perf_counter()-start_time)/samples
+
+def main( samples ):
+    psutil_time = bench_sampler( PsutilSampler(), samples )
+    procfs_time = bench_sampler( ProcfsSampler(), samples )
+    print("psutil sampler: %10.1f usec per sample"%(psutil_time*1000000))
+    print("procfs sampler: %10.1f usec per sample"%(procfs_time*1000000))
+    print("speedup:        %10.1fx"%(psutil_time/procfs_time))
+    return 0
+
+if __name__ == '__main__':
+    exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
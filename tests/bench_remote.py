@@ -0,0 +1,55 @@
+# Copyright 2020 James P Goodwin data table package to manage sparse columnar data
+""" benchmark of the round trip latency of the remote table protocol against a table server running in a local subprocess, for each protocol version, run with PYTHONPATH=. python3 tests/bench_remote.py [requests] """
+import sys
+import os
+import json
+import time
+import subprocess
+import io
+from data_sources.remote_data import Connection
+
+def start_server():
+    """ start dashboard --server in a subprocess and return (process,connection) """
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = top+os.pathsep+env.get("PYTHONPATH","")
+    process = subprocess.Popen([sys.executable,os.path.join(top,"scripts","dashboard"),"--server"],
+        stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env)
+    return (process,Connection(None,None,None,io.TextIOWrapper(process.stdin,line_buffering=True),process.stdout,io.TextIOWrapper(process.stderr),30))
+
+def bench_protocol( protocol, table_def, requests ):
+    """ run requests gets of the table over the protocol version and print the latency and size of the responses """
+    process,connection = start_server()
+    try:
+        connection.negotiate(protocol)
+        start_time = time.perf_counter()
+        response = connection.table(json.dumps(table_def))
+        assert response.startswith("loaded:bench"), response
+        load_time = time.perf_counter()-start_time
+
+        latencies = []
+        for idx in range(requests):
+            start_time = time.perf_counter()
+            response = connection.get("bench")
+            dt = connection.decode_table(response)
+            latencies.append(time.perf_counter()-start_time)
+        latencies.sort()
+        print("protocol %d"%protocol)
+        print("    table load:  %10.2f msec"%(load_time*1000))
+        print("    get mean:    %10.2f msec"%(sum(latencies)/len(latencies)*1000))
+        print("    get median:  %10.2f msec"%(latencies[len(latencies)//2]*1000))
+        print("    get max:     %10.2f msec"%(latencies[-1]*1000))
+        print("    get size:    %10d bytes"%len(response))
+    finally:
+        connection.exit()
+        process.wait()
+
+def main( requests ):
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    table_def = { "name" : "bench", "type" : "CSVDataTable", "refresh_minutes" : 1, "csv_spec" : os.path.join(top,"tests","data","test_csv.csv") }
+    for protocol in [1,2,3]:
+        bench_protocol( protocol, table_def, requests )
+    return 0
+
+if __name__ == '__main__':
+    exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100))
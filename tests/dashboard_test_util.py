@@ -5,12 +5,18 @@ import re
 import os
 import sys
 import subprocess
+import io
 from io import StringIO,BytesIO
 import pytest
 import pyodbc
 import os
 import shutil
 import random
+import json
+import threading
+import sqlite3
+from collections import namedtuple
+from http.server import HTTPServer,BaseHTTPRequestHandler
 from datetime import datetime,timedelta
 import keyring
 from elasticsearch import Elasticsearch
@@ -272,3 +278,193 @@ def dt_testdir(request,testdir):
             "ssh_path": ssh_path,
             "snapshot_path": snapshot_path,
             "testdir" : testdir }
+
+
+class ESStubHandler(BaseHTTPRequestHandler):
+    """ minimal stand in for an elasticsearch server, answers every search with the canned response on the server or the result of calling it with the query body """
+    protocol_version = "HTTP/1.1"
+
+    def send_json( self, response ):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type","application/json")
+        self.send_header("X-Elastic-Product","Elasticsearch")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request( self ):
+        length = int(self.headers.get("Content-Length",0))
+        body = self.rfile.read(length) if length else b""
+        self.server.requests.append((self.command,self.path,body))
+        self.server.connections.add(self.client_address)
+        if "_pit" in self.path:
+            if self.command == "DELETE":
+                self.send_json({"succeeded":True,"num_freed":1})
+            else:
+                self.send_json({"id":"stub_pit"})
+        elif "_msearch" in self.path:
+            lines = [ json.loads(line) for line in body.decode("utf-8").split("\n") if line.strip() ]
+            responses = []
+            for query in lines[1::2]:
+                response = self.server.search_response
+                responses.append(response(query) if callable(response) else response)
+            self.send_json({"took":1,"responses":responses})
+        elif "_search" in self.path:
+            response = self.server.search_response
+            if callable(response):
+                response = response(json.loads(body) if body else {})
+            self.send_json(response)
+        else:
+            self.send_json({"version":{"number":"7.17.0","build_flavor":"default"},"tagline":"You Know, for Search"})
+
+    def do_GET( self ):
+        self.handle_request()
+
+    def do_POST( self ):
+        self.handle_request()
+
+    def do_HEAD( self ):
+        self.handle_request()
+
+    def do_DELETE( self ):
+        self.handle_request()
+
+    def log_message( self, format, *args ):
+        pass
+
+@pytest.fixture(scope="function")
+def es_stub(request):
+    services = ["service_a","service_b","service_c","service_d"]
+    hits = []
+    for idx in range(len(services)):
+        hits.append({"_index":"stub","_id":str(idx),"_source":{"service":services[idx],"metric1":idx,"metric2":idx+5}})
+
+    server = HTTPServer(("127.0.0.1",0),ESStubHandler)
+    server.requests = []
+    server.connections = set()
+    server.search_response = {"took":1,"timed_out":False,"hits":{"total":{"value":len(hits),"relation":"eq"},"hits":hits}}
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+
+    def cleanup_es_stub():
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+    request.addfinalizer(cleanup_es_stub)
+
+    return {"server": server,
+            "url": "http://127.0.0.1:%d"%server.server_address[1] }
+
+class OdbcStubCursor():
+    """ stand in for a pyodbc cursor on a sqlite database, rows allow attribute access to the columns like pyodbc rows """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.db.cursor()
+        self.description = None
+        self.row_type = None
+
+    def execute( self, sql, *params ):
+        if self.conn.broken:
+            raise pyodbc.Error("08S01","communication link failure")
+        self.cursor.execute(sql,params)
+        self.description = self.cursor.description
+        if self.description:
+            self.row_type = namedtuple("Row",[d[0] for d in self.description])
+        return self
+
+    def fetchone( self ):
+        row = self.cursor.fetchone()
+        return self.row_type(*row) if row else None
+
+    def fetchmany( self, size=1 ):
+        return [ self.row_type(*row) for row in self.cursor.fetchmany(size) ]
+
+    def fetchall( self ):
+        return [ self.row_type(*row) for row in self.cursor.fetchall() ]
+
+    def __iter__( self ):
+        return iter(self.fetchall())
+
+# pyodbc returns DATETIME columns as datetime, have the sqlite stand in do the same for columns declared datetime
+sqlite3.register_converter("datetime",lambda value: datetime.fromisoformat(value.decode("utf-8")))
+sqlite3.register_adapter(datetime,lambda value: value.isoformat(" "))
+
+class OdbcStubConnection():
+    """ stand in for a pyodbc connection on a sqlite database """
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path,check_same_thread=False,detect_types=sqlite3.PARSE_DECLTYPES)
+        self.broken = False
+        self.closed = False
+
+    def cursor( self ):
+        return OdbcStubCursor(self)
+
+    def execute( self, sql, *params ):
+        return self.cursor().execute(sql,*params)
+
+    def commit( self ):
+        self.db.commit()
+
+    def close( self ):
+        self.closed = True
+        self.db.close()
+
+@pytest.fixture(scope="function")
+def odbc_stub(request,tmp_path,monkeypatch):
+    """ replace pyodbc.connect and the keyring with stand ins backed by a sqlite database holding the same table as dt_testdir """
+    db_path = str(tmp_path / "odbc_stub.db")
+    sql_spec = "odbc://tester@localhost/stub/stub_db"
+    connections = []
+    keyring_calls = []
+
+    conn = OdbcStubConnection(db_path)
+    conn.execute("CREATE TABLE services ( service varchar (18), metric1 int, metric2 int )")
+    services = ["service_a","service_b","service_c","service_d"]
+    for idx in range(len(services)):
+        conn.execute("INSERT INTO services VALUES ( ?,?,? )",services[idx],idx,idx+5)
+    conn.commit()
+    conn.close()
+
+    def connect( connection_string ):
+        assert "PWD=stub_password;" in connection_string
+        conn = OdbcStubConnection(db_path)
+        connections.append(conn)
+        return conn
+
+    def get_password( service, username ):
+        keyring_calls.append((service,username))
+        return "stub_password" if service == sql_spec else None
+
+    monkeypatch.setattr(pyodbc,"connect",connect,raising=False)
+    monkeypatch.setattr(keyring,"get_password",get_password)
+
+    return {"sql_spec": sql_spec,
+            "db_path": db_path,
+            "table_name": "services",
+            "connections": connections,
+            "keyring_calls": keyring_calls }
+
+@pytest.fixture(scope="function")
+def table_server(request):
+    """ start a dashboard table server in a local subprocess and return a remote_data.Connection talking to it over its stdin and stdout """
+    from data_sources.remote_data import Connection
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = top+os.pathsep+env.get("PYTHONPATH","")
+    process = subprocess.Popen([sys.executable,os.path.join(top,"scripts","dashboard"),"--server"],
+        stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env)
+    connection = Connection(None,None,None,io.TextIOWrapper(process.stdin,line_buffering=True),process.stdout,io.TextIOWrapper(process.stderr),30)
+
+    def cleanup_table_server():
+        if process.poll() == None:
+            connection.exit()
+            process.stdin.close()
+        process.wait()
+
+    request.addfinalizer(cleanup_table_server)
+
+    return {"process": process,
+            "connection": connection,
+            "csv_path": os.path.join(top,"tests","data","test_csv.csv") }
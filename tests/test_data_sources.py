@@ -1,18 +1,28 @@
 from data_sources.syslog_data import SyslogDataTable
-from data_sources.proc_data import ProcDataTable
-from data_sources.elastic_data import ElasticsearchDataTable
-from data_sources.remote_data import RemoteDataTable,shutdown_connection_manager
-from data_sources.odbc_data import ODBCDataTable
+from data_sources.proc_data import ProcDataTable,RateCounter,PsutilSampler,ProcfsSampler
+from data_sources.elastic_data import ElasticsearchDataTable,get_es_client,shutdown_es_clients,compile_field_map,extract_fields,incremental_query
+from data_sources.remote_data import RemoteDataTable,ConnectionManager,shutdown_connection_manager
+from data_sources.odbc_data import ODBCDataTable,get_odbc_pool,shutdown_odbc_pools,aggregate_query
 from data_sources.json_data import JSONDataTable
 from data_sources.csv_data import CSVDataTable
 from data_sources.logs_data import LogDataTable
-from data_sources.data_table import DataTable,Column,Cell,ColumnIterator,string_type,float_type,int_type,date_type,blank_type,format_string,format_date,format_float,format_int,blank_cell
+from data_sources.cgroup_data import CgroupDataTable
+from data_sources.data_table import DataTable,Column,Cell,ColumnIterator,string_type,float_type,int_type,date_type,blank_type,format_string,format_date,format_float,format_int,blank_cell,from_csv,to_csv,from_json,to_json,to_binary,from_binary
+import pytest
 import curses
 import curses.ascii
 import os
 import time
+import json
+import threading
+import sqlite3
+import shutil
+import subprocess
+import sys
+import io
+from io import StringIO
 from datetime import datetime,timedelta
-from dashboard_test_util import dt_testdir
+from dashboard_test_util import dt_testdir,es_stub,odbc_stub,table_server
 
 def test_Cell():
     c = Cell(string_type,"Test Value",format_string)
@@ -160,6 +170,83 @@ def test_DataTable():
 
     assert timestamp != new_timestamp
 
+def test_from_csv_field_map():
+    stream = StringIO("a,b,c,d\n1,x,2.5,skip\n2,,\n")
+    dt = from_csv(stream,"Mapped",[["c","C","_float"],["a","A","_int"],["b","B","_string"]])
+    assert dt.get_name() == "Mapped"
+    assert dt.get_names() == ["A","B","C"]
+    assert dt.get_bounds() == (2,3)
+    assert dt.get(1,"A").get_value() == 2
+    assert dt.get(0,"B").get_value() == "x"
+    assert dt.get(1,"B").get_type() == blank_type
+    assert dt.get(0,"C").get_value() == 2.5
+    assert dt.get(1,"C").get_type() == blank_type
+
+    assert from_csv(StringIO("a,b\n"),None,[["a","A","_int"]]) == None
+
+    dt = from_csv(StringIO("a,b\n1,2\n\n3,4\n\n"),None,[["a","A","_int"],["b","B","_int"]])
+    assert dt.get_bounds() == (2,2)
+    assert [ c.get_value() for c in dt.get_column("A").values ] == [1,3]
+
+def test_to_json_unlocked():
+    dt = DataTable(None,"Unlocked",5)
+    dt.add_column(Column(values=[Cell(int_type,1,format_int),Cell(int_type,2,format_int)],name="Ints"))
+    class CheckedStream(StringIO):
+        def write(self,text):
+            result = []
+            def try_lock():
+                result.append(dt.refresh_lock.acquire(timeout=0))
+                if result[0]:
+                    dt.refresh_lock.release()
+            t = threading.Thread(target=try_lock)
+            t.start()
+            t.join()
+            assert result == [True]
+            return StringIO.write(self,text)
+
+    for write in [lambda stream: to_json(dt,stream), lambda stream: to_json(dt,stream,True), lambda stream: to_csv(dt,stream)]:
+        stream = CheckedStream()
+        write(stream)
+        assert "Ints" in stream.getvalue()
+
+def test_to_binary_fallback():
+    dt = DataTable(None,"Binary",5)
+    dt.add_column(Column(values=[Cell(int_type,1,format_int),blank_cell,Cell(int_type,3,format_int)],name="Ints"))
+    dt.add_column(Column(values=[Cell(int_type,1,format_float),Cell(int_type,1.5,format_float),blank_cell],name="Averages"))
+    dt.add_column(Column(values=[Cell(int_type,2**70,format_int)],name="Big"))
+    for compression in ["none","zlib","lzma"]:
+        (key,ldt), = from_binary(to_binary([("binary",dt)],compression))
+        assert key == "binary" and ldt.get_name() == "Binary"
+        for cn in ["Ints","Averages","Big"]:
+            assert [ (c.get_type(),c.get_value()) for c in ldt.get_column(cn).values ] == [ (c.get_type(),c.get_value()) for c in dt.get_column(cn).values ]
+
+def test_to_json_columnar():
+    dt = DataTable(None,"Columnar",5)
+    dt.add_column(Column(values=[Cell(int_type,1,format_int),blank_cell,Cell(int_type,3,format_int)],name="Ints"))
+    dt.add_column(Column(values=[Cell(date_type,datetime(2020,8,26,7,51,0),format_date),Cell(string_type,"mixed",format_string)],name="Mixed"))
+
+    for columnar in [False,True]:
+        stream = StringIO()
+        to_json(dt,stream,columnar)
+        assert json.loads(stream.getvalue()).get("format") == ("columnar" if columnar else None)
+        ldt = from_json(StringIO(stream.getvalue()))
+        assert ldt.get_name() == "Columnar" and ldt.refresh_minutes == 5
+        assert [ (c.get_type(),c.get_value()) for c in ldt.get_column("Ints").values ] == [(int_type,1),(blank_type,""),(int_type,3)]
+        assert ldt.get(0,"Mixed").get_value() == datetime(2020,8,26,7,51,0)
+        assert ldt.get(1,"Mixed").get_value() == "mixed"
+
+    dt = DataTable(None,"CSV",5)
+    dt.add_column(Column(values=[blank_cell,Cell(int_type,2,format_int),Cell(int_type,3,format_int)],name="Ints"))
+    dt.add_column(Column(values=[Cell(date_type,datetime(2020,8,26,7,51,0),format_date)],name="Dates"))
+    stream = StringIO()
+    to_csv(dt,stream)
+    ldt = from_csv(StringIO(stream.getvalue()))
+    assert ldt.get_name() == "CSV"
+    assert ldt.get(0,"Ints").get_type() == blank_type
+    assert ldt.get(2,"Ints").get_value() == 3
+    assert ldt.get(0,"Dates").get_value() == datetime(2020,8,26,7,51,0)
+    assert ldt.get(1,"Dates").get_type() == blank_type
+
 def test_JSONDataTable(dt_testdir):
     jdt = JSONDataTable( dt_testdir["json_path"] )
     assert jdt.get_name() == "Syslog Data: /var/log/syslog* for the last 24 hours in 1 hour buckets, refreshed every 10 minutes"
@@ -180,6 +267,85 @@ def test_CSVDataTable(dt_testdir):
     assert str(cdt.get(21,'Services')) == "apport"
     assert str(cdt.get(13,'Errors by Time')) == "2.00"
 
+def test_file_change_detection(tmp_path):
+    data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+    csv_path = str(tmp_path / "test_csv.csv")
+    json_path = str(tmp_path / "test_json.json")
+    shutil.copy(os.path.join(data_path,"test_csv.csv"),csv_path)
+    shutil.copy(os.path.join(data_path,"test_json.json"),json_path)
+
+    changes = []
+    cdt = CSVDataTable( 1, csv_path, None, None, True )
+    cdt.listen(lambda t: changes.append("csv"))
+    jdt = JSONDataTable( json_path )
+    jdt.listen(lambda t: changes.append("json"))
+    cdt.refresh()
+    jdt.refresh()
+    assert changes == []
+
+    # same contents with a new modification time is skipped when hashing
+    os.utime(csv_path,(time.time()+10,time.time()+10))
+    os.utime(json_path,(time.time()+10,time.time()+10))
+    cdt.refresh()
+    jdt.refresh()
+    assert changes == ["json"]
+
+    lines = open(csv_path,"r").readlines()
+    open(csv_path,"w").writelines(lines[:-1])
+    cdt.refresh()
+    assert changes == ["json","csv"]
+    assert cdt.get_bounds() == (24,8)
+
+def test_CSVDataTable_tail(tmp_path):
+    csv_path = str(tmp_path / "results.csv")
+    csv_map = [["Run","Run","_int"],["Result","Result","_float"]]
+    def write( mode, text ):
+        with open(csv_path,mode) as f:
+            f.write(text)
+        # make sure the modification time moves even on coarse grained file systems
+        st = os.stat(csv_path)
+        os.utime(csv_path,ns=(st.st_atime_ns,st.st_mtime_ns+1000000000))
+
+    write("w","Run,Result\n1,1.5\n2,2.5\n3,3.5\n")
+    cdt = CSVDataTable( 1, csv_path, csv_map, "Results", False, True, 4 )
+    assert [ c.get_value() for c in cdt.get_column("Run").values ] == [1,2,3]
+
+    write("a","4,4.5\n5,5.5\n6,")
+    cdt.refresh()
+    assert [ c.get_value() for c in cdt.get_column("Run").values ] == [2,3,4,5]
+    assert cdt.get(3,"Result").get_value() == 5.5
+
+    write("a","6.5\n")
+    cdt.refresh()
+    assert [ c.get_value() for c in cdt.get_column("Run").values ] == [3,4,5,6]
+    assert cdt.get(3,"Result").get_value() == 6.5
+
+    write("w","Run,Result\n7,7.5\n")
+    cdt.refresh()
+    assert [ c.get_value() for c in cdt.get_column("Run").values ] == [7]
+    assert cdt.get_column("Result").size() == 1
+
+    # a rewrite in place with the same header that leaves the file larger is reloaded from the top
+    write("w","Run,Result\n8,8.5\n9,9.5\n")
+    cdt.refresh()
+    assert [ c.get_value() for c in cdt.get_column("Run").values ] == [8,9]
+
+    # a quoted field with a newline is only parsed once the whole record is there
+    csv_map.append(["Note","Note","_string"])
+    write("w","Run,Result,Note\n1,1.5,\"first\n")
+    cdt = CSVDataTable( 1, csv_path, csv_map, "Results", False, True )
+    assert not cdt.has_column("Run")
+    write("a","line\"\n2,2.5,second\n")
+    cdt.refresh()
+    assert [ c.get_value() for c in cdt.get_column("Note").values ] == ["first\nline","second"]
+
+    # a reset with no new records still notifies the listeners
+    changes = []
+    cdt.listen(lambda t: changes.append(t.get_column("Run").size()))
+    write("w","Run,Result,Note\n")
+    cdt.refresh()
+    assert changes == [0]
+
 def test_SyslogDataTable(dt_testdir):
     st = dt_testdir["start_time"]
     sdt = SyslogDataTable( dt_testdir["syslog_path"],start_time=[st.year,st.month,st.day,st.hour,st.minute,st.second])
@@ -217,6 +383,37 @@ def test_LogDataTable(dt_testdir):
         total_stops += ldt.get(idx,"Stops by Time").get_float_value()
     assert total_starts == 38 and total_stops == 8
 
+def test_checkpoint(dt_testdir):
+    state_dir = os.path.join(dt_testdir["local_path"],"state")
+    st = dt_testdir["start_time"]
+    start_time = [st.year,st.month,st.day,st.hour,st.minute,st.second]
+    sdt = SyslogDataTable( dt_testdir["syslog_path"],start_time=start_time,state_dir=state_dir)
+    sdt.save_checkpoint()
+    assert os.path.exists(sdt.checkpoint_path)
+
+    rdt = SyslogDataTable( dt_testdir["syslog_path"],start_time=start_time,state_dir=state_dir)
+    assert rdt.file_map == sdt.file_map
+    assert rdt.get(13,"Errors by Time").get_value() == 4
+    assert rdt.get(15,"Messages by Time").get_value() == 23
+    assert rdt.get(0,"Messages by Service").get_value() == 60
+
+    log_map = [{
+            "line_regex": "(\\w\\w\\w\\s+\\d+\\s\\d\\d:\\d\\d:\\d\\d)\\s[a-z0-9\\-]*\\s([a-zA-Z0-9\\-\\_\\.]*)[\\[\\]0-9]*:\\s*(.*)",
+            "num_buckets" : 24,
+            "bucket_size" : 60,
+            "bucket_type" : "_date",
+            "column_map" : [ [ 1,"Time Stamps","_date","key" ], [3,"Starts by Time","_int","count(.*[Ss]tart.*)"]]
+            }]
+    ldt = LogDataTable(dt_testdir["syslog_path"],log_map,[1,0,0],1,state_dir)
+    ldt.save_checkpoint()
+    rldt = LogDataTable(dt_testdir["syslog_path"],log_map,[1,0,0],1,state_dir)
+    assert rldt.file_map == ldt.file_map
+    assert rldt.get_bounds() == ldt.get_bounds()
+    rows,cols = rldt.get_bounds()
+    for idx in range(rows):
+        assert rldt.get(idx,"Time Stamps").get_value() == ldt.get(idx,"Time Stamps").get_value()
+        assert rldt.get(idx,"Starts by Time").get_value() == ldt.get(idx,"Starts by Time").get_value()
+
 def test_ODBCDataTable(dt_testdir):
     odt = ODBCDataTable(1,dt_testdir["odbc_path"],"select * from %s"%dt_testdir["table_idx_name"],[["service","Service"],["metric1","First Metric"],["metric2","Second Metric"]])
     column_names = ["Service","First Metric","Second Metric"]
@@ -230,6 +427,154 @@ def test_ODBCDataTable(dt_testdir):
         v = services.index(service)
         assert odt.get(idx,"First Metric").get_value() == v and odt.get(idx,"Second Metric").get_value() == v+5
 
+def test_ODBCDataTable_pool(odbc_stub):
+    sql_map = [["service","Service"],["metric1","First Metric"]]
+    try:
+        odt_a = ODBCDataTable(1,odbc_stub["sql_spec"],"select * from services",sql_map)
+        odt_b = ODBCDataTable(1,odbc_stub["sql_spec"],"select * from services where metric1 > 1",sql_map)
+        odt_a.refresh()
+        odt_b.refresh()
+        assert odt_b.get(0,"Service").get_value() == "service_c"
+        assert len(odbc_stub["connections"]) == 1
+        assert len(odbc_stub["keyring_calls"]) == 1
+
+        # a broken pooled connection is discarded and the query retried on a new one
+        odbc_stub["connections"][0].broken = True
+        odt_b.refresh()
+        assert len(odbc_stub["connections"]) == 2
+        assert odbc_stub["connections"][0].closed
+        assert len(odbc_stub["keyring_calls"]) == 1
+
+        # idle connections past the timeout are closed and replaced
+        pool = get_odbc_pool(odbc_stub["sql_spec"])
+        pool.idle_seconds = 0
+        odt_a.refresh()
+        assert len(odbc_stub["connections"]) == 3
+        assert odbc_stub["connections"][1].closed
+
+        # idle connections are closed by the sweep even if the pool isn't used again
+        pool.close()
+        pool.idle_seconds = 0.2
+        pool.check_seconds = 0.1
+        odt_a.refresh()
+        assert not odbc_stub["connections"][-1].closed
+        for i in range(50):
+            if pool.sweep_thread == None:
+                break
+            time.sleep(0.1)
+        assert odbc_stub["connections"][-1].closed
+        assert pool.idle == [] and pool.sweep_thread == None
+    finally:
+        shutdown_odbc_pools()
+    assert odbc_stub["connections"][2].closed
+
+def test_ODBCDataTable_watermark(odbc_stub):
+    sql_map = [["rowid","Row"],["service","Service"]]
+    try:
+        odt = ODBCDataTable(1,odbc_stub["sql_spec"],"select rowid,* from services",sql_map)
+        odt.refresh()
+        assert odt.get_column("Service").size() == 4
+
+        odt = ODBCDataTable(1,odbc_stub["sql_spec"],"select rowid,* from services where rowid > ? order by rowid",sql_map,{"column":"rowid","start":0},5)
+        assert odt.get_column("Service").size() == 4
+        assert odt.watermark == 4
+
+        conn = odbc_stub["connections"][0]
+        for idx in range(3):
+            conn.execute("INSERT INTO services VALUES ( ?,?,? )","service_%d"%idx,idx,idx)
+        conn.commit()
+        odt.refresh()
+        assert odt.watermark == 7
+        assert [ c.get_value() for c in odt.get_column("Row").values ] == [3,4,5,6,7]
+        assert odt.get(4,"Service").get_value() == "service_2"
+
+        odt.refresh()
+        assert odt.get_column("Row").size() == 5
+
+        # overlapping refreshes must not fetch from the same watermark twice
+        for idx in range(3,6):
+            conn.execute("INSERT INTO services VALUES ( ?,?,? )","service_%d"%idx,idx,idx)
+        conn.commit()
+        threads = [ threading.Thread(target=odt.refresh) for idx in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert odt.watermark == 10
+        assert [ c.get_value() for c in odt.get_column("Row").values ] == [6,7,8,9,10]
+    finally:
+        shutdown_odbc_pools()
+
+def test_ODBCDataTable_datetime_watermark(odbc_stub):
+    start_time = datetime(2020,1,1)
+    conn = sqlite3.connect(odbc_stub["db_path"])
+    conn.execute("CREATE TABLE events ( created datetime, service varchar (18) )")
+    for hour in [1,2,3]:
+        conn.execute("INSERT INTO events VALUES ( ?,? )",((start_time+timedelta(hours=hour)).isoformat(" "),"service_%d"%hour))
+    conn.commit()
+
+    sql_map = [["created","Created"],["service","Service"]]
+    try:
+        odt = ODBCDataTable(1,odbc_stub["sql_spec"],"select * from events where created > ? order by created",sql_map,{"column":"created","start":"2020-01-01 01:00:00"})
+        assert [ c.get_value() for c in odt.get_column("Service").values ] == ["service_2","service_3"]
+        assert odt.watermark == start_time+timedelta(hours=3)
+
+        conn.execute("INSERT INTO events VALUES ( ?,? )",((start_time+timedelta(hours=4)).isoformat(" "),"service_4"))
+        conn.commit()
+        odt.refresh()
+        assert [ c.get_value() for c in odt.get_column("Service").values ] == ["service_2","service_3","service_4"]
+        assert odt.watermark == start_time+timedelta(hours=4)
+    finally:
+        conn.close()
+        shutdown_odbc_pools()
+
+def test_ODBCDataTable_batches(odbc_stub):
+    conn = sqlite3.connect(odbc_stub["db_path"])
+    conn.execute("INSERT INTO services VALUES ( ?,?,? )",("service_e",None,2.5))
+    conn.commit()
+    conn.close()
+
+    sql_map = [["SERVICE","Service"],["metric1","First Metric"],["metric2","Second Metric"]]
+    try:
+        odt = ODBCDataTable(1,odbc_stub["sql_spec"],"select * from services",sql_map,None,None,2)
+        assert odt.get_column("Service").size() == 5
+        assert odt.get(0,"Service").get_value() == "service_a"
+        assert odt.get(3,"First Metric").get_type() == int_type
+        assert odt.get(3,"Second Metric").get_value() == 8
+        assert odt.get(4,"First Metric").get_value() == "None"
+        assert odt.get(4,"Second Metric").get_type() == float_type
+
+        odt.refresh()
+        assert odt.get_column("Service").size() == 5
+    finally:
+        shutdown_odbc_pools()
+
+def test_ODBCDataTable_aggregate(odbc_stub):
+    start_time = datetime.now().replace(minute=0,second=0,microsecond=0)
+    conn = sqlite3.connect(odbc_stub["db_path"])
+    conn.execute("CREATE TABLE events ( created text, latency int )")
+    for hour in [0,0,0,2,2,7]:
+        created = start_time - timedelta(hours=hour) + timedelta(seconds=1)
+        conn.execute("INSERT INTO events VALUES ( ?,? )",(created.strftime("%Y-%m-%d %H:%M:%S"),hour*10+5))
+    conn.commit()
+    conn.close()
+
+    sql_aggregate = { "table" : "events", "timestamp_column" : "created", "num_buckets" : 4,
+                      "aggregates" : [ ["count","*","Events"], ["avg","latency","Latency"] ] }
+    try:
+        odt = ODBCDataTable(1,odbc_stub["sql_spec"],None,None,None,None,1000,sql_aggregate)
+        assert odt.get_column("Time Stamps").size() == 4
+        assert [ c.get_value() for c in odt.get_column("Time Stamps").values ] == [ start_time - timedelta(hours=hour) for hour in [3,2,1,0] ]
+        assert [ c.get_value() for c in odt.get_column("Events").values ] == [0,2,0,3]
+        assert odt.get(1,"Latency").get_value() == 25
+        assert odt.get(2,"Latency").get_type() == blank_type
+        assert odt.get(3,"Latency").get_value() == 5
+    finally:
+        shutdown_odbc_pools()
+
+    sql_aggregate["dialect"] = "postgresql"
+    assert aggregate_query(sql_aggregate) == "SELECT CAST(FLOOR(EXTRACT(EPOCH FROM created)/3600)*3600 AS BIGINT) AS bucket,COUNT(*) AS agg0,AVG(latency) AS agg1 FROM events WHERE created >= ? GROUP BY 1 ORDER BY 1"
+
 def test_ElasticsearchDataTable(dt_testdir):
     odt = ElasticsearchDataTable(1,dt_testdir["table_idx_name"],{},[["hits.hits._source.service","Service","string"],["hits.hits._source.metric1","First Metric","int"],["hits.hits._source.metric2","Second Metric","int"]])
     time.sleep(1)
@@ -246,6 +591,158 @@ def test_ElasticsearchDataTable(dt_testdir):
         v = services.index(service)
         assert odt.get(idx,"First Metric").get_value() == v and odt.get(idx,"Second Metric").get_value() == v+5
 
+def test_extract_fields():
+    result = { "took" : 3,
+        "hits" : { "hits" : [ { "_source" : { "service" : "service_a", "host.name" : "host_a" } }, { "_source" : { "service" : "service_b", "host.name" : "host_b" } } ] },
+        "aggregations" : { "3" : { "buckets" : [ { "key" : 1598400000000, "doc_count" : 5, "4" : { "value" : 1.5 } }, { "key" : 1598403600000, "doc_count" : 6, "4" : { "value" : 2.5 } } ] } } }
+    field_map = [["hits.hits._source.service","Service","str"],
+                 ["hits.hits._source.host.name","Host","str"],
+                 ["aggregations.3.buckets.key","Time","date"],
+                 ["aggregations.3.buckets.4.value","Value","float"],
+                 ["aggregations.3.buckets.doc_count","Count","int"]]
+    trie = compile_field_map(field_map)
+    assert list(trie[0].keys()) == ["hits","aggregations"]
+
+    matches = []
+    extract_fields(trie,result,lambda column_name,convert,value: matches.append((column_name,convert(value))))
+    assert [(m[0],m[1].get_value()) for m in matches] == [("Service","service_a"),("Host","host_a"),("Service","service_b"),("Host","host_b"),
+        ("Time",datetime.fromtimestamp(1598400000)),("Count",5),("Value",1.5),
+        ("Time",datetime.fromtimestamp(1598403600)),("Count",6),("Value",2.5)]
+    assert matches[4][1].get_type() == date_type and matches[5][1].get_type() == int_type and matches[6][1].get_type() == float_type
+
+def test_ElasticsearchDataTable_client(es_stub):
+    es_connection = {"hosts":[es_stub["url"]]}
+    field_map = [["hits.hits._source.service","Service","string"],["hits.hits._source.metric1","First Metric","int"]]
+    try:
+        first = ElasticsearchDataTable(1,"stub",{},field_map,es_connection)
+        second = ElasticsearchDataTable(1,"stub",{},field_map,es_connection)
+        first.refresh()
+        second.refresh()
+
+        assert get_es_client(es_connection) is get_es_client({"hosts":[es_stub["url"]]})
+        assert get_es_client(es_connection) is not get_es_client({"hosts":[es_stub["url"]+"/"]})
+        searches = [r for r in es_stub["server"].requests if "_search" in r[1]]
+        assert len(searches) == 4
+        assert len(es_stub["server"].connections) == 1
+        for dt in [first,second]:
+            assert dt.get_column("Service").size() == 4
+            assert dt.get(2,"Service").get_value() == "service_c"
+            assert dt.get(2,"First Metric").get_value() == 2
+    finally:
+        shutdown_es_clients()
+
+def test_ElasticsearchDataTable_incremental(es_stub):
+    now = datetime.now().replace(minute=0,second=0,microsecond=0)
+    buckets = [ now - timedelta(hours=h) for h in range(23,-1,-1) ]
+    def search( body ):
+        start = 0
+        for f in body.get("query",{}).get("bool",{}).get("filter",[]):
+            if "range" in f:
+                start = f["range"]["@timestamp"]["gte"]
+        keys = [ int(b.timestamp()*1000) for b in buckets ]
+        return { "aggregations" : { "2" : { "buckets" : [ { "key" : k, "doc_count" : k//3600000%100 } for k in keys if k >= start ] } } }
+    es_stub["server"].search_response = search
+
+    field_map = [["aggregations.2.buckets.key","Time","date"],["aggregations.2.buckets.doc_count","Count","int"]]
+    query = { "size" : 0, "aggs" : { "2" : { "date_histogram" : { "field" : "@timestamp", "fixed_interval" : "1h" } } } }
+    incremental = { "timestamp_field" : "@timestamp", "key_column" : "Time", "window_minutes" : 23*60 }
+    try:
+        edt = ElasticsearchDataTable(1,"stub",query,field_map,{"hosts":[es_stub["url"]]},incremental)
+        assert edt.get_column("Time").size() == 23
+        assert edt.get(0,"Time").get_value() == now - timedelta(hours=22)
+
+        buckets.append(now + timedelta(hours=1))
+        edt.refresh()
+
+        method,path,body = es_stub["server"].requests[-1]
+        sent = json.loads(body)
+        assert sent["query"]["bool"]["filter"][0]["range"]["@timestamp"]["gte"] == int(now.timestamp()*1000)
+        assert query == { "size" : 0, "aggs" : { "2" : { "date_histogram" : { "field" : "@timestamp", "fixed_interval" : "1h" } } } }
+
+        assert edt.get_column("Time").size() == 24
+        assert edt.get(0,"Time").get_value() == now - timedelta(hours=22)
+        assert edt.get(23,"Time").get_value() == now + timedelta(hours=1)
+        for idx in range(24):
+            key = int(edt.get(idx,"Time").get_value().timestamp()*1000)
+            assert edt.get(idx,"Count").get_value() == key//3600000%100
+    finally:
+        shutdown_es_clients()
+
+def test_incremental_query():
+    start = datetime(2020,1,2)
+    start_ms = int(start.timestamp()*1000)
+    query = { "query" : { "range" : { "@timestamp" : { "gt" : "now-1d" } } } }
+    assert incremental_query(query,"@timestamp",start)["query"]["range"]["@timestamp"] == { "gte" : start_ms, "format" : "epoch_millis" }
+    assert query == { "query" : { "range" : { "@timestamp" : { "gt" : "now-1d" } } } }
+
+    # an upper bound in the range's own format must still parse
+    query = { "query" : { "range" : { "@timestamp" : { "gte" : "2020/01/01", "lt" : "2020/02/01", "format" : "yyyy/MM/dd" } } } }
+    assert incremental_query(query,"@timestamp",start)["query"]["range"]["@timestamp"] == { "gte" : start_ms, "lt" : "2020/02/01", "format" : "yyyy/MM/dd||epoch_millis" }
+    query = { "query" : { "range" : { "@timestamp" : { "gte" : "now-1d", "lte" : "now" } } } }
+    assert incremental_query(query,"@timestamp",start)["query"]["range"]["@timestamp"] == { "gte" : start_ms, "lte" : "now" }
+
+def test_ElasticsearchDataTable_paged(es_stub):
+    def search( body ):
+        start = body.get("search_after",[-1])[0]+1
+        hits = [ { "_source" : { "seq" : idx }, "sort" : [ idx ] } for idx in range(start,min(start+body["size"],2500)) ]
+        return { "pit_id" : "stub_pit", "hits" : { "hits" : hits } }
+    es_stub["server"].search_response = search
+
+    field_map = [["hits.hits._source.seq","Sequence","int"]]
+    try:
+        edt = ElasticsearchDataTable(1,"stub",{"aggs":{"total":{"value_count":{"field":"seq"}}}},field_map,{"hosts":[es_stub["url"]]},None,2200,500)
+        seq = edt.get_column("Sequence")
+        assert seq.size() == 2200
+        for idx in range(seq.size()):
+            assert seq.get(idx).get_value() == idx
+
+        searches = [ json.loads(r[2]) for r in es_stub["server"].requests if "_search" in r[1] ]
+        assert [ s["size"] for s in searches ] == [500,500,500,500,200]
+        assert searches[1]["search_after"] == [499]
+        assert searches[0]["pit"]["id"] == "stub_pit"
+        assert [ "aggs" in s for s in searches ] == [True,False,False,False,False]
+        assert [ r[0] for r in es_stub["server"].requests if "_pit" in r[1] ] == ["POST","DELETE"]
+
+        edt.es_max_rows = 5000
+        edt.refresh()
+        assert edt.get_column("Sequence").size() == 2500
+    finally:
+        shutdown_es_clients()
+
+def test_ElasticsearchDataTable_batched(es_stub):
+    def search( body ):
+        service = body["query"]["term"]["service"]
+        return { "hits" : { "hits" : [ { "_source" : { "service" : service, "metric1" : len(service) } } ] } }
+    es_stub["server"].search_response = search
+
+    field_map = [["hits.hits._source.service","Service","str"],["hits.hits._source.metric1","Metric1","int"]]
+    connection = {"hosts":[es_stub["url"]]}
+    queries = [ { "query" : { "term" : { "service" : service } } } for service in ["a","a","bbb"] ]
+    try:
+        tables = [None]*len(queries)
+        def create_table( idx ):
+            tables[idx] = ElasticsearchDataTable(1,"stub",queries[idx],field_map,connection,None,None,1000,0.5,60)
+        threads = [ threading.Thread(target=create_table,args=(idx,)) for idx in range(len(queries)) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for idx,service in enumerate(["a","a","bbb"]):
+            assert tables[idx].get(0,"Service").get_value() == service
+            assert tables[idx].get(0,"Metric1").get_value() == len(service)
+
+        searches = [ r for r in es_stub["server"].requests if "search" in r[1] ]
+        assert len(searches) == 1
+        assert "_msearch" in searches[0][1]
+        assert len([ line for line in searches[0][2].split(b"\n") if line.strip() ]) == 4
+
+        cached = ElasticsearchDataTable(1,"stub",queries[2],field_map,connection,None,None,1000,0.5,60)
+        assert cached.get(0,"Service").get_value() == "bbb"
+        assert len([ r for r in es_stub["server"].requests if "search" in r[1] ]) == 1
+    finally:
+        shutdown_es_clients()
+
 def test_RemoteDataTable(dt_testdir):
     rdt = RemoteDataTable(dt_testdir["ssh_path"],{"name": "syslog", "type": "SyslogDataTable", "refresh_minutes": 1},"Remote Table",0.0833)
 
@@ -268,6 +765,336 @@ def test_RemoteDataTable(dt_testdir):
     finally:
         shutdown_connection_manager()
 
+def test_Connection_local(table_server):
+    connection = table_server["connection"]
+    table_def = { "name" : "local", "type" : "CSVDataTable", "refresh_minutes" : 1, "csv_spec" : table_server["csv_path"] }
+    assert connection.table(json.dumps(table_def)).startswith("loaded:local")
+
+    start_time = time.time()
+    for idx in range(5):
+        name,json_blob = connection.get("local").split(":",1)
+        assert name == "local"
+    assert time.time() - start_time < 1.0
+
+    dt = from_json(StringIO(json_blob))
+    assert dt.get_bounds() == (25,8)
+
+    # blank lines are skipped and bad commands are answered with an error without taking the server down
+    for bad in ["","nonsense","get:missing"]:
+        print(bad,file=connection.stdin,flush=True)
+    assert connection.get_stdout_line().startswith("error:")
+    assert connection.get_stdout_line().startswith("error:")
+    assert connection.get("local").startswith("local:")
+
+    connection.exit()
+    table_server["process"].stdin.close()
+    table_server["process"].wait()
+    with pytest.raises(Exception):
+        connection.get_stdout_line()
+
+def test_Connection_framed(table_server):
+    connection = table_server["connection"]
+    assert connection.negotiate(2) == 2
+    for name in ["first","second"]:
+        table_def = { "name" : name, "type" : "CSVDataTable", "refresh_minutes" : 1, "csv_spec" : table_server["csv_path"] }
+        assert connection.table(json.dumps(table_def)).startswith("loaded:%s"%name)
+
+    responses = {}
+    def get_table( name ):
+        responses[name] = connection.get(name)
+    threads = [ threading.Thread(target=get_table,args=(name,)) for name in ["first","second","first","second"] ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for name in ["first","second"]:
+        assert responses[name].startswith("%s:"%name)
+
+    tables = connection.get_many(["first","second"])
+    assert sorted(tables.keys()) == ["first","second"]
+    assert tables["second"].get_bounds() == (25,8)
+
+    with pytest.raises(Exception):
+        connection.get("missing")
+    assert connection.refresh("first").startswith("first:")
+
+    # badly framed lines are rejected without taking the server down
+    for bad in ["get:first","x get:first",""]:
+        print(bad,file=connection.stdin,flush=True)
+    assert connection.get("first").startswith("first:")
+
+def test_Connection_binary(table_server):
+    connection = table_server["connection"]
+    connection.compression = "lzma"
+    assert connection.negotiate(3) == 3
+    table_def = { "name" : "binary", "type" : "CSVDataTable", "refresh_minutes" : 1, "csv_spec" : table_server["csv_path"] }
+    assert connection.table(json.dumps(table_def)).startswith("loaded:binary")
+
+    response = connection.get("binary")
+    assert isinstance(response,bytes)
+    dt = connection.decode_table(response)
+    expected = from_csv(open(table_server["csv_path"],"r"))
+    assert dt.get_name() == expected.get_name()
+    assert dt.get_bounds() == expected.get_bounds()
+    for cn in expected.get_names():
+        assert [ (c.get_type(),c.get_value()) for c in dt.get_column(cn).values ] == [ (c.get_type(),c.get_value()) for c in expected.get_column(cn).values ]
+
+    assert connection.get_many(["binary"])["binary"].get_bounds() == expected.get_bounds()
+    with pytest.raises(Exception):
+        connection.get("missing")
+
+def test_Connection_delta(table_server,tmp_path,monkeypatch):
+    connection = table_server["connection"]
+    assert connection.negotiate(4) == 4
+    csv_path = str(tmp_path / "results.csv")
+    def write( mode, text ):
+        with open(csv_path,mode) as f:
+            f.write(text)
+        st = os.stat(csv_path)
+        os.utime(csv_path,ns=(st.st_atime_ns,st.st_mtime_ns+1000000000))
+
+    write("w","Run,Result,Host\n1,1.5,a\n2,2.5,a\n3,3.5,a\n")
+    table_def = { "name" : "delta", "type" : "CSVDataTable", "refresh_minutes" : 0, "csv_spec" : csv_path,
+        "csv_map" : [["Run","Run","_int"],["Result","Result","_float"],["Host","Host","_string"]], "csv_tail" : True, "csv_max_rows" : 4 }
+
+    class StubManager():
+        def connect(self,ssh_spec,client):
+            return connection
+    monkeypatch.setattr("data_sources.remote_data.get_connection_manager",lambda: StubManager())
+    rdt = RemoteDataTable("ssh://user@localhost",table_def,"delta",1)
+    assert rdt.remote_version
+    assert [ c.get_value() for c in rdt.get_column("Run").values ] == [1,2,3]
+
+    delta = connection.get_delta("delta",rdt.remote_version)
+    assert not delta["reset"] and delta["version"] == rdt.remote_version
+    assert delta["columns"] == [{"name":"Run"},{"name":"Result"},{"name":"Host"}]
+
+    host = rdt.get_column("Host")
+    write("a","4,4.5,a\n5,5.5,a\n")
+    connection.refresh("delta")
+    since = rdt.remote_version
+    delta = connection.get_delta("delta",since)
+    assert isinstance(connection.get("delta"),bytes)
+    assert [ (c["name"],c["evict"],c["keep"],[ v.get_value() for v in c["append"] ]) for c in delta["columns"] ] == [
+        ("Run",1,2,[4,5]),("Result",1,2,[4.5,5.5]),("Host",0,3,["a"])]
+
+    rdt.refresh()
+    assert rdt.get_column("Host") is host
+    assert [ c.get_value() for c in rdt.get_column("Run").values ] == [2,3,4,5]
+    assert [ c.get_value() for c in rdt.get_column("Result").values ] == [2.5,3.5,4.5,5.5]
+    assert [ c.get_value() for c in host.values ] == ["a","a","a","a"]
+
+    assert connection.get_delta("delta",999999)["reset"]
+
+def test_TableHistory():
+    from dashboard_cli.server import TableHistory
+    from data_sources.remote_data import encode_delta,decode_delta,delta_json
+    dt = DataTable(None,"History",1)
+    dt.add_column(Column(values=[Cell(int_type,idx,format_int) for idx in range(5)],name="Bucket"))
+    dt.add_column(Column(values=[Cell(float_type,0.5,format_float) for idx in range(5)],name="Value"))
+    history = TableHistory()
+    delta = history.delta(dt,0)
+    assert delta["reset"] and [ (c["evict"],c["keep"],len(c["append"])) for c in delta["columns"] ] == [(0,0,5),(0,0,5)]
+    version = delta["version"]
+
+    # the last bucket updated in place keeps every row but the last
+    dt.put(4,"Value",Cell(float_type,1.5,format_float))
+    delta = history.delta(dt,version)
+    assert delta["columns"][0] == {"name":"Bucket"}
+    assert [ (c["evict"],c["keep"],[ v.get_value() for v in c["append"] ]) for c in delta["columns"][1:] ] == [(0,4,[1.5])]
+
+    # a new bucket evicts the oldest one
+    for name in ["Bucket","Value"]:
+        dt.get_column(name).delete(0)
+    dt.put(4,"Bucket",Cell(int_type,5,format_int))
+    dt.put(4,"Value",Cell(float_type,0.5,format_float))
+    delta = history.delta(dt,delta["version"])
+    assert [ (c["evict"],c["keep"],len(c["append"])) for c in delta["columns"] ] == [(1,4,1),(1,4,1)]
+
+    for decoded in [decode_delta(encode_delta(delta,"zlib")),json.loads(delta_json(delta))]:
+        assert decoded["version"] == delta["version"] and not decoded["reset"]
+        assert [ (c["evict"],c["keep"]) for c in decoded["columns"] ] == [(1,4),(1,4)]
+    assert [ v.get_value() for v in decode_delta(encode_delta(delta,"none"))["columns"][1]["append"] ] == [0.5]
+
+def test_Connection_subscribe(table_server,tmp_path,monkeypatch):
+    connection = table_server["connection"]
+    assert connection.negotiate(5) == 5
+    csv_path = str(tmp_path / "results.csv")
+    def write( mode, text ):
+        with open(csv_path,mode) as f:
+            f.write(text)
+        st = os.stat(csv_path)
+        os.utime(csv_path,ns=(st.st_atime_ns,st.st_mtime_ns+1000000000))
+
+    write("w","Run,Result\n1,1.5\n2,2.5\n")
+    table_def = { "name" : "pushed", "type" : "CSVDataTable", "refresh_minutes" : 0, "csv_spec" : csv_path,
+        "csv_map" : [["Run","Run","_int"],["Result","Result","_float"]], "csv_tail" : True }
+
+    class StubManager():
+        def connect(self,ssh_spec,client):
+            return connection
+    monkeypatch.setattr("data_sources.remote_data.get_connection_manager",lambda: StubManager())
+    rdt = RemoteDataTable("ssh://user@localhost",table_def,"pushed",1)
+    assert rdt.subscription != None
+    assert [ c.get_value() for c in rdt.get_column("Run").values ] == [1,2]
+
+    pushes = []
+    rdt.listen(lambda t: pushes.append(t.remote_version))
+    write("a","3,3.5\n")
+    for i in range(100):
+        if rdt.get_column("Run").size() == 3:
+            break
+        time.sleep(0.1)
+    assert [ c.get_value() for c in rdt.get_column("Run").values ] == [1,2,3]
+    assert pushes
+
+    version = rdt.remote_version
+    rdt.refresh()
+    assert rdt.remote_version == version
+
+    # a slow listener runs on the push thread and doesn't hold up other responses
+    rdt.listen(lambda t: time.sleep(2))
+    write("a","4,4.5\n")
+    time.sleep(1.5)
+    start_time = time.time()
+    assert connection.get_delta("pushed",0)["reset"]
+    assert time.time()-start_time < 1.0
+
+    subscription = connection.subscribe("pushed",0,lambda response: None)
+    assert connection.unsubscribe(subscription).startswith("unsubscribed:")
+
+    # when the connection closes the table stops waiting for pushes
+    table_server["process"].kill()
+    for i in range(100):
+        if rdt.subscription == None:
+            break
+        time.sleep(0.1)
+    assert rdt.subscription == None and rdt.connection == None
+
+def test_ConnectionManager_parallel(tmp_path,monkeypatch):
+    class StubSSHClient():
+        def load_system_host_keys(self):
+            pass
+        def load_host_keys(self,path):
+            pass
+        def connect(self,hostname,port,username,password):
+            time.sleep(0.5)
+        def close(self):
+            pass
+
+    class StubConnection():
+        def __init__(self,ssh_client,protocol):
+            self.ssh_client = ssh_client
+            self.protocol = protocol
+            self.clients = []
+        closed = False
+        def open(self,client):
+            self.clients.append(client)
+        def exit(self):
+            pass
+
+    commands = []
+    def run_command( ssh_client, command ):
+        commands.append(command)
+        time.sleep(0.5)
+        if command.endswith("--protocol"):
+            return (0,"dashboard protocol 1,2,3,4,5\n","")
+        return (0,"dashboard version %s\n"%__version__,"")
+
+    from dashboard.version import __version__
+    monkeypatch.setattr("data_sources.remote_data.SSHClient",StubSSHClient)
+    monkeypatch.setattr("keyring.get_password",lambda server,username: "password")
+    cache_path = str(tmp_path / "remote_hosts.json")
+    ssh_specs = [ "ssh://user@host%d"%idx for idx in range(8) ]
+
+    cm = ConnectionManager(cache_path)
+    monkeypatch.setattr(cm,"run_command",run_command)
+    monkeypatch.setattr(cm,"start_server",lambda ssh_client,protocol: StubConnection(ssh_client,protocol))
+    start_time = time.time()
+    connections = cm.connect_all(ssh_specs+ssh_specs[:2])
+    assert time.time()-start_time < 4.0
+    assert sorted(connections) == sorted(ssh_specs)
+    assert len(commands) == 2*len(ssh_specs)
+    assert cm.connect(ssh_specs[0],"client") is connections[ssh_specs[0]]
+    assert connections[ssh_specs[0]].clients == ["client"]
+    cm.shutdown()
+
+    commands.clear()
+    cm = ConnectionManager(cache_path)
+    monkeypatch.setattr(cm,"run_command",run_command)
+    monkeypatch.setattr(cm,"start_server",lambda ssh_client,protocol: StubConnection(ssh_client,protocol))
+    assert len(cm.connect_all(ssh_specs)) == len(ssh_specs)
+    assert commands == []
+    assert cm.cached_protocol("user@host0:22") == 5
+    cm.shutdown()
+
+def test_ConnectionManager_cached_protocol(tmp_path,monkeypatch):
+    class StubSSHClient():
+        closed = False
+        def load_system_host_keys(self):
+            pass
+        def connect(self,hostname,port,username,password):
+            pass
+        def close(self):
+            self.closed = True
+
+    class StubSession():
+        def __init__(self,process):
+            self.process = process
+            self.closed = False
+        def close(self):
+            self.closed = True
+            self.process.kill()
+
+    # a server that exits at once and one that only speaks protocol 2
+    protocol_2_server = "\n".join([
+        "import sys",
+        "for line in sys.stdin:",
+        "    if line.split()[-1] == 'exit':",
+        "        break",
+        "    print('protocol:2' if line.startswith('protocol:') else 'error:',flush=True)" ])
+    servers = [ "pass", protocol_2_server ]
+    sessions = []
+    def start_command( ssh_client, command, binary=False ):
+        process = subprocess.Popen([sys.executable,"-c",servers.pop(0)],stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        sessions.append(StubSession(process))
+        return (sessions[-1],io.TextIOWrapper(process.stdin,line_buffering=True),process.stdout,io.TextIOWrapper(process.stderr))
+
+    commands = []
+    def run_command( ssh_client, command ):
+        commands.append(command)
+        if command.endswith("--protocol"):
+            return (0,"dashboard protocol 1,2,3,4,5\n","")
+        return (0,"dashboard version %s\n"%__version__,"")
+
+    from dashboard.version import __version__
+    monkeypatch.setattr("data_sources.remote_data.SSHClient",StubSSHClient)
+    monkeypatch.setattr("keyring.get_password",lambda server,username: "password")
+    cm = ConnectionManager(str(tmp_path / "remote_hosts.json"))
+    monkeypatch.setattr(cm,"start_command",start_command)
+    monkeypatch.setattr(cm,"run_command",run_command)
+
+    # the cached server fails to start, it is disconnected and the full setup runs
+    cm.cache_host("user@host0:22",5)
+    connection = cm.open_connection("ssh://user@host0")
+    assert sessions[0].closed
+    assert not sessions[1].closed
+    assert len(commands) == 2
+    assert connection.protocol == 2
+    assert cm.cached_protocol("user@host0:22") == 2
+    connection.exit()
+
+    # the cached protocol is rejected, the connection is kept but the host is forgotten
+    servers.append(protocol_2_server)
+    cm.cache_host("user@host0:22",5)
+    commands.clear()
+    connection = cm.open_connection("ssh://user@host0")
+    assert connection.protocol == 2
+    assert commands == []
+    assert cm.cached_protocol("user@host0:22") == None
+    connection.exit()
+    cm.shutdown()
+
 def test_ProcDataTable():
     pdt = ProcDataTable(1,1/60,1/60)
     column_names = [ "Time Stamps", "CPU Percent", "Load Avg",
@@ -283,3 +1110,110 @@ def test_ProcDataTable():
 
     for cn in column_names:
         assert pdt.get(0,cn) != blank_cell
+
+def test_ProcDataTable_sampling():
+    pdt = ProcDataTable(1,1,1,0.1,["max"])
+    pdt.start_refresh()
+    try:
+        time.sleep(2)
+    finally:
+        pdt.stop_refresh()
+
+    assert pdt.get_bounds()[0] == 1
+    cpu = pdt.get(0,"CPU Percent")
+    assert cpu.count > 10
+    assert pdt.get(0,"CPU Percent Max").get_value() == cpu.get_stat("max")
+    assert cpu.get_stat("min") <= cpu.get_value() <= cpu.get_stat("max")
+
+def test_ProcDataTable_rates():
+    rc = RateCounter()
+    assert rc.rate(100,10.0) == None
+    assert rc.rate(300,12.0) == 100.0
+    assert rc.rate(50,14.0) == 25.0
+    assert rc.rate(50,14.0) == None
+
+    pdt = ProcDataTable(1,1/60,1/60)
+    rate_names = [ "Filesystem Read Bytes/Sec","Filesystem Write Bytes/Sec","Filesystem Read Ops/Sec","Filesystem Write Ops/Sec",
+        "Network Sent Bytes/Sec","Network Received Bytes/Sec","Network Sent Packets/Sec","Network Received Packets/Sec" ]
+    for cn in rate_names:
+        assert pdt.has_column(cn)
+
+    time.sleep(1)
+    pdt.refresh()
+
+    for cn in rate_names:
+        assert pdt.get(0,cn) != blank_cell
+        assert pdt.get(0,cn).get_value() >= 0.0
+
+def test_ProcfsSampler():
+    procfs = ProcfsSampler()
+    ps = PsutilSampler()
+    values,counters = procfs.sample_values()
+    ps_values,ps_counters = ps.sample_values()
+    assert [v[0] for v in values] == [v[0] for v in ps_values]
+    assert [c[0] for c in counters] == [c[0] for c in ps_counters]
+    values = dict(values)
+    ps_values = dict(ps_values)
+    assert values["Total Virtual Memory"] == ps_values["Total Virtual Memory"]
+    assert values["Filesystem Percent Full"] == ps_values["Filesystem Percent Full"]
+    assert values["Network Sent Bytes"] <= ps_values["Network Sent Bytes"]
+
+    pdt = ProcDataTable(1,1/60,1/60,proc_backend="procfs")
+    time.sleep(1)
+    pdt.refresh()
+    for cn in ["CPU Percent","Available Virtual Memory","Network Connections","Filesystem Read Bytes/Sec"]:
+        assert pdt.get(0,cn) != blank_cell
+
+def test_ProcDataTable_metrics():
+    pdt = ProcDataTable(1,1/60,1/60,proc_metrics=["per_cpu","per_disk","per_nic","top_processes"],proc_top_n=5,proc_top_sort="rss")
+    assert not pdt.has_column("CPU Percent")
+    assert pdt.has_column("CPU 0 Percent")
+    names = pdt.get_names()
+    assert [n for n in names if n.startswith("Disk ") and n.endswith(" Read Bytes/Sec")]
+    assert [n for n in names if n.startswith("Network ") and n.endswith(" Sent Bytes/Sec")]
+
+    time.sleep(1)
+    pdt.refresh()
+
+    assert pdt.get(0,"CPU 0 Percent") != blank_cell
+    assert pdt.get_column("Process Name").size() == 5
+    for idx in range(4):
+        assert pdt.get(idx,"Process RSS").get_value() >= pdt.get(idx+1,"Process RSS").get_value()
+
+def test_CgroupDataTable(tmp_path):
+    cgroup_root = str(tmp_path / "cgroup")
+    for service in ["a.service","b.service"]:
+        cgroup_path = os.path.join(cgroup_root,"system.slice",service)
+        os.makedirs(cgroup_path)
+        print("usage_usec 1000000\nuser_usec 600000\nsystem_usec 400000\nthrottled_usec 0",file=open(os.path.join(cgroup_path,"cpu.stat"),"w"))
+        print("4096",file=open(os.path.join(cgroup_path,"memory.current"),"w"))
+        print("anon 1024\nfile 2048",file=open(os.path.join(cgroup_path,"memory.stat"),"w"))
+        print("8:0 rbytes=100 wbytes=200 rios=1 wios=2 dbytes=0 dios=0",file=open(os.path.join(cgroup_path,"io.stat"),"w"))
+
+    cdt = CgroupDataTable(["system.slice/*.service"],1,1/60,1/60,cgroup_root=cgroup_root)
+    try:
+        for service in ["a.service","b.service"]:
+            assert cdt.get(0,"system.slice/%s Memory Current"%service).get_value() == 4096
+            assert cdt.get(0,"system.slice/%s Memory File"%service).get_value() == 2048
+            assert cdt.has_column("system.slice/%s CPU Percent"%service)
+            assert cdt.has_column("system.slice/%s IO Read Bytes/Sec"%service)
+
+        a_path = os.path.join(cgroup_root,"system.slice","a.service")
+        print("usage_usec 1500000\nthrottled_usec 0",file=open(os.path.join(a_path,"cpu.stat"),"w"))
+        print("8:0 rbytes=1100 wbytes=200 rios=3 wios=2",file=open(os.path.join(a_path,"io.stat"),"w"))
+        time.sleep(1)
+        cdt.refresh()
+
+        assert 0.0 < cdt.get(0,"system.slice/a.service CPU Percent").get_value() <= 50.0
+        assert 0.0 < cdt.get(0,"system.slice/a.service IO Read Bytes/Sec").get_value() <= 1000.0
+        assert cdt.get(0,"system.slice/b.service CPU Percent").get_value() == 0.0
+
+        b_files = cdt.cgroups["system.slice/b.service"]
+        shutil.rmtree(os.path.join(cgroup_root,"system.slice","b.service"))
+        cdt.refresh()
+        assert list(cdt.cgroups) == ["system.slice/a.service"]
+        assert not b_files.files
+        assert not [ cn for cn in cdt.rate_counters if cn.startswith("system.slice/b.service") ]
+    finally:
+        cdt.stop_refresh()
+    assert not cdt.cgroups["system.slice/a.service"].files